@@ -16,9 +16,78 @@ IMAGE_MAX_SIZE_DEFAULT = int(os.environ.get("IMAGE_MAX_SIZE", "1024"))
 IMAGE_QUALITY_DEFAULT = int(os.environ.get("IMAGE_QUALITY", "85"))
 MAX_SECTION_CHARS_DEFAULT = int(os.environ.get("MAX_SECTION_CHARS", "60000"))
 
+# Batch planner: "greedy" (sequential fill) or "binpack" (first-fit-decreasing within a locality window)
+BATCH_PLANNER_DEFAULT = os.environ.get("BATCH_PLANNER", "greedy")
+BATCH_LOCALITY_WINDOW_DEFAULT = int(os.environ.get("BATCH_LOCALITY_WINDOW", "8"))
+# Keep each batch's predicted CSV output under this many tokens; 0 disables. Models in the
+# capability registry use their own output limit instead (see batch_limits_for_models)
+OUTPUT_TOKEN_BUDGET_DEFAULT = int(os.environ.get("OUTPUT_TOKEN_BUDGET", "3600"))
+# Output-size calibration learned from finished batches (runtime state, kept under data/)
+OUTPUT_CALIBRATION_PATH = Path(
+	os.environ.get("OUTPUT_CALIBRATION_PATH", str(BASE_DIR / "data" / "calibration" / "output_model.json"))
+)
+
+# Incremental mode: diff unit size (chars) and min similarity to treat a moved/renamed unit as modified
+DIFF_UNIT_CHARS_DEFAULT = int(os.environ.get("DIFF_UNIT_CHARS", "4000"))
+DIFF_SIMILARITY_THRESHOLD_DEFAULT = float(os.environ.get("DIFF_SIMILARITY_THRESHOLD", "0.5"))
+
+# Memoized parse/batch-plan results (LRU bounded by entry count and cached PRD size)
+PARSE_CACHE_MAX_ENTRIES_DEFAULT = int(os.environ.get("PARSE_CACHE_MAX_ENTRIES", "32"))
+PARSE_CACHE_MAX_MB_DEFAULT = int(os.environ.get("PARSE_CACHE_MAX_MB", "64"))
+
+# Image download guards (streamed fetch with byte cap and per-image deadline)
+IMAGE_MAX_BYTES_DEFAULT = int(os.environ.get("IMAGE_MAX_BYTES", str(15 * 1024 * 1024)))
+IMAGE_CONNECT_TIMEOUT_DEFAULT = float(os.environ.get("IMAGE_CONNECT_TIMEOUT", "5"))
+IMAGE_READ_TIMEOUT_DEFAULT = float(os.environ.get("IMAGE_READ_TIMEOUT", "10"))
+IMAGE_DEADLINE_SECONDS_DEFAULT = float(os.environ.get("IMAGE_DEADLINE_SECONDS", "20"))
+
+# Near-duplicate image pruning: max dHash Hamming distance (0-64) to merge; -1 disables
+IMAGE_DEDUP_DISTANCE_DEFAULT = int(os.environ.get("IMAGE_DEDUP_DISTANCE", "-1"))
+
+# Model-aware image sizing: crop uniform margins, and cap estimated image tokens per batch (0 = no cap)
+IMAGE_CROP_MARGINS_DEFAULT = os.environ.get("IMAGE_CROP_MARGINS", "0") == "1"
+IMAGE_TOKEN_BUDGET_DEFAULT = int(os.environ.get("IMAGE_TOKEN_BUDGET", "0"))
+# Per-image encoded byte budget; >0 enables WebP/JPEG/PNG-8 quality search (0 = fixed JPEG quality)
+IMAGE_BYTE_BUDGET_DEFAULT = int(os.environ.get("IMAGE_BYTE_BUDGET", "0"))
+
+# Prompt compaction: image tags -> attachment placeholders, drop comments/padding ("0" disables)
+PROMPT_COMPACTION_DEFAULT = os.environ.get("PROMPT_COMPACTION", "1") == "1"
+
+# Send image-free batches to the text model and plan them apart from image batches ("0" disables)
+TEXT_BATCH_ROUTING_DEFAULT = os.environ.get("TEXT_BATCH_ROUTING", "1") == "1"
+
+# Drop near-duplicate test cases after merging batches (MinHash similarity of 测试项/步骤/预期, same
+# 预期结果 and numbers required); 0 disables. Off by default: it can only ever delete cases, try 0.9
+CASE_DEDUP_THRESHOLD_DEFAULT = float(os.environ.get("CASE_DEDUP_THRESHOLD", "0"))
+
+# Re-ask the text model for malformed CSV rows only (wrong column count / empty required fields)
+ROW_REPAIR_DEFAULT = os.environ.get("ROW_REPAIR", "1") == "1"
+
+# Enhance mode: "delta" asks only for added/modified rows and merges them locally; "full" rewrites the whole CSV
+ENHANCE_MODE_DEFAULT = os.environ.get("ENHANCE_MODE", "delta")
+
+# Delta enhance splits large suites into chunks of about this many input tokens, grouped by 模块/子模块
+ENHANCE_CHUNK_TOKENS_DEFAULT = int(os.environ.get("ENHANCE_CHUNK_TOKENS", "6000"))
+
+# Persisted KB vector index with approximate (IVF) search once it holds KB_ANN_MIN_ROWS sections ("1" enables; needs NumPy).
+# Below that, exact search is already about 1 ms and IVF recall is poor (20k sections: nprobe=16 is 1.8x
+# faster at recall@10 0.92); at 60k nprobe=16 is about 5x faster at 0.96 (scripts/bench_kb_ann.py)
+KB_ANN_INDEX_DEFAULT = os.environ.get("KB_ANN_INDEX", "0") == "1"
+KB_ANN_MIN_ROWS_DEFAULT = int(os.environ.get("KB_ANN_MIN_ROWS", "50000"))
+# IVF clusters (0 = about sqrt(sections)) and clusters probed per query (higher = better recall, slower)
+KB_ANN_NLIST_DEFAULT = int(os.environ.get("KB_ANN_NLIST", "0"))
+KB_ANN_NPROBE_DEFAULT = int(os.environ.get("KB_ANN_NPROBE", "16"))
+KB_INDEX_DIR = Path(os.environ.get("KB_INDEX_DIR", str(BASE_DIR / "data" / "kb" / "index")))
+
+# Model capability overrides: JSON file and/or inline JSON {"<model regex>": {"context_window": ..., ...}}
+MODEL_CAPABILITIES_FILE = Path(os.environ.get("MODEL_CAPABILITIES_FILE", str(BASE_DIR / "model_capabilities.json")))
+MODEL_CAPABILITIES_JSON = os.environ.get("MODEL_CAPABILITIES", "")
+
 # Concurrency defaults
 BATCH_INFERENCE_CONCURRENCY_DEFAULT = int(os.environ.get("BATCH_INFERENCE_CONCURRENCY", "2"))
 IMAGE_DOWNLOAD_CONCURRENCY_DEFAULT = int(os.environ.get("IMAGE_DOWNLOAD_CONCURRENCY", "4"))
+# Buffered (processed, not yet consumed) image bytes allowed per prefetching run
+IMAGE_PREFETCH_MEMORY_MB_DEFAULT = int(os.environ.get("IMAGE_PREFETCH_MEMORY_MB", "64"))
 
 # Global rate limiter for model calls
 MAX_CONCURRENT_MODEL_CALLS_DEFAULT = int(os.environ.get("MAX_CONCURRENT_MODEL_CALLS", "3"))
@@ -34,8 +103,38 @@ __all__ = [
 	"IMAGE_MAX_SIZE_DEFAULT",
 	"IMAGE_QUALITY_DEFAULT",
 	"MAX_SECTION_CHARS_DEFAULT",
+	"BATCH_PLANNER_DEFAULT",
+	"BATCH_LOCALITY_WINDOW_DEFAULT",
+	"OUTPUT_TOKEN_BUDGET_DEFAULT",
+	"OUTPUT_CALIBRATION_PATH",
+	"DIFF_UNIT_CHARS_DEFAULT",
+	"DIFF_SIMILARITY_THRESHOLD_DEFAULT",
+	"PARSE_CACHE_MAX_ENTRIES_DEFAULT",
+	"PARSE_CACHE_MAX_MB_DEFAULT",
+	"IMAGE_MAX_BYTES_DEFAULT",
+	"IMAGE_CONNECT_TIMEOUT_DEFAULT",
+	"IMAGE_READ_TIMEOUT_DEFAULT",
+	"IMAGE_DEADLINE_SECONDS_DEFAULT",
+	"IMAGE_DEDUP_DISTANCE_DEFAULT",
+	"IMAGE_CROP_MARGINS_DEFAULT",
+	"IMAGE_TOKEN_BUDGET_DEFAULT",
+	"IMAGE_BYTE_BUDGET_DEFAULT",
+	"PROMPT_COMPACTION_DEFAULT",
+	"TEXT_BATCH_ROUTING_DEFAULT",
+	"CASE_DEDUP_THRESHOLD_DEFAULT",
+	"ROW_REPAIR_DEFAULT",
+	"ENHANCE_MODE_DEFAULT",
+	"ENHANCE_CHUNK_TOKENS_DEFAULT",
+	"KB_ANN_INDEX_DEFAULT",
+	"KB_ANN_MIN_ROWS_DEFAULT",
+	"KB_ANN_NLIST_DEFAULT",
+	"KB_ANN_NPROBE_DEFAULT",
+	"KB_INDEX_DIR",
+	"MODEL_CAPABILITIES_FILE",
+	"MODEL_CAPABILITIES_JSON",
 	"BATCH_INFERENCE_CONCURRENCY_DEFAULT",
 	"IMAGE_DOWNLOAD_CONCURRENCY_DEFAULT",
+	"IMAGE_PREFETCH_MEMORY_MB_DEFAULT",
 	"MAX_CONCURRENT_MODEL_CALLS_DEFAULT",
 	"MIN_CALL_INTERVAL_MS_DEFAULT",
 ]
@@ -8,23 +8,47 @@ from backend.config import (
 	DISABLE_VISION_DEFAULT,
 	IMAGE_MAX_SIZE_DEFAULT,
 	IMAGE_QUALITY_DEFAULT,
-	MAX_IMAGES_PER_BATCH_DEFAULT,
-	MAX_SECTION_CHARS_DEFAULT,
 	BATCH_INFERENCE_CONCURRENCY_DEFAULT,
 	IMAGE_DOWNLOAD_CONCURRENCY_DEFAULT,
+	IMAGE_DEDUP_DISTANCE_DEFAULT,
+	IMAGE_CROP_MARGINS_DEFAULT,
+	IMAGE_TOKEN_BUDGET_DEFAULT,
+	IMAGE_BYTE_BUDGET_DEFAULT,
+	BATCH_PLANNER_DEFAULT,
+	BATCH_LOCALITY_WINDOW_DEFAULT,
+	PROMPT_COMPACTION_DEFAULT,
+	TEXT_BATCH_ROUTING_DEFAULT,
+	CASE_DEDUP_THRESHOLD_DEFAULT,
+	ROW_REPAIR_DEFAULT,
 )
 from backend.services import (
+	batch_limits_for_models,
 	build_vision_messages,
 	call_model_with_retries,
-	create_batches_from_sections,
+	SQA_SYSTEM_PROMPT,
+	compare_batch_planners,
 	create_openai_client,
+	generate_incremental_csv,
 	make_key,
 	cache_get,
 	cache_set,
 	merge_csv_texts,
-	validate_strict_csv,
-	coerce_to_strict_csv,
-	parse_prd_sections,
+	merge_csv_rows,
+	make_row_repairer,
+	rows_to_csv,
+	record_output_usage,
+	summarize_image_dedup,
+	summarize_image_tokens,
+	summarize_image_payload,
+	summarize_batch_models,
+	select_batch_model,
+	summarize_prompt_compaction,
+	summarize_prompt_cache,
+	start_image_prefetch,
+	normalize_csv,
+	parse_prd_sections_cached,
+	plan_prd_batches,
+	prune_section_images,
     uploads_get_prd,
 )
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -62,12 +86,37 @@ def generate_test_cases():
 	user_text_model = user_config.get("text_model")
 	user_vision_model = user_config.get("vision_model")
 	user_disable_vision = user_config.get("disable_vision", DISABLE_VISION_DEFAULT)
-	user_max_images_per_batch = user_config.get("max_images_per_batch") or MAX_IMAGES_PER_BATCH_DEFAULT
+	# Defaults sized to the registered limits of the models in use
+	model_limits = batch_limits_for_models([user_vision_model, user_text_model])
+	user_max_images_per_batch = user_config.get("max_images_per_batch") or model_limits["max_images"]
 	user_image_max_size = user_config.get("image_max_size") or IMAGE_MAX_SIZE_DEFAULT
 	user_image_quality = user_config.get("image_quality") or IMAGE_QUALITY_DEFAULT
-	user_max_section_chars = user_config.get("max_section_chars") or MAX_SECTION_CHARS_DEFAULT
+	user_max_section_chars = user_config.get("max_section_chars") or model_limits["max_section_chars"]
 	user_batch_infer_conc = user_config.get("batch_inference_concurrency") or BATCH_INFERENCE_CONCURRENCY_DEFAULT
 	user_image_dl_conc = user_config.get("image_download_concurrency") or IMAGE_DOWNLOAD_CONCURRENCY_DEFAULT
+	user_image_dedup_distance = user_config.get("image_dedup_distance")
+	if user_image_dedup_distance is None:
+		user_image_dedup_distance = IMAGE_DEDUP_DISTANCE_DEFAULT
+	user_image_crop_margins = user_config.get("image_crop_margins", IMAGE_CROP_MARGINS_DEFAULT)
+	user_image_token_budget = user_config.get("image_token_budget") or IMAGE_TOKEN_BUDGET_DEFAULT
+	user_image_byte_budget = user_config.get("image_byte_budget") or IMAGE_BYTE_BUDGET_DEFAULT
+	user_prompt_compaction = user_config.get("prompt_compaction", PROMPT_COMPACTION_DEFAULT)
+	user_batch_planner = user_config.get("batch_planner") or BATCH_PLANNER_DEFAULT
+	user_locality_window = user_config.get("batch_locality_window") or BATCH_LOCALITY_WINDOW_DEFAULT
+	user_output_token_budget = user_config.get("output_token_budget")
+	if user_output_token_budget is None:
+		user_output_token_budget = model_limits["max_output_tokens"]
+	# Image-free batches go to the text model alone, so they are sized to its own limits
+	text_limits = batch_limits_for_models([user_text_model])
+	user_text_max_section_chars = user_config.get("max_section_chars") or text_limits["max_section_chars"]
+	user_text_output_token_budget = user_config.get("output_token_budget")
+	if user_text_output_token_budget is None:
+		user_text_output_token_budget = text_limits["max_output_tokens"]
+	user_route_text_batches = user_config.get("route_text_batches", TEXT_BATCH_ROUTING_DEFAULT)
+	user_case_dedup_threshold = user_config.get("case_dedup_threshold")
+	if user_case_dedup_threshold is None:
+		user_case_dedup_threshold = CASE_DEDUP_THRESHOLD_DEFAULT
+	user_row_repair = user_config.get("row_repair", ROW_REPAIR_DEFAULT)
 
 	if not user_api_key or not user_text_model:
 		return jsonify({"error": "缺少必要配置：请在模型配置中填写 API Key 和 文本模型名称。"}), 400
@@ -90,30 +139,32 @@ def generate_test_cases():
 		return jsonify({"test_cases": cached["result"], "meta": cached.get("meta", {})})
 
 	if old_prd_content and old_prd_content.strip():
-		final_prompt = prompt_template_diff.format(
-			old_prd_content=old_prd_content,
-			new_prd_content=new_prd_content,
-		)
-		messages = [
-			{
-				"role": "system",
-				"content": "你是一名顶级的、经验丰富的软件测试保证（SQA）工程师。请始终使用简体中文输出。",
+		# Diff the PRDs section by section and only generate for added/modified parts
+		ai_response, meta = generate_incremental_csv(
+			user_client,
+			old_prd_content,
+			new_prd_content or "",
+			prompt_template_diff,
+			text_model=user_text_model,
+			vision_model=user_vision_model,
+			use_vision=not user_disable_vision,
+			max_images=int(user_max_images_per_batch),
+			max_section_chars=int(user_max_section_chars),
+			dedup_threshold=float(user_case_dedup_threshold),
+			row_repair=bool(user_row_repair),
+			concurrency=int(user_batch_infer_conc),
+			vision_options={
+				"use_deepseek": bool(user_base_url) and "deepseek" in str(user_base_url).lower(),
+				"image_max_size": user_image_max_size,
+				"image_quality": user_image_quality,
+				"image_download_concurrency": int(user_image_dl_conc),
+				"image_dedup_distance": int(user_image_dedup_distance),
+				"image_crop_margins": bool(user_image_crop_margins),
+				"image_token_budget": int(user_image_token_budget),
+				"image_byte_budget": int(user_image_byte_budget),
+				"compact_prompt": bool(user_prompt_compaction),
 			},
-			{"role": "user", "content": final_prompt},
-		]
-
-		completion = user_client.chat.completions.create(
-			model=user_text_model,
-			messages=messages,
-			max_tokens=4096,
 		)
-		ai_response = completion.choices[0].message.content
-
-		meta = {
-			"mode": "incremental",
-			"model_used": user_text_model,
-			"use_vision": False,
-		}
 
 		cache_set(cache_key, {"result": ai_response, "meta": meta})
 		return jsonify({"test_cases": ai_response, "meta": meta})
@@ -121,30 +172,19 @@ def generate_test_cases():
 	if user_disable_vision:
 		final_prompt = prompt_template_full.format(prd_content=new_prd_content)
 		messages = [
-			{
-				"role": "system",
-				"content": "你是一名资深SQA工程师。请严格基于以下PRD生成测试用例，使用简体中文，不得编造无关场景。",
-			},
+			{"role": "system", "content": SQA_SYSTEM_PROMPT},
 			{"role": "user", "content": final_prompt},
 		]
-		completion = user_client.chat.completions.create(
-			model=user_text_model,
-			messages=messages,
-			max_tokens=4096,
-		)
-		ai_response = completion.choices[0].message.content
+		usage: dict = {}
+		ai_response = call_model_with_retries(user_client, user_text_model, messages, usage=usage)
 		# 宽松模式：不再拦截；若能修复则返回修复后的内容
-		ok, _ = validate_strict_csv(ai_response)
-		if not ok:
-			repaired = coerce_to_strict_csv(ai_response)
-			ok2, _ = validate_strict_csv(repaired)
-			if ok2:
-				ai_response = repaired
+		ai_response, _, _ = normalize_csv(ai_response)
 
 		meta = {
 			"mode": "full-text-fallback",
 			"model_used": user_text_model,
 			"use_vision": False,
+			"usage": usage,
 		}
 
 		cache_set(cache_key, {"result": ai_response, "meta": meta})
@@ -153,48 +193,60 @@ def generate_test_cases():
 	if not user_vision_model:
 		return jsonify({"error": "缺少视觉模型名称：请在模型配置中填写视觉模型或勾选禁用图片识别。"}), 400
 
-	sections = parse_prd_sections(new_prd_content)
+	# Memoized: previews and retries of the same PRD skip parsing
+	sections = parse_prd_sections_cached(new_prd_content)
 	total_images = sum(len(section["images"]) for section in sections)
 
 	if total_images == 0:
 		final_prompt = prompt_template_full.format(prd_content=new_prd_content)
 		messages = [
-			{
-				"role": "system",
-				"content": "你是一名资深SQA工程师。请严格基于以下PRD生成测试用例，使用简体中文，不得编造无关场景。",
-			},
+			{"role": "system", "content": SQA_SYSTEM_PROMPT},
 			{"role": "user", "content": final_prompt},
 		]
-		completion = user_client.chat.completions.create(
-			model=user_text_model,
-			messages=messages,
-			max_tokens=4096,
-		)
-		ai_response = completion.choices[0].message.content
-		ok, _ = validate_strict_csv(ai_response)
-		if not ok:
-			repaired = coerce_to_strict_csv(ai_response)
-			ok2, _ = validate_strict_csv(repaired)
-			if ok2:
-				ai_response = repaired
+		usage: dict = {}
+		ai_response = call_model_with_retries(user_client, user_text_model, messages, usage=usage)
+		ai_response, _, _ = normalize_csv(ai_response)
 
 		meta = {
 			"mode": "full-no-images",
 			"model_used": user_text_model,
 			"use_vision": False,
+			"usage": usage,
 		}
 
 		cache_set(cache_key, {"result": ai_response, "meta": meta})
 		return jsonify({"test_cases": ai_response, "meta": meta})
 
-	batches = create_batches_from_sections(
-		sections,
+	use_deepseek = bool(user_base_url) and "deepseek" in str(user_base_url).lower()
+
+	# Start fetching every image now so downloads overlap earlier batches
+	prefetcher = None
+	if not use_deepseek:
+		prefetcher = start_image_prefetch(
+			sections,
+			vision_model=user_vision_model,
+			image_max_size=user_image_max_size,
+			image_quality=user_image_quality,
+			image_crop_margins=bool(user_image_crop_margins),
+			image_byte_budget=int(user_image_byte_budget),
+			concurrency=int(user_image_dl_conc),
+		)
+	# Drop near-duplicate images before planning, so batch sizes count only the kept ones
+	if int(user_image_dedup_distance) >= 0:
+		prune_section_images(sections, int(user_image_dedup_distance), prefetcher=prefetcher)
+	sections, batches = plan_prd_batches(
+		new_prd_content,
 		user_max_images_per_batch,
 		user_max_section_chars,
+		planner=user_batch_planner,
+		locality_window=int(user_locality_window),
+		max_output_tokens=int(user_output_token_budget),
+		split_by_modality=bool(user_route_text_batches),
+		text_max_section_chars=int(user_text_max_section_chars),
+		text_max_output_tokens=int(user_text_output_token_budget),
+		sections=sections,
 	)
 
-	use_deepseek = bool(user_base_url) and "deepseek" in str(user_base_url).lower()
-
 	# Function to process a single batch end-to-end
 	def run_one(idx_batch_tuple):
 		idx, batch = idx_batch_tuple
@@ -210,9 +262,19 @@ def generate_test_cases():
 			image_max_size=user_image_max_size,
 			image_quality=user_image_quality,
 			image_download_concurrency=int(user_image_dl_conc),
+			image_dedup_distance=int(user_image_dedup_distance),
+			vision_model=user_vision_model,
+			image_crop_margins=bool(user_image_crop_margins),
+			image_token_budget=int(user_image_token_budget),
+			image_byte_budget=int(user_image_byte_budget),
+			compact_prompt=bool(user_prompt_compaction),
+			prefetcher=prefetcher,
+		)
+		batch_model = select_batch_model(
+			batch, user_vision_model, user_text_model, route_text_batches=bool(user_route_text_batches)
 		)
 		try:
-			return idx, call_model_with_retries(user_client, user_vision_model, msgs)
+			return idx, call_model_with_retries(user_client, batch_model, msgs, usage=batch.setdefault("usage", {}))
 		except Exception as exc:  # noqa: BLE001
 			print(f"第 {idx + 1} 批失败: {exc}")
 			# Degrade: fallback to text-only generation for this batch
@@ -221,44 +283,45 @@ def generate_test_cases():
 			)
 			final_prompt = prompt_template_full.format(prd_content=combined_text)
 			try:
-				completion = user_client.chat.completions.create(
-					model=user_text_model,
-					messages=[
-						{
-							"role": "system",
-							"content": "你是一名资深SQA工程师。请严格基于以下PRD生成测试用例，使用简体中文，不得编造无关场景。",
-						},
+				return idx, call_model_with_retries(
+					user_client,
+					user_text_model,
+					[
+						{"role": "system", "content": SQA_SYSTEM_PROMPT},
 						{"role": "user", "content": final_prompt},
 					],
-					max_tokens=4096,
+					usage=batch.setdefault("usage", {}),
 				)
-				return idx, completion.choices[0].message.content
 			except Exception as exc2:  # noqa: BLE001
 				print(f"第 {idx + 1} 批文本降级也失败: {exc2}")
 				return idx, ""
 
 	# Parallel over batches with bounded workers
-	if len(batches) > 1 and int(user_batch_infer_conc) > 1:
-		with ThreadPoolExecutor(max_workers=int(user_batch_infer_conc)) as ex:
-			futures = [ex.submit(run_one, (i, b)) for i, b in enumerate(batches)]
-			results = {}
-			for fut in as_completed(futures):
-				idx, resp = fut.result()
-				results[idx] = resp
-		responses = [results.get(i, "") for i in range(len(batches))]
-	else:
-		responses: list[str] = []
-		for idx, batch in enumerate(batches):
-			_, resp = run_one((idx, batch))
-			responses.append(resp)
-
-	final_response = merge_csv_texts(responses)
-	ok, _ = validate_strict_csv(final_response)
-	if not ok:
-		repaired = coerce_to_strict_csv(final_response)
-		ok2, _ = validate_strict_csv(repaired)
-		if ok2:
-			final_response = repaired
+	try:
+		if len(batches) > 1 and int(user_batch_infer_conc) > 1:
+			with ThreadPoolExecutor(max_workers=int(user_batch_infer_conc)) as ex:
+				futures = [ex.submit(run_one, (i, b)) for i, b in enumerate(batches)]
+				results = {}
+				for fut in as_completed(futures):
+					idx, resp = fut.result()
+					results[idx] = resp
+			responses = [results.get(i, "") for i in range(len(batches))]
+		else:
+			responses: list[str] = []
+			for idx, batch in enumerate(batches):
+				_, resp = run_one((idx, batch))
+				responses.append(resp)
+	finally:
+		if prefetcher is not None:
+			prefetcher.close()
+
+	output_usage = record_output_usage(batches, responses)
+	case_rows, csv_report = merge_csv_rows(
+		responses,
+		dedup_threshold=float(user_case_dedup_threshold),
+		repair=make_row_repairer(user_client, user_text_model, batches) if user_row_repair else None,
+	)
+	final_response = rows_to_csv(case_rows) if csv_report["ok"] else merge_csv_texts(responses)
 
 	meta = {
 		"mode": "full-vision-multimodal",
@@ -268,6 +331,139 @@ def generate_test_cases():
 		"total_images": total_images,
 		"total_sections": len(sections),
 	}
+	if int(user_image_dedup_distance) >= 0:
+		meta["image_dedup"] = summarize_image_dedup(batches)
+	meta["image_tokens"] = summarize_image_tokens(batches)
+	meta["image_payload"] = summarize_image_payload(batches)
+	meta["prompt_compaction"] = summarize_prompt_compaction(batches)
+	meta["prompt_cache"] = summarize_prompt_cache(batches)
+	meta["csv_repairs"] = csv_report
+	meta["case_dedup"] = csv_report["dedup"]
+	meta["row_repair"] = csv_report["row_repair"]
+	meta["output_tokens"] = output_usage
+	meta["batches_by_model"] = summarize_batch_models(
+		batches, user_vision_model, user_text_model, route_text_batches=bool(user_route_text_batches)
+	)
+	meta["batch_plan"] = compare_batch_planners(
+		sections,
+		user_max_images_per_batch,
+		user_max_section_chars,
+		planner=user_batch_planner,
+		locality_window=int(user_locality_window),
+		max_output_tokens=int(user_output_token_budget),
+		split_by_modality=bool(user_route_text_batches),
+		text_max_section_chars=int(user_text_max_section_chars),
+		text_max_output_tokens=int(user_text_output_token_budget),
+		batches=batches,
+	)
 
 	cache_set(cache_key, {"result": final_response, "meta": meta})
 	return jsonify({"test_cases": final_response, "meta": meta})
+
+
+@bp.route("/plan", methods=["POST"])
+def preview_batch_plan():
+	"""Return the batch plan for a PRD without calling any model.
+
+	Goes through the same steps as ``/generate``: memoized parse, duplicate
+	image pruning (which downloads the PRD's remote images when dedup is on)
+	and ``plan_prd_batches(sections=...)`` with the same limits. The preview
+	therefore shows the batches the run will use and warms its plan cache.
+	"""
+
+	data = request.get_json() or {}
+	new_prd_content: str | None = data.get("new_prd")
+	new_prd_id = data.get("new_prd_id")
+	if new_prd_id and not new_prd_content:
+		ref = uploads_get_prd(new_prd_id)
+		if not ref:
+			return jsonify({"error": "指定的新PRD文件不存在"}), 404
+		new_prd_content = ref.get("content")
+	if not new_prd_content:
+		return jsonify({"error": "新版PRD内容不能为空"}), 400
+
+	user_config: dict = data.get("config") or {}
+	# Defaults sized to the registered limits of the models in use
+	model_limits = batch_limits_for_models([user_config.get("vision_model"), user_config.get("text_model")])
+	user_max_images_per_batch = user_config.get("max_images_per_batch") or model_limits["max_images"]
+	user_max_section_chars = user_config.get("max_section_chars") or model_limits["max_section_chars"]
+	user_batch_planner = user_config.get("batch_planner") or BATCH_PLANNER_DEFAULT
+	user_locality_window = user_config.get("batch_locality_window") or BATCH_LOCALITY_WINDOW_DEFAULT
+	user_output_token_budget = user_config.get("output_token_budget")
+	if user_output_token_budget is None:
+		user_output_token_budget = model_limits["max_output_tokens"]
+	# Image-free batches go to the text model alone, so they are sized to its own limits
+	text_limits = batch_limits_for_models([user_config.get("text_model")])
+	user_text_max_section_chars = user_config.get("max_section_chars") or text_limits["max_section_chars"]
+	user_text_output_token_budget = user_config.get("output_token_budget")
+	if user_text_output_token_budget is None:
+		user_text_output_token_budget = text_limits["max_output_tokens"]
+	user_route_text_batches = user_config.get("route_text_batches", TEXT_BATCH_ROUTING_DEFAULT)
+	user_image_dedup_distance = user_config.get("image_dedup_distance")
+	if user_image_dedup_distance is None:
+		user_image_dedup_distance = IMAGE_DEDUP_DISTANCE_DEFAULT
+
+	sections = parse_prd_sections_cached(new_prd_content)
+	if int(user_image_dedup_distance) >= 0 and any(s["images"] for s in sections):
+		# Same pruning as /generate, so the plan (and its memo key) match the run
+		user_base_url = user_config.get("base_url")
+		prefetcher = None
+		if not (bool(user_base_url) and "deepseek" in str(user_base_url).lower()):
+			prefetcher = start_image_prefetch(
+				sections,
+				vision_model=user_config.get("vision_model"),
+				image_max_size=user_config.get("image_max_size") or IMAGE_MAX_SIZE_DEFAULT,
+				image_quality=user_config.get("image_quality") or IMAGE_QUALITY_DEFAULT,
+				image_crop_margins=bool(user_config.get("image_crop_margins", IMAGE_CROP_MARGINS_DEFAULT)),
+				image_byte_budget=int(user_config.get("image_byte_budget") or IMAGE_BYTE_BUDGET_DEFAULT),
+				concurrency=int(user_config.get("image_download_concurrency") or IMAGE_DOWNLOAD_CONCURRENCY_DEFAULT),
+			)
+		try:
+			prune_section_images(sections, int(user_image_dedup_distance), prefetcher=prefetcher)
+		finally:
+			if prefetcher is not None:
+				prefetcher.close()
+	sections, batches = plan_prd_batches(
+		new_prd_content,
+		int(user_max_images_per_batch),
+		int(user_max_section_chars),
+		planner=user_batch_planner,
+		locality_window=int(user_locality_window),
+		max_output_tokens=int(user_output_token_budget),
+		split_by_modality=bool(user_route_text_batches),
+		text_max_section_chars=int(user_text_max_section_chars),
+		text_max_output_tokens=int(user_text_output_token_budget),
+		sections=sections,
+	)
+	return jsonify(
+		{
+			"total_sections": len(sections),
+			"total_images": sum(len(s["images"]) for s in sections),
+			"total_batches": len(batches),
+			"model_limits": model_limits,
+			"text_model_limits": text_limits,
+			"batch_plan": compare_batch_planners(
+				sections,
+				int(user_max_images_per_batch),
+				int(user_max_section_chars),
+				planner=user_batch_planner,
+				locality_window=int(user_locality_window),
+				max_output_tokens=int(user_output_token_budget),
+				split_by_modality=bool(user_route_text_batches),
+				text_max_section_chars=int(user_text_max_section_chars),
+				text_max_output_tokens=int(user_text_output_token_budget),
+				batches=batches,
+			),
+			"batches": [
+				{
+					"index": i,
+					"sections": [s["title"] for s in b["sections"]],
+					"images": b["total_images"],
+					"chars": b["total_chars"],
+					"predicted_output_tokens": b["predicted_output_tokens"],
+					"modality": b.get("modality", "vision"),
+				}
+				for i, b in enumerate(batches)
+			],
+		}
+	)
@@ -1,15 +1,27 @@
-"""Async job endpoints for generation progress & ETA."""
+"""Async job endpoints for generation progress & ETA, and result retrieval."""
 
 from __future__ import annotations
 
-from flask import Blueprint, jsonify, request
+from urllib.parse import quote
+
+from flask import Blueprint, Response, jsonify, request
 
 from backend.services import make_key, cache_get, cache_set
-from backend.services.jobs import start_generate_job, start_enhance_job, get_job
+from backend.services.jobs import (
+    start_generate_job,
+    start_enhance_job,
+    get_job,
+    get_job_result,
+    get_job_result_rows,
+)
 
 
 bp = Blueprint("jobs", __name__, url_prefix="/api")
 
+_STREAM_CHUNK_CHARS = 64 * 1024
+_ROWS_PAGE_DEFAULT = 200
+_ROWS_PAGE_MAX = 1000
+
 
 @bp.route("/generate_async", methods=["POST"])
 def generate_async():
@@ -44,7 +56,81 @@ def enhance_async():
 
 @bp.route("/job_status/<job_id>", methods=["GET"])
 def job_status(job_id: str):
+    """Status, progress and meta only; ``?include=result`` also embeds the result (legacy)."""
     job = get_job(job_id)
     if not job:
         return jsonify({"error": "job not found"}), 404
+    if request.args.get("include") == "result":
+        job = dict(job, result=get_job_result(job_id))
     return jsonify(job)
+
+
+def _finished_job(job_id: str):
+    """Return ``(job, None)`` for a job with a result, else ``(None, error_response)``."""
+    job = get_job(job_id)
+    if not job:
+        return None, (jsonify({"error": "job not found"}), 404)
+    if job.get("status") != "done" or not job.get("result_etag"):
+        return None, (jsonify({"error": "任务尚未完成", "status": job.get("status")}), 409)
+    return job, None
+
+
+@bp.route("/job_result/<job_id>.csv", methods=["GET"])
+def job_result_csv(job_id: str):
+    """Stream the result as a CSV download; honours If-None-Match."""
+    job, error = _finished_job(job_id)
+    if error:
+        return error
+    etag = job["result_etag"]
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+    text = get_job_result(job_id)
+    if text is None:
+        return jsonify({"error": "任务结果已过期"}), 410
+
+    def chunks():
+        for start in range(0, len(text), _STREAM_CHUNK_CHARS):
+            yield text[start:start + _STREAM_CHUNK_CHARS]
+
+    filename = request.args.get("filename") or f"test_cases_{job_id[:8]}.csv"
+    resp = Response(chunks(), content_type="text/csv; charset=utf-8")
+    resp.headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(filename)}"
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.set_etag(etag)
+    return resp
+
+
+@bp.route("/job_result/<job_id>/rows", methods=["GET"])
+def job_result_rows(job_id: str):
+    """One page of result rows: ``?offset=0&limit=200`` (limit capped at 1000)."""
+    job, error = _finished_job(job_id)
+    if error:
+        return error
+    try:
+        offset = max(0, int(request.args.get("offset", 0)))
+        limit = min(_ROWS_PAGE_MAX, max(1, int(request.args.get("limit", _ROWS_PAGE_DEFAULT))))
+    except ValueError:
+        return jsonify({"error": "offset/limit 必须为整数"}), 400
+    etag = f"{job['result_etag']}-{offset}-{limit}"
+    if request.if_none_match.contains(etag):
+        resp = Response(status=304)
+        resp.set_etag(etag)
+        return resp
+    parsed = get_job_result_rows(job_id, job["result_etag"])
+    if parsed is None:
+        return jsonify({"error": "任务结果已过期"}), 410
+    header, rows = parsed
+    resp = jsonify(
+        {
+            "header": header,
+            "rows": rows[offset:offset + limit],
+            "offset": offset,
+            "limit": limit,
+            "total": len(rows),
+        }
+    )
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.set_etag(etag)
+    return resp
@@ -5,25 +5,47 @@ from __future__ import annotations
 from flask import Blueprint, jsonify, request
 
 from backend.services import (
+    batch_limits_for_models,
     kb_list_docs,
     kb_load_doc,
     kb_search_similar_sections,
     create_openai_client,
     build_vision_messages,
     call_model_with_retries,
+    SQA_SYSTEM_PROMPT,
+    compare_batch_planners,
     merge_csv_texts,
-    validate_strict_csv,
-    coerce_to_strict_csv,
+    merge_csv_rows,
+    make_row_repairer,
+    rows_to_csv,
+    record_output_usage,
+    prune_section_images,
+    summarize_image_dedup,
+    summarize_image_tokens,
+    summarize_image_payload,
+    summarize_batch_models,
+    select_batch_model,
+    summarize_prompt_compaction,
+    summarize_prompt_cache,
+    normalize_csv,
 )
 from backend.services.jobs import start_kb_ingest_job
 from backend.config import (
     DISABLE_VISION_DEFAULT,
     IMAGE_MAX_SIZE_DEFAULT,
     IMAGE_QUALITY_DEFAULT,
-    MAX_IMAGES_PER_BATCH_DEFAULT,
-    MAX_SECTION_CHARS_DEFAULT,
     BATCH_INFERENCE_CONCURRENCY_DEFAULT,
     IMAGE_DOWNLOAD_CONCURRENCY_DEFAULT,
+    IMAGE_DEDUP_DISTANCE_DEFAULT,
+    IMAGE_CROP_MARGINS_DEFAULT,
+    IMAGE_TOKEN_BUDGET_DEFAULT,
+    IMAGE_BYTE_BUDGET_DEFAULT,
+    BATCH_PLANNER_DEFAULT,
+    BATCH_LOCALITY_WINDOW_DEFAULT,
+    PROMPT_COMPACTION_DEFAULT,
+    TEXT_BATCH_ROUTING_DEFAULT,
+    CASE_DEDUP_THRESHOLD_DEFAULT,
+    ROW_REPAIR_DEFAULT,
 )
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
@@ -68,12 +90,37 @@ def generate_from_kb():
     user_text_model = user_config.get("text_model")
     user_vision_model = user_config.get("vision_model")
     user_disable_vision = user_config.get("disable_vision", DISABLE_VISION_DEFAULT)
-    user_max_images_per_batch = user_config.get("max_images_per_batch") or MAX_IMAGES_PER_BATCH_DEFAULT
+    # Defaults sized to the registered limits of the models in use
+    model_limits = batch_limits_for_models([user_vision_model, user_text_model])
+    user_max_images_per_batch = user_config.get("max_images_per_batch") or model_limits["max_images"]
     user_image_max_size = user_config.get("image_max_size") or IMAGE_MAX_SIZE_DEFAULT
     user_image_quality = user_config.get("image_quality") or IMAGE_QUALITY_DEFAULT
-    user_max_section_chars = user_config.get("max_section_chars") or MAX_SECTION_CHARS_DEFAULT
+    user_max_section_chars = user_config.get("max_section_chars") or model_limits["max_section_chars"]
     user_batch_infer_conc = user_config.get("batch_inference_concurrency") or BATCH_INFERENCE_CONCURRENCY_DEFAULT
     user_image_dl_conc = user_config.get("image_download_concurrency") or IMAGE_DOWNLOAD_CONCURRENCY_DEFAULT
+    user_image_dedup_distance = user_config.get("image_dedup_distance")
+    if user_image_dedup_distance is None:
+        user_image_dedup_distance = IMAGE_DEDUP_DISTANCE_DEFAULT
+    user_image_crop_margins = user_config.get("image_crop_margins", IMAGE_CROP_MARGINS_DEFAULT)
+    user_image_token_budget = user_config.get("image_token_budget") or IMAGE_TOKEN_BUDGET_DEFAULT
+    user_image_byte_budget = user_config.get("image_byte_budget") or IMAGE_BYTE_BUDGET_DEFAULT
+    user_prompt_compaction = user_config.get("prompt_compaction", PROMPT_COMPACTION_DEFAULT)
+    user_batch_planner = user_config.get("batch_planner") or BATCH_PLANNER_DEFAULT
+    user_locality_window = user_config.get("batch_locality_window") or BATCH_LOCALITY_WINDOW_DEFAULT
+    user_output_token_budget = user_config.get("output_token_budget")
+    if user_output_token_budget is None:
+        user_output_token_budget = model_limits["max_output_tokens"]
+    # Image-free batches go to the text model alone, so they are sized to its own limits
+    text_limits = batch_limits_for_models([user_text_model])
+    user_text_max_section_chars = user_config.get("max_section_chars") or text_limits["max_section_chars"]
+    user_text_output_token_budget = user_config.get("output_token_budget")
+    if user_text_output_token_budget is None:
+        user_text_output_token_budget = text_limits["max_output_tokens"]
+    user_route_text_batches = user_config.get("route_text_batches", TEXT_BATCH_ROUTING_DEFAULT)
+    user_case_dedup_threshold = user_config.get("case_dedup_threshold")
+    if user_case_dedup_threshold is None:
+        user_case_dedup_threshold = CASE_DEDUP_THRESHOLD_DEFAULT
+    user_row_repair = user_config.get("row_repair", ROW_REPAIR_DEFAULT)
 
     if not user_api_key or not user_text_model:
         return jsonify({"error": "缺少必要配置：请填写 API Key 和 文本模型名称。"}), 400
@@ -93,34 +140,44 @@ def generate_from_kb():
     if user_disable_vision or total_images == 0 or not user_vision_model:
         combined_text = "\n\n".join([f"## {s['title']}\n{s['text']}" for s in sections])
         final_prompt = prompt_full.format(prd_content=combined_text)
-        completion = user_client.chat.completions.create(
-            model=user_text_model,
-            messages=[
-                {"role": "system", "content": "你是一名资深SQA工程师。请严格基于以下PRD生成测试用例，使用简体中文，不得编造无关场景。"},
+        usage: dict = {}
+        ai_response = call_model_with_retries(
+            user_client,
+            user_text_model,
+            [
+                {"role": "system", "content": SQA_SYSTEM_PROMPT},
                 {"role": "user", "content": final_prompt},
             ],
-            max_tokens=4096,
+            usage=usage,
         )
-        ai_response = completion.choices[0].message.content
-        ok, _ = validate_strict_csv(ai_response)
-        if not ok:
-            repaired = coerce_to_strict_csv(ai_response)
-            ok2, _ = validate_strict_csv(repaired)
-            if ok2:
-                ai_response = repaired
+        ai_response, _, _ = normalize_csv(ai_response)
         meta = {
             "mode": "kb-text",
             "model_used": user_text_model,
             "use_vision": False,
+            "usage": usage,
             "doc_id": doc_id,
             "total_images": total_images,
             "total_sections": len(sections),
         }
         return jsonify({"test_cases": ai_response, "meta": meta})
 
-    # Vision path using preprocessed data URLs
+    # Vision path using preprocessed KB images (blob refs materialized per batch)
     from backend.services.parsing import create_batches_from_sections
-    batches = create_batches_from_sections(sections, user_max_images_per_batch, user_max_section_chars)
+    if int(user_image_dedup_distance) >= 0:
+        # KB images are already local: prune before planning so fewer batches are needed
+        prune_section_images(sections, int(user_image_dedup_distance))
+    batches = create_batches_from_sections(
+        sections,
+        user_max_images_per_batch,
+        user_max_section_chars,
+        planner=user_batch_planner,
+        locality_window=int(user_locality_window),
+        max_output_tokens=int(user_output_token_budget),
+        split_by_modality=bool(user_route_text_batches),
+        text_max_section_chars=int(user_text_max_section_chars),
+        text_max_output_tokens=int(user_text_output_token_budget),
+    )
     total_batches = len(batches)
 
     def run_one(i_b):
@@ -134,22 +191,31 @@ def generate_from_kb():
             image_max_size=user_image_max_size,
             image_quality=user_image_quality,
             image_download_concurrency=int(user_image_dl_conc),
+            image_dedup_distance=int(user_image_dedup_distance),
+            vision_model=user_vision_model,
+            image_crop_margins=bool(user_image_crop_margins),
+            image_token_budget=int(user_image_token_budget),
+            image_byte_budget=int(user_image_byte_budget),
+            compact_prompt=bool(user_prompt_compaction),
+        )
+        batch_model = select_batch_model(
+            b, user_vision_model, user_text_model, route_text_batches=bool(user_route_text_batches)
         )
         try:
-            return i, call_model_with_retries(user_client, user_vision_model, msgs)
+            return i, call_model_with_retries(user_client, batch_model, msgs, usage=b.setdefault("usage", {}))
         except Exception:
             # Degrade to text-only for this batch
             combined_text = "\n\n".join([f"## {s['title']}\n{s['text']}" for s in b["sections"]])
             final_prompt = prompt_full.format(prd_content=combined_text)
-            completion = user_client.chat.completions.create(
-                model=user_text_model,
-                messages=[
-                    {"role": "system", "content": "你是一名资深SQA工程师。请严格基于以下PRD生成测试用例，使用简体中文，不得编造无关场景。"},
+            return i, call_model_with_retries(
+                user_client,
+                user_text_model,
+                [
+                    {"role": "system", "content": SQA_SYSTEM_PROMPT},
                     {"role": "user", "content": final_prompt},
                 ],
-                max_tokens=4096,
+                usage=b.setdefault("usage", {}),
             )
-            return i, completion.choices[0].message.content
 
     if total_batches > 1 and int(user_batch_infer_conc) > 1:
         with ThreadPoolExecutor(max_workers=int(user_batch_infer_conc)) as ex:
@@ -165,13 +231,13 @@ def generate_from_kb():
             _, r = run_one((i, b))
             responses.append(r)
 
-    final_response = merge_csv_texts(responses)
-    ok, _ = validate_strict_csv(final_response)
-    if not ok:
-        repaired = coerce_to_strict_csv(final_response)
-        ok2, _ = validate_strict_csv(repaired)
-        if ok2:
-            final_response = repaired
+    output_usage = record_output_usage(batches, responses)
+    case_rows, csv_report = merge_csv_rows(
+        responses,
+        dedup_threshold=float(user_case_dedup_threshold),
+        repair=make_row_repairer(user_client, user_text_model, batches) if user_row_repair else None,
+    )
+    final_response = rows_to_csv(case_rows) if csv_report["ok"] else merge_csv_texts(responses)
 
     meta = {
         "mode": "kb-vision",
@@ -182,6 +248,31 @@ def generate_from_kb():
         "total_images": total_images,
         "total_sections": len(sections),
     }
+    if int(user_image_dedup_distance) >= 0:
+        meta["image_dedup"] = summarize_image_dedup(batches)
+    meta["image_tokens"] = summarize_image_tokens(batches)
+    meta["image_payload"] = summarize_image_payload(batches)
+    meta["prompt_compaction"] = summarize_prompt_compaction(batches)
+    meta["prompt_cache"] = summarize_prompt_cache(batches)
+    meta["csv_repairs"] = csv_report
+    meta["case_dedup"] = csv_report["dedup"]
+    meta["row_repair"] = csv_report["row_repair"]
+    meta["output_tokens"] = output_usage
+    meta["batches_by_model"] = summarize_batch_models(
+        batches, user_vision_model, user_text_model, route_text_batches=bool(user_route_text_batches)
+    )
+    meta["batch_plan"] = compare_batch_planners(
+        sections,
+        user_max_images_per_batch,
+        user_max_section_chars,
+        planner=user_batch_planner,
+        locality_window=int(user_locality_window),
+        max_output_tokens=int(user_output_token_budget),
+        split_by_modality=bool(user_route_text_batches),
+        text_max_section_chars=int(user_text_max_section_chars),
+        text_max_output_tokens=int(user_text_output_token_budget),
+        batches=batches,
+    )
     return jsonify({"test_cases": final_response, "meta": meta})
 
 
@@ -1,19 +1,47 @@
 """Service layer helpers for the Testcase Agent backend."""
 
-from .client_factory import create_openai_client, call_model_with_retries
-from .parsing import extract_images_from_markdown, parse_prd_sections, create_batches_from_sections
+from .client_factory import create_openai_client, call_model_with_retries, summarize_prompt_cache
+from .models import PromptTooLarge, get_model_capabilities, batch_limits_for_models
+from .parsing import (
+    extract_images_from_markdown,
+    parse_prd_sections,
+    create_batches_from_sections,
+    compare_batch_planners,
+    parse_prd_sections_cached,
+    plan_prd_batches,
+    parse_cache_stats,
+)
 from .postprocess import (
     sanitize_table_rows,
-    deduplicate_test_case_ids,
     merge_markdown_tables,
     merge_csv_texts,
-    validate_strict_csv,
-    coerce_to_strict_csv,
+    merge_csv_rows,
+    rows_to_csv,
+    renumber_case_ids,
+    normalize_csv,
+    iter_normalized_csv,
     EXPECTED_HEADER,
 )
-from .vision import download_and_process_image, build_vision_messages
+from .vision import (
+    download_and_encode_image,
+    download_and_process_image,
+    build_vision_messages,
+    prune_section_images,
+    summarize_image_dedup,
+    summarize_image_tokens,
+    summarize_image_payload,
+    start_image_prefetch,
+    select_batch_model,
+    summarize_batch_models,
+)
 from .kb import save_doc as kb_save_doc, load_doc as kb_load_doc, list_docs as kb_list_docs, create_doc_from_sections as kb_create_doc_from_sections, search_similar_sections as kb_search_similar_sections
-from .prompts import load_prompt_templates
+from .prompts import SQA_SYSTEM_PROMPT, load_prompt_templates
+from .compaction import compact_prd_text, estimate_text_tokens, summarize_prompt_compaction
+from .output_budget import predict_batch_output_tokens, record_output_usage, output_model
+from .dedup import dedupe_case_rows
+from .repair import make_row_repairer, repair_flagged_rows
+from .enhance import enhance_test_cases, apply_enhance_delta, parse_enhance_delta
+from .prd_diff import diff_prd_sections, summarize_prd_diff, generate_incremental_csv
 from .cache import make_key, get as cache_get, set as cache_set
 from .uploads import (
     save_testcases as uploads_save_testcases,
@@ -27,19 +55,53 @@ from .uploads import (
 __all__ = [
     "create_openai_client",
     "call_model_with_retries",
+    "summarize_prompt_cache",
+    "PromptTooLarge",
+    "get_model_capabilities",
+    "batch_limits_for_models",
     "extract_images_from_markdown",
     "parse_prd_sections",
     "create_batches_from_sections",
+    "compare_batch_planners",
+    "parse_prd_sections_cached",
+    "plan_prd_batches",
+    "parse_cache_stats",
     "sanitize_table_rows",
-    "deduplicate_test_case_ids",
     "merge_markdown_tables",
     "merge_csv_texts",
-    "validate_strict_csv",
-    "coerce_to_strict_csv",
+    "merge_csv_rows",
+    "rows_to_csv",
+    "renumber_case_ids",
+    "dedupe_case_rows",
+    "make_row_repairer",
+    "repair_flagged_rows",
+    "enhance_test_cases",
+    "apply_enhance_delta",
+    "parse_enhance_delta",
+    "normalize_csv",
+    "iter_normalized_csv",
     "EXPECTED_HEADER",
+    "download_and_encode_image",
     "download_and_process_image",
     "build_vision_messages",
+    "prune_section_images",
+    "summarize_image_dedup",
+    "summarize_image_tokens",
+    "summarize_image_payload",
+    "start_image_prefetch",
+    "select_batch_model",
+    "summarize_batch_models",
+    "SQA_SYSTEM_PROMPT",
     "load_prompt_templates",
+    "compact_prd_text",
+    "estimate_text_tokens",
+    "summarize_prompt_compaction",
+    "predict_batch_output_tokens",
+    "record_output_usage",
+    "output_model",
+    "diff_prd_sections",
+    "summarize_prd_diff",
+    "generate_incremental_csv",
     "make_key",
     "cache_get",
     "cache_set",
@@ -0,0 +1,263 @@
+"""Approximate nearest-neighbour search (IVF-flat) and on-disk index storage.
+
+``IvfFlat`` clusters the normalized section embeddings with spherical
+k-means; a query scores only the rows of the ``nprobe`` clusters whose
+centroids are closest, trading recall for speed (``nprobe = nlist`` is
+exact). Lists hold row numbers into the caller's vector matrix, so vectors
+are stored once.
+
+``IndexStore`` persists the index under ``data/kb/index/`` as append-only
+segments (raw float32 vectors, int32 cluster assignments, JSON-lines
+metadata with ``{"deleted": doc_id}`` tombstones inline so replay keeps the
+order of deletes and re-adds) plus the centroids and a manifest, so
+a worker start reads files instead of reloading every document and
+re-training, and ingests append instead of rewriting. Writers hold an
+exclusive file lock; a full rewrite (after re-training or compaction) bumps
+the manifest generation so other workers reload.
+
+Both need NumPy.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+try:
+    import numpy as np
+except Exception:  # noqa: BLE001 - optional dependency
+    np = None
+
+try:
+    import fcntl
+except Exception:  # noqa: BLE001 - not available on Windows
+    fcntl = None
+
+
+# Rows assigned per matrix product while training/assigning, to bound memory
+_ASSIGN_BLOCK = 65_536
+# Consolidate a cluster's appended chunks once it has this many
+_MAX_LIST_CHUNKS = 16
+_MANIFEST_VERSION = 1
+
+
+class IvfFlat:
+    """Inverted-file index over row numbers of an external normalized matrix."""
+
+    def __init__(self, nlist: int = 0, nprobe: int = 16, iterations: int = 8, seed: int = 0) -> None:
+        self.nlist = int(nlist)  # 0 = about sqrt(rows) at training time
+        self.nprobe = max(1, int(nprobe))
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids: Any = None
+        self.trained_rows = 0
+        self._lists: List[List[Any]] = []
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def train(self, vectors: Any) -> None:
+        """Fit centroids on (a sample of) ``vectors`` with spherical k-means."""
+
+        n = vectors.shape[0]
+        nlist = self.nlist or max(1, int(round(n ** 0.5)))
+        nlist = min(nlist, n)
+        rng = np.random.default_rng(self.seed)
+        sample = vectors[rng.choice(n, size=min(n, nlist * 40), replace=False)] if n > nlist * 40 else vectors
+        centroids = sample[rng.choice(sample.shape[0], size=nlist, replace=False)].copy()
+        for _ in range(self.iterations):
+            labels = _nearest(sample, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            norms = np.linalg.norm(sums, axis=1)
+            empty = norms == 0
+            # Re-seed empty clusters from random sample rows
+            if empty.any():
+                sums[empty] = sample[rng.choice(sample.shape[0], size=int(empty.sum()), replace=False)]
+                norms[empty] = 1.0
+            centroids = (sums / norms[:, None]).astype(np.float32)
+        self.centroids = centroids
+        self.trained_rows = n
+        self.reset_lists()
+
+    def load(self, centroids: Any, trained_rows: int) -> None:
+        """Adopt persisted (or, with ``None``, drop) centroids; lists start empty."""
+
+        self.centroids = centroids
+        self.trained_rows = trained_rows if centroids is not None else 0
+        self.reset_lists()
+
+    def reset_lists(self) -> None:
+        self._lists = [[] for _ in range(len(self.centroids))] if self.centroids is not None else []
+
+    def assign(self, vectors: Any) -> Any:
+        """Nearest centroid of each row (int32)."""
+
+        return _nearest(vectors, self.centroids)
+
+    def add(self, rows: Any, labels: Any) -> None:
+        """Append ``rows`` (row numbers) to the clusters given by ``labels``."""
+
+        if not len(rows):
+            return
+        order = np.argsort(labels, kind="stable")
+        rows = np.asarray(rows, dtype=np.int64)[order]
+        labels = np.asarray(labels)[order]
+        bounds = np.flatnonzero(np.diff(labels)) + 1
+        for part_rows, part_labels in zip(np.split(rows, bounds), np.split(labels, bounds)):
+            chunks = self._lists[int(part_labels[0])]
+            chunks.append(part_rows)
+            if len(chunks) > _MAX_LIST_CHUNKS:
+                chunks[:] = [np.concatenate(chunks)]
+
+    def candidates(self, query: Any, nprobe: Optional[int] = None) -> Any:
+        """Row numbers in the ``nprobe`` clusters closest to ``query``."""
+
+        probe = min(nprobe or self.nprobe, len(self._lists))
+        scores = self.centroids @ query
+        nearest = np.argpartition(-scores, probe - 1)[:probe] if probe < len(scores) else range(len(scores))
+        chunks = [c for i in nearest for c in self._lists[int(i)]]
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=np.int64)
+
+
+def _nearest(vectors: Any, centroids: Any) -> Any:
+    labels = np.empty(vectors.shape[0], dtype=np.int32)
+    for start in range(0, vectors.shape[0], _ASSIGN_BLOCK):
+        block = vectors[start:start + _ASSIGN_BLOCK]
+        labels[start:start + block.shape[0]] = np.argmax(block @ centroids.T, axis=1)
+    return labels
+
+
+class IndexStore:
+    """Append-only persistence for the KB vector index in one directory."""
+
+    def __init__(self, root: Path) -> None:
+        self.root = Path(root)
+        self._manifest = self.root / "manifest.json"
+        self._vectors = self.root / "vectors.f32"
+        self._meta = self.root / "meta.jsonl"
+        self._assign = self.root / "assign.i32"
+        self._centroids = self.root / "centroids.npy"
+        self._lock_path = self.root / "lock"
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self._lock_path.open("a") as fh:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+    def manifest(self) -> Optional[Dict[str, Any]]:
+        try:
+            data = json.loads(self._manifest.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        return data if data.get("version") == _MANIFEST_VERSION else None
+
+    def offsets(self) -> Dict[str, int]:
+        """Current byte sizes of the append-only segments."""
+
+        return {
+            "vectors": _size(self._vectors),
+            "meta": _size(self._meta),
+            "assign": _size(self._assign),
+        }
+
+    def read(self, since: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+        """Segments appended after ``since`` (all of them when ``None``).
+
+        Returns vectors (rows x dim float32), assign (int32) and records
+        (one meta per row, interleaved with ``{"deleted": doc_id}``), plus the
+        new ``offsets``. Call under ``lock``.
+        """
+
+        manifest = self.manifest() or {}
+        dim = int(manifest.get("dim") or 0)
+        since = since or {"vectors": 0, "meta": 0, "assign": 0}
+        offsets = self.offsets()
+        raw = _read_from(self._vectors, since["vectors"], offsets["vectors"])
+        vectors = np.frombuffer(raw, dtype=np.float32).reshape(-1, dim) if dim else np.empty((0, 0), np.float32)
+        records = [json.loads(line) for line in _read_from(self._meta, since["meta"], offsets["meta"]).decode("utf-8").splitlines() if line]
+        assign = np.frombuffer(_read_from(self._assign, since["assign"], offsets["assign"]), dtype=np.int32)
+        return {"vectors": vectors, "records": records, "assign": assign, "offsets": offsets}
+
+    def centroids(self) -> Any:
+        try:
+            return np.load(self._centroids)
+        except (OSError, ValueError):
+            return None
+
+    def append(self, vectors: Any, metas: List[Dict[str, Any]], assign: Any) -> None:
+        """Append rows; call under ``lock`` after syncing with ``read``."""
+
+        with self._vectors.open("ab") as fh:
+            fh.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        with self._meta.open("ab") as fh:
+            fh.write("".join(json.dumps(m, ensure_ascii=False) + "\n" for m in metas).encode("utf-8"))
+        with self._assign.open("ab") as fh:
+            fh.write(np.asarray(assign, dtype=np.int32).tobytes())
+
+    def append_tombstones(self, doc_ids: List[str]) -> None:
+        with self._meta.open("ab") as fh:
+            fh.write("".join(json.dumps({"deleted": d}, ensure_ascii=False) + "\n" for d in doc_ids).encode("utf-8"))
+
+    def rewrite(
+        self,
+        dim: int,
+        vectors: Any,
+        metas: List[Dict[str, Any]],
+        assign: Any,
+        centroids: Any,
+        extra: Dict[str, Any],
+    ) -> int:
+        """Replace all segments (no tombstones) and bump the generation; return it."""
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        generation = int((self.manifest() or {}).get("generation", 0)) + 1
+        tmp = {p: p.with_suffix(p.suffix + ".tmp") for p in (self._vectors, self._meta, self._assign)}
+        tmp[self._vectors].write_bytes(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+        tmp[self._meta].write_bytes("".join(json.dumps(m, ensure_ascii=False) + "\n" for m in metas).encode("utf-8"))
+        tmp[self._assign].write_bytes(np.asarray(assign, dtype=np.int32).tobytes())
+        for final, path in tmp.items():
+            os.replace(path, final)
+        if centroids is not None:
+            with self._centroids.open("wb") as fh:
+                np.save(fh, centroids)
+        elif self._centroids.exists():
+            self._centroids.unlink()
+        manifest = dict(extra, version=_MANIFEST_VERSION, generation=generation, dim=dim)
+        self._manifest.write_text(json.dumps(manifest), encoding="utf-8")
+        return generation
+
+    def set_dim(self, dim: int) -> None:
+        """Start an empty store for ``dim``-sized vectors if none exists."""
+
+        if self.manifest() is None:
+            self.rewrite(dim, np.empty((0, dim), np.float32), [], np.empty(0, np.int32), None, {})
+
+
+def _size(path: Path) -> int:
+    try:
+        return path.stat().st_size
+    except OSError:
+        return 0
+
+
+def _read_from(path: Path, start: int, end: int) -> bytes:
+    if end <= start:
+        return b""
+    with path.open("rb") as fh:
+        fh.seek(start)
+        return fh.read(end - start)
+
+
+__all__ = ["IvfFlat", "IndexStore"]
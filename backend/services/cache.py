@@ -43,6 +43,12 @@ def make_key(payload: Dict[str, Any]) -> str:
             k: payload.get("config", {}).get(k)
             for k in sorted((payload.get("config", {}) or {}).keys())
         },
+        # Other inputs (e.g. enhance_of, enhance_group) must separate keys too
+        "extra": {
+            k: payload[k]
+            for k in sorted(payload.keys())
+            if k not in ("old_prd", "new_prd", "config")
+        },
     })
     return hashlib.sha256(key_src.encode("utf-8")).hexdigest()
 
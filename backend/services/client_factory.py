@@ -14,6 +14,8 @@ from backend.config import (
 	MIN_CALL_INTERVAL_MS_DEFAULT,
 )
 
+from .models import plan_request, record_model_throughput
+
 
 def create_openai_client(api_key: str, base_url: str | None = None) -> OpenAI:
 	"""Instantiate an OpenAI-compatible client with optional base URL."""
@@ -29,19 +31,66 @@ _LAST_CALL_TS = 0.0
 _MIN_INTERVAL_S = max(0.0, float(MIN_CALL_INTERVAL_MS_DEFAULT) / 1000.0)
 
 
+def usage_counts(completion: Any) -> Dict[str, int]:
+	"""Prompt, cached-prompt and completion tokens from a completion's ``usage``.
+
+	Cached tokens come from ``prompt_tokens_details.cached_tokens`` (OpenAI and
+	compatible APIs) or ``prompt_cache_hit_tokens`` (DeepSeek).
+	"""
+
+	raw = getattr(completion, "usage", None)
+	details = getattr(raw, "prompt_tokens_details", None)
+	cached = getattr(details, "cached_tokens", None)
+	if cached is None:
+		cached = getattr(raw, "prompt_cache_hit_tokens", None)
+	return {
+		"prompt_tokens": int(getattr(raw, "prompt_tokens", 0) or 0),
+		"cached_tokens": int(cached or 0),
+		"completion_tokens": int(getattr(raw, "completion_tokens", 0) or 0),
+	}
+
+
+def summarize_prompt_cache(batches: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+	"""Collect per-batch provider usage (``batch["usage"]``) for job meta."""
+
+	per_batch = [
+		{k: int((b.get("usage") or {}).get(k, 0)) for k in ("prompt_tokens", "cached_tokens", "completion_tokens")}
+		for b in batches
+	]
+	prompt = sum(p["prompt_tokens"] for p in per_batch)
+	cached = sum(p["cached_tokens"] for p in per_batch)
+	return {
+		"prompt_tokens": prompt,
+		"cached_tokens": cached,
+		"hit_ratio": round(cached / prompt, 3) if prompt else 0.0,
+		"per_batch": per_batch,
+	}
+
+
 def call_model_with_retries(
 	client_instance: OpenAI,
 	model_name: str,
 	messages: Iterable[Dict[str, Any]],
 	*,
-	max_tokens: int = 4096,
+	max_tokens: int | None = None,
 	max_retries: int = 2,
 	backoff_base: float = 0.6,
 	timeout: Optional[float] = None,
 	extra_kwargs: Optional[Dict[str, Any]] = None,
+	usage: Optional[Dict[str, int]] = None,
 ) -> str:
-	"""Call chat.completions with exponential backoff and return message content."""
-
+	"""Call chat.completions with exponential backoff and return message content.
+
+	``max_tokens`` (default: the model's registered output limit) is clamped to
+	that limit and the context left after the prompt; prompts that cannot fit (or images sent to a
+	text-only model) raise ``PromptTooLarge`` up front instead of being retried.
+	When ``usage`` is given, prompt/cached/completion token counts reported by
+	the provider are added to it, plus ``truncated`` for replies that stopped
+	at ``max_tokens`` (``finish_reason == "length"``).
+	"""
+
+	messages = list(messages)
+	max_tokens = plan_request(model_name, messages, max_tokens)
 	attempt = 0
 	delay = backoff_base
 	last_err: Exception | None = None
@@ -63,7 +112,7 @@ def call_model_with_retries(
 					api = api.with_options(timeout=timeout)
 				kwargs: Dict[str, Any] = dict(
 					model=model_name,
-					messages=list(messages),
+					messages=messages,
 					max_tokens=max_tokens,
 				)
 				if timeout is not None:
@@ -71,7 +120,16 @@ def call_model_with_retries(
 					kwargs["request_timeout"] = timeout
 				if extra_kwargs:
 					kwargs.update(extra_kwargs)
+				started = monotonic()
 				completion = api.create(**kwargs)
+				elapsed = monotonic() - started
+			counts = usage_counts(completion)
+			record_model_throughput(model_name, counts["completion_tokens"], elapsed)
+			if usage is not None:
+				for key, value in counts.items():
+					usage[key] = usage.get(key, 0) + value
+				finish_reason = getattr(completion.choices[0], "finish_reason", None)
+				usage["truncated"] = usage.get("truncated", 0) + int(finish_reason == "length")
 			return completion.choices[0].message.content
 		except Exception as exc:  # noqa: BLE001 - bubble up after retries
 			last_err = exc
@@ -85,4 +143,4 @@ def call_model_with_retries(
 	raise RuntimeError(f"模型调用在重试后仍失败: {last_err}")
 
 
-__all__ = ["create_openai_client", "call_model_with_retries"]
+__all__ = ["create_openai_client", "call_model_with_retries", "usage_counts", "summarize_prompt_cache"]
@@ -0,0 +1,124 @@
+"""Prompt compaction: strip image markup and markdown noise from PRD text."""
+
+from __future__ import annotations
+
+import re
+from typing import Any, Dict, List, Mapping
+
+
+_HTML_COMMENT_PATTERN = re.compile(r"<!--.*?-->", re.DOTALL)
+# Same shape parse_prd_sections uses to collect images, plus the alt text
+_IMAGE_TAG_PATTERN = re.compile(r"!\[(.*?)\]\((.*?)\)")
+_INLINE_SPACE_PATTERN = re.compile(r"[ \t\u3000]{2,}")
+_TABLE_DELIMITER_CELL = re.compile(r"^:?-+:?$")
+_FENCE_PATTERN = re.compile(r"^\s*(```|~~~)")
+_CJK_PATTERN = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+_MAX_ALT_CHARS = 40
+
+
+def estimate_text_tokens(text: str) -> int:
+	"""Rough token count: one per CJK character, one per ~4 other characters."""
+
+	if not text:
+		return 0
+	cjk = len(_CJK_PATTERN.findall(text))
+	return cjk + (len(text) - cjk + 3) // 4
+
+
+def _image_placeholder(alt: str, url: str, image_index: Mapping[str, int] | None) -> str:
+	alt = " ".join(alt.split())
+	if len(alt) > _MAX_ALT_CHARS:
+		alt = alt[:_MAX_ALT_CHARS] + "…"
+	n = (image_index or {}).get(url.strip())
+	label = f"图{n}" if n else "图片"
+	return f"[{label}: {alt}]" if alt else f"[{label}]"
+
+
+def count_numbered_images(text: str, image_index: Mapping[str, int] | None) -> int:
+	"""How many image tags in ``text`` ``compact_prd_text`` would number (``[图N]``)."""
+
+	if not text or not image_index:
+		return 0
+	return sum(1 for m in _IMAGE_TAG_PATTERN.finditer(text) if image_index.get(m.group(2).strip()))
+
+
+def _compact_table_row(line: str) -> str:
+	stripped = line.strip()
+	cells = [c.strip() for c in stripped.strip("|").split("|")]
+	if cells and all(_TABLE_DELIMITER_CELL.match(c) for c in cells):
+		cells = [
+			(":" if c.startswith(":") else "") + "---" + (":" if c.endswith(":") and len(c) > 1 else "")
+			for c in cells
+		]
+	return "|" + "|".join(cells) + "|"
+
+
+def compact_prd_text(text: str, image_index: Mapping[str, int] | None = None) -> str:
+	"""Return ``text`` with fewer tokens and the same meaning for the model.
+
+	- ``![alt](url)`` tags (long signed URLs, inline base64) become ``[图N: alt]``
+	  where N is the 1-based position of that image among the attachments
+	  (``image_index`` maps URL -> N); images that are not attached become ``[图片: alt]``.
+	- HTML comments are dropped.
+	- Table cell padding is removed and delimiter rows shortened.
+	- Runs of spaces are collapsed, trailing spaces stripped and consecutive
+	  blank lines folded into one. Fenced code blocks are left untouched.
+	"""
+
+	if not text:
+		return text
+	text = _HTML_COMMENT_PATTERN.sub("", text)
+	text = _IMAGE_TAG_PATTERN.sub(lambda m: _image_placeholder(m.group(1), m.group(2), image_index), text)
+
+	out: List[str] = []
+	in_fence = False
+	blank = False
+	for line in text.split("\n"):
+		if _FENCE_PATTERN.match(line):
+			in_fence = not in_fence
+			out.append(line.rstrip())
+			blank = False
+			continue
+		if in_fence:
+			out.append(line)
+			continue
+		stripped = line.strip()
+		if not stripped:
+			if not blank and out:
+				out.append("")
+			blank = True
+			continue
+		blank = False
+		if stripped.startswith("|"):
+			out.append(_compact_table_row(line))
+			continue
+		indent = len(line) - len(line.lstrip(" \t"))
+		out.append(line[:indent] + _INLINE_SPACE_PATTERN.sub(" ", stripped))
+	while out and out[-1] == "":
+		out.pop()
+	return "\n".join(out)
+
+
+def compaction_stats(raw_text: str, compact_text: str) -> Dict[str, int]:
+	raw = estimate_text_tokens(raw_text)
+	compact = estimate_text_tokens(compact_text)
+	return {"raw": raw, "compact": compact, "saved": raw - compact}
+
+
+def summarize_prompt_compaction(batches: List[Dict]) -> Dict[str, Any]:
+	"""Collect per-batch text token savings (set by build_vision_messages) for job meta."""
+
+	per_batch = [b.get("prompt_tokens") or {"raw": 0, "compact": 0, "saved": 0} for b in batches]
+	raw = sum(p["raw"] for p in per_batch)
+	compact = sum(p["compact"] for p in per_batch)
+	return {"raw": raw, "compact": compact, "saved": raw - compact, "per_batch": per_batch}
+
+
+__all__ = [
+	"estimate_text_tokens",
+	"compact_prd_text",
+	"count_numbered_images",
+	"compaction_stats",
+	"summarize_prompt_compaction",
+]
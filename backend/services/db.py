@@ -9,7 +9,8 @@ from __future__ import annotations
 import os
 from typing import Any, Dict, List, Optional
 
-from sqlalchemy import JSON, Integer, String, Text, ForeignKey, create_engine, select, func
+from sqlalchemy import JSON, Integer, LargeBinary, String, Text, ForeignKey, create_engine, select, func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, sessionmaker, Session
 
 
@@ -46,6 +47,16 @@ class KbSection(Base):
     doc: Mapped[KbDoc] = relationship("KbDoc", back_populates="sections")
 
 
+class KbImage(Base):
+    """Binary KB image stored once per content hash (bytea on Postgres)."""
+
+    __tablename__ = "kb_images"
+
+    sha256: Mapped[str] = mapped_column(String(64), primary_key=True)
+    mime: Mapped[str] = mapped_column(String(32), nullable=False, default="image/jpeg")
+    data: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+
+
 # Upload buckets
 class UploadedTestCases(Base):
     __tablename__ = "uploaded_testcases"
@@ -110,6 +121,14 @@ def create_doc_from_sections(name: str, created_at: int, sections: List[Dict[str
     return doc_id
 
 
+def list_doc_ids() -> List[str]:
+    if not is_enabled():
+        raise RuntimeError("DATABASE_URL not configured")
+    assert _Session is not None
+    with _Session() as s:
+        return list(s.execute(select(KbDoc.doc_id)).scalars().all())
+
+
 def list_docs() -> List[Dict[str, Any]]:
     if not is_enabled():
         raise RuntimeError("DATABASE_URL not configured")
@@ -161,6 +180,37 @@ def load_doc(doc_id: str) -> Optional[Dict[str, Any]]:
         }
 
 
+def put_kb_image(sha256: str, mime: str, data: bytes) -> None:
+    """Insert an image blob unless one with the same hash already exists.
+
+    Only the duplicate-key race is tolerated; any other failure propagates so
+    the ingest fails instead of keeping a ref to a blob that was never stored.
+    """
+    if not is_enabled():
+        raise RuntimeError("DATABASE_URL not configured")
+    assert _Session is not None
+    with _Session() as s:
+        if s.get(KbImage, sha256) is not None:
+            return
+        s.add(KbImage(sha256=sha256, mime=mime, data=data))
+        try:
+            s.commit()
+        except IntegrityError:
+            # Concurrent ingest stored the same content first
+            s.rollback()
+
+
+def get_kb_image(sha256: str) -> Optional[tuple]:
+    if not is_enabled():
+        raise RuntimeError("DATABASE_URL not configured")
+    assert _Session is not None
+    with _Session() as s:
+        img = s.get(KbImage, sha256)
+        if not img:
+            return None
+        return bytes(img.data), img.mime
+
+
 # ---------- Uploads: Test cases ----------
 def save_uploaded_testcases(name: str, created_at: int, content: str, content_type: Optional[str], embedding: Optional[List[float]] = None, *, id: Optional[str] = None) -> str:
     if not is_enabled():
@@ -0,0 +1,169 @@
+"""Near-duplicate test case removal with MinHash signatures and LSH banding.
+
+Rows are compared on 测试项 + 操作步骤 + 预期结果: the text is normalized
+(case, whitespace, punctuation and step numbering dropped), split into
+character 3-grams and summarized by a one-permutation MinHash signature.
+LSH bands bucket rows that probably match, so only bucket members are
+compared and the whole pass stays roughly linear in the number of rows.
+The stage is off by default (``CASE_DEDUP_THRESHOLD=0``).
+"""
+
+from __future__ import annotations
+
+import operator
+import random
+import re
+import zlib
+from typing import Any, Dict, List, Set, Tuple
+
+from backend.config import CASE_DEDUP_THRESHOLD_DEFAULT
+
+
+# Column positions in postprocess.EXPECTED_HEADER
+_ID_COLUMN = 0
+_TITLE_COLUMN = 3
+_EXPECTED_COLUMN = 6
+_FIELDS = (3, 5, 6)  # 测试项, 操作步骤, 预期结果
+
+_SHINGLE = 3
+# 64 one-permutation bins in 8 bands of 8: pairs above ~0.77 Jaccard collide in some band
+_BIN_BITS = 6
+_BINS = 1 << _BIN_BITS
+_BANDS = 8
+_ROWS_PER_BAND = _BINS // _BANDS
+
+# Per-bin probe order for densifying empty bins (fixed, so signatures are reproducible)
+_PROBES = [random.Random(b).sample(range(_BINS), _BINS) for b in range(_BINS)]
+
+_STEP_NUMBER_PATTERN = re.compile(r"(?:^|(?<=[；;\s]))\d+[.、)）]")
+_NOISE_PATTERN = re.compile(r"[\W_]+")
+_NUMBER_PATTERN = re.compile(r"\d+(?:\.\d+)?")
+
+
+def _row_text(row: List[str]) -> str:
+	text = "\u0001".join(row[i] if i < len(row) else "" for i in _FIELDS)
+	return _STEP_NUMBER_PATTERN.sub(" ", text.lower())
+
+
+def _signature(text: str) -> Tuple[int, ...]:
+	"""One-permutation MinHash over character shingles, densified.
+
+	Short texts leave bins empty; each empty bin copies the first filled bin in
+	its own fixed probe order (offset by its index), so identical shingle sets
+	give identical signatures and a small change to the set only moves the
+	empty bins whose donor changed.
+	"""
+
+	data = _NOISE_PATTERN.sub("", text).encode("utf-32-le")
+	width = 4 * _SHINGLE
+	hashes = set(map(zlib.crc32, (data[i:i + width] for i in range(0, max(len(data) - width, 0) + 4, 4))))
+	mask = _BINS - 1
+	# Descending order: the last write to each bin is its minimum
+	mins = {h & mask: h >> _BIN_BITS for h in sorted(hashes, reverse=True)}
+	if len(mins) == _BINS:
+		return tuple([mins[b] for b in range(_BINS)])
+	if not mins:
+		return (0,) * _BINS
+	sig = []
+	for b in range(_BINS):
+		v = mins.get(b)
+		if v is None:
+			# First filled bin in this bin's fixed probe order
+			for p in _PROBES[b]:
+				if p in mins:
+					v = mins[p] + ((b + 1) << 32)
+					break
+		sig.append(v)
+	return tuple(sig)
+
+
+def _similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+	return sum(map(operator.eq, a, b)) / _BINS
+
+
+def _numbers(text: str) -> Tuple[str, ...]:
+	return tuple(sorted(_NUMBER_PATTERN.findall(text)))
+
+
+def _expected_key(row: List[str]) -> str:
+	text = row[_EXPECTED_COLUMN] if len(row) > _EXPECTED_COLUMN else ""
+	return _NOISE_PATTERN.sub("", text.lower())
+
+
+def dedupe_case_rows(
+	rows: List[List[str]],
+	threshold: float = CASE_DEDUP_THRESHOLD_DEFAULT,
+) -> Tuple[List[List[str]], List[Dict[str, Any]]]:
+	"""Drop near-duplicate rows, keeping the first row of each cluster.
+
+	Two rows are duplicates when their estimated Jaccard similarity is at least
+	``threshold``, their 预期结果 match once case, whitespace and punctuation
+	are ignored, and they mention the same numbers. The last two guard cases a
+	shingle estimate cannot tell apart: one key noun of difference (显示用户昵称
+	vs 显示用户头像) or boundary values (20 vs 21 characters). A row joins a
+	cluster only if it is a duplicate of every member, so the result does not
+	hinge on which row an LSH bucket saw first. ``threshold <= 0`` disables the
+	stage. Returns ``(kept_rows, removed)``; each removed entry records the
+	row's ID and 测试项, the index of its representative in ``kept_rows`` and
+	the estimated similarity to it.
+	"""
+
+	if threshold <= 0 or len(rows) < 2:
+		return rows, []
+
+	texts = [_row_text(row) for row in rows]
+	sigs = [_signature(text) for text in texts]
+	numbers = [_numbers(text) for text in texts]
+	expected = [_expected_key(row) for row in rows]
+
+	def duplicate(i: int, j: int) -> bool:
+		return (
+			numbers[i] == numbers[j]
+			and expected[i] == expected[j]
+			and _similarity(sigs[i], sigs[j]) >= threshold
+		)
+
+	# Earlier rows sharing an LSH band with each row
+	candidates: Dict[int, Set[int]] = {}
+	for band in range(_BANDS):
+		lo = band * _ROWS_PER_BAND
+		hi = lo + _ROWS_PER_BAND
+		buckets: Dict[Tuple[int, ...], List[int]] = {}
+		for i, sig in enumerate(sigs):
+			members = buckets.setdefault(sig[lo:hi], [])
+			if members:
+				candidates.setdefault(i, set()).update(members)
+			members.append(i)
+
+	# Cluster root (its earliest row) per row, and the members of each cluster
+	root_of = list(range(len(rows)))
+	clusters: Dict[int, List[int]] = {}
+	for i in range(len(rows)):
+		roots = sorted({root_of[j] for j in candidates.get(i, ())})
+		for root in roots:
+			if all(duplicate(i, m) for m in clusters.get(root, [root])):
+				root_of[i] = root
+				clusters.setdefault(root, [root]).append(i)
+				break
+
+	kept: List[List[str]] = []
+	kept_index: Dict[int, int] = {}
+	removed: List[Dict[str, Any]] = []
+	for i, row in enumerate(rows):
+		root = root_of[i]
+		if root == i:
+			kept_index[i] = len(kept)
+			kept.append(row)
+			continue
+		removed.append(
+			{
+				"id": row[_ID_COLUMN],
+				"title": row[_TITLE_COLUMN] if len(row) > _TITLE_COLUMN else "",
+				"kept_index": kept_index[root],
+				"similarity": round(_similarity(sigs[root], sigs[i]), 3),
+			}
+		)
+	return kept, removed
+
+
+__all__ = ["dedupe_case_rows"]
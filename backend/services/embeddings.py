@@ -6,6 +6,8 @@ Reads from environment: EMBEDDING_API_KEY, EMBEDDING_BASE_URL, EMBEDDING_MODEL.
 
 from __future__ import annotations
 
+import math
+import operator
 import os
 from typing import List, Optional
 
@@ -53,11 +55,14 @@ def embed_texts(texts: List[str]) -> List[List[float]]:
 
 
 def cosine_similarity(a: List[float], b: List[float]) -> float:
-    """Compute cosine similarity between two vectors."""
-    import math
-    dot = sum(x * y for x, y in zip(a, b))
-    norm_a = math.sqrt(sum(x * x for x in a))
-    norm_b = math.sqrt(sum(x * x for x in b))
+    """Compute cosine similarity between two vectors.
+
+    For searching many sections use the KB vector index (vector_index), which
+    normalizes each embedding once.
+    """
+    dot = sum(map(operator.mul, a, b))
+    norm_a = math.sqrt(sum(map(operator.mul, a, a)))
+    norm_b = math.sqrt(sum(map(operator.mul, b, b)))
     if norm_a == 0 or norm_b == 0:
         return 0.0
     return dot / (norm_a * norm_b)
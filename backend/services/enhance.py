@@ -0,0 +1,425 @@
+"""Test case enhancement: full rewrite or delta-only with local merge.
+
+In ``delta`` mode the model sees the existing suite but returns only the rows
+it adds or changes, each ``用例ID`` prefixed with ``[新增]`` or ``[修改]``.
+The original CSV is parsed locally and the delta is merged into it, so the
+output tokens scale with the improvement rather than with the suite.
+Large suites are enhanced in chunks grouped by 模块/子模块 and run in
+parallel. ``full`` mode keeps the original behaviour of asking for the
+complete CSV in one call.
+"""
+
+from __future__ import annotations
+
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from backend.config import ENHANCE_CHUNK_TOKENS_DEFAULT, ENHANCE_MODE_DEFAULT
+
+from .cache import get as cache_get, make_key, set as cache_set
+from .client_factory import call_model_with_retries
+from .compaction import estimate_text_tokens
+from .models import get_model_capabilities
+from .postprocess import EXPECTED_HEADER, iter_normalized_csv, normalize_csv, rows_to_csv
+
+
+ADDED_MARKER = "[新增]"
+MODIFIED_MARKER = "[修改]"
+
+_MARKER_PATTERN = re.compile(r"^\s*[\[【]\s*(新增|修改)\s*[\]】]\s*")
+_CASE_ID_PATTERN = re.compile(r"^(.*?)-?(\d+)$")
+
+# Room for the enhance instructions around a chunk of cases
+_PROMPT_OVERHEAD_TOKENS = 800
+
+_ENHANCE_SYSTEM_PROMPT = "你是一位经验丰富的测试工程师，擅长设计全面的测试用例。"
+
+_ENHANCE_GOALS = """【完善目标】
+1. 用户场景补充：添加更多正向流程、边界条件
+2. 异常场景补充：错误处理、异常输入、网络异常等
+3. 测试步骤完善：步骤清晰、可执行
+4. 预期结果优化：明确具体、可验证
+5. 覆盖度提升：识别遗漏并补充"""
+
+_CSV_RULES = """- 仅输出 CSV 文本，不要输出 Markdown、代码块或其它说明。
+- 第一行必须是表头，列为：用例ID,模块,子模块,测试项,前置条件,操作步骤,预期结果,用例类型
+- 使用英文逗号分隔；如单元格内含逗号或换行，请用双引号包裹，并将内部双引号转义为两个双引号。"""
+
+_FULL_PROMPT = """你是一位专业的测试工程师。请分析以下测试用例，并进行完善和补充：
+
+【现有测试用例（原文）】
+{test_cases}
+
+""" + _ENHANCE_GOALS + """
+
+【输出格式（严格）】
+""" + _CSV_RULES + """
+- 新增的测试用例在“用例ID”列以“[新增] ”前缀标注，例如：[新增] TC-登录-密码错误-0007
+
+请直接输出完善后的完整 CSV 内容。"""
+
+_DELTA_PROMPT = """你是一位专业的测试工程师。请分析以下测试用例，并进行完善和补充：
+
+【现有测试用例】
+{test_cases}
+
+""" + _ENHANCE_GOALS + """
+
+【输出格式（严格）】
+""" + _CSV_RULES + """
+- 只输出新增或修改的测试用例，未改动的用例不要输出。
+- 新增用例的“用例ID”以“[新增] ”为前缀，编号接续同模块已有编号，例如：[新增] TC-登录-密码错误-0007
+- 修改用例的“用例ID”以“[修改] ”为前缀并保留原编号，输出修改后的整行，例如：[修改] TC-登录-密码错误-0003
+
+请直接输出新增与修改的 CSV 行。"""
+
+
+def _strip_marker(case_id: str) -> str:
+	match = _MARKER_PATTERN.match(case_id)
+	return case_id[match.end():].strip() if match else case_id
+
+
+def parse_case_table(text: str) -> List[List[str]] | None:
+	"""Parse test cases given as CSV or as a Markdown table into 8-column rows.
+
+	``[新增]``/``[修改]`` prefixes left by an earlier enhance run are stripped
+	from the IDs. Returns ``None`` when neither form has the expected header.
+	"""
+
+	report: Dict[str, Any] = {}
+	rows = [row for row, _status in iter_normalized_csv(text, report)]
+	if report["ok"]:
+		for row in rows:
+			row[0] = _strip_marker(row[0])
+		return rows
+	# Spreadsheet uploads arrive as Markdown tables from the frontend
+	lines = [ln.strip() for ln in (text or "").splitlines() if ln.strip().startswith("|")]
+	table = [[c.strip() for c in ln.strip("|").split("|")] for ln in lines]
+	if not table or table[0][: len(EXPECTED_HEADER)] != EXPECTED_HEADER:
+		return None
+	width = len(EXPECTED_HEADER)
+	rows = []
+	for cells in table[1:]:
+		if all(set(c) <= set("-: —") for c in cells) or cells == table[0]:
+			continue
+		row = (cells + [""] * width)[:width]
+		row[0] = _strip_marker(row[0])
+		rows.append(row)
+	return rows
+
+
+def parse_enhance_delta(text: str) -> List[Tuple[str, List[str]]]:
+	"""Rows of a delta reply as ``(marker, row)`` with the marker stripped from the ID.
+
+	``marker`` is ``"added"``, ``"modified"`` or ``""`` when the model left it out.
+	"""
+
+	delta: List[Tuple[str, List[str]]] = []
+	for row, _status in iter_normalized_csv(text):
+		match = _MARKER_PATTERN.match(row[0])
+		marker = ""
+		if match:
+			marker = "added" if match.group(1) == "新增" else "modified"
+			row[0] = row[0][match.end():].strip()
+		delta.append((marker, row))
+	return delta
+
+
+def _next_case_id(case_id: str, taken: set) -> str:
+	match = _CASE_ID_PATTERN.match(case_id)
+	prefix = (match.group(1) if match else case_id) or "TC-AUTO"
+	n = int(match.group(2)) if match else 0
+	candidate = case_id
+	while not candidate or candidate in taken:
+		n += 1
+		candidate = f"{prefix}-{n:04d}"
+	return candidate
+
+
+def apply_enhance_delta(
+	rows: List[List[str]],
+	delta: List[Tuple[str, List[str]]],
+	*,
+	mark: bool = True,
+) -> Tuple[List[List[str]], Dict[str, Any]]:
+	"""Merge ``delta`` (from ``parse_enhance_delta``) into the original ``rows``.
+
+	Modified rows replace the original with the same ``用例ID`` in place; a
+	modification of an unknown ID is treated as an addition. Added rows go
+	after the last original row of the same 模块/子模块 (else 模块, else the
+	end) and get the next free number when their ID is already taken.
+	Unmarked rows identical to an original are echoes and are skipped.
+	Prefixes already on the original IDs (an enhanced CSV enhanced again) are
+	ignored for matching and dropped; with ``mark`` the output IDs carry the
+	``[新增]``/``[修改]`` prefixes of this merge only.
+	"""
+
+	merged = [[_strip_marker(r[0])] + list(r[1:]) for r in rows]
+	by_id = {r[0]: i for i, r in enumerate(merged) if r[0]}
+	taken = set(by_id)
+	report = {"added": 0, "modified": 0, "unchanged": 0}
+	last_by_group: Dict[Tuple[str, Any], int] = {}
+	for i, r in enumerate(merged):
+		last_by_group[(r[1], r[2])] = i
+		last_by_group[(r[1], None)] = i
+	# Additions per original row index (-1 = append)
+	inserts: Dict[int, List[List[str]]] = {}
+	for marker, row in delta:
+		index = by_id.get(row[0])
+		if index is not None and marker != "added":
+			if merged[index] == row:
+				report["unchanged"] += 1
+				continue
+			merged[index] = ([f"{MODIFIED_MARKER} {row[0]}"] if mark else [row[0]]) + row[1:]
+			report["modified"] += 1
+			continue
+		row = list(row)
+		row[0] = _next_case_id(row[0], taken)
+		taken.add(row[0])
+		anchor = last_by_group.get((row[1], row[2]), last_by_group.get((row[1], None), -1))
+		if mark:
+			row[0] = f"{ADDED_MARKER} {row[0]}"
+		inserts.setdefault(anchor, []).append(row)
+		report["added"] += 1
+
+	out: List[List[str]] = []
+	for i, row in enumerate(merged):
+		out.append(row)
+		out.extend(inserts.get(i, []))
+	out.extend(inserts.get(-1, []))
+	return out, report
+
+
+def _row_tokens(row: List[str]) -> int:
+	return estimate_text_tokens(",".join(row)) + 2
+
+
+def plan_enhance_units(rows: List[List[str]], max_tokens: int) -> List[List[int]]:
+	"""Split row indexes into 模块/子模块 groups of at most ``max_tokens`` input tokens.
+
+	Groups keep their order of first appearance; a group larger than the
+	budget is split into consecutive parts. A unit depends only on its own
+	rows, so it is the cache key for enhance replies. ``max_tokens <= 0``
+	keeps each group whole.
+	"""
+
+	groups: Dict[Tuple[str, str], List[int]] = {}
+	for i, row in enumerate(rows):
+		groups.setdefault((row[1], row[2]), []).append(i)
+
+	units: List[List[int]] = []
+	for indexes in groups.values():
+		current: List[int] = []
+		used = 0
+		for i in indexes:
+			cost = _row_tokens(rows[i])
+			if current and max_tokens > 0 and used + cost > max_tokens:
+				units.append(current)
+				current, used = [], 0
+			current.append(i)
+			used += cost
+		units.append(current)
+	return units
+
+
+def plan_enhance_chunks(rows: List[List[str]], units: List[List[int]], max_tokens: int) -> List[List[int]]:
+	"""Pack ``units`` (from ``plan_enhance_units``) greedily into chunks of at most ``max_tokens``.
+
+	Returns lists of unit positions. ``max_tokens <= 0`` packs everything into one chunk.
+	"""
+
+	chunks: List[List[int]] = []
+	current: List[int] = []
+	used = 0
+	for u, indexes in enumerate(units):
+		cost = sum(_row_tokens(rows[i]) for i in indexes)
+		if current and max_tokens > 0 and used + cost > max_tokens:
+			chunks.append(current)
+			current, used = [], 0
+		current.append(u)
+		used += cost
+	if current:
+		chunks.append(current)
+	return chunks
+
+
+def _split_delta_by_unit(
+	rows: List[List[str]],
+	units: List[List[int]],
+	chunk: List[int],
+	delta: List[Tuple[str, List[str]]],
+) -> Dict[int, List[Tuple[str, List[str]]]]:
+	"""Attribute a chunk's delta rows to the units it covered.
+
+	Modified rows go to the unit holding their ``用例ID``; other rows to the
+	last unit of the same 模块/子模块 (else 模块, else the chunk's last unit).
+	"""
+
+	unit_of_id: Dict[str, int] = {}
+	by_group: Dict[Tuple[str, Any], int] = {}
+	for u in chunk:
+		for i in units[u]:
+			unit_of_id[rows[i][0]] = u
+		first = rows[units[u][0]]
+		by_group[(first[1], first[2])] = u
+		by_group[(first[1], None)] = u
+	out: Dict[int, List[Tuple[str, List[str]]]] = {u: [] for u in chunk}
+	for marker, row in delta:
+		u = unit_of_id.get(row[0]) if marker != "added" else None
+		if u is None:
+			u = by_group.get((row[1], row[2]), by_group.get((row[1], None), chunk[-1]))
+		out[u].append((marker, row))
+	return out
+
+
+def _chunk_budget(model: str, chunk_tokens: int) -> int:
+	caps = get_model_capabilities(model)
+	context = caps.get("context_window")
+	if not context:
+		return chunk_tokens
+	# Leave room for the instructions and a full reply (requests send the model's max_output)
+	room = int(context) - int(caps.get("max_output") or 4_096) - _PROMPT_OVERHEAD_TOKENS
+	return max(1, min(chunk_tokens, room)) if chunk_tokens > 0 else max(1, room)
+
+
+def _call_enhance(client: Any, model: str, prompt: str, usage: Dict[str, int]) -> str:
+	return call_model_with_retries(
+		client,
+		model,
+		[
+			{"role": "system", "content": _ENHANCE_SYSTEM_PROMPT},
+			{"role": "user", "content": prompt},
+		],
+		timeout=180,
+		extra_kwargs={"temperature": 0.7},
+		usage=usage,
+	)
+
+
+def enhance_test_cases(
+	client: Any,
+	model: str,
+	test_cases: str,
+	*,
+	mode: str = ENHANCE_MODE_DEFAULT,
+	chunk_tokens: int = ENHANCE_CHUNK_TOKENS_DEFAULT,
+	concurrency: int = 1,
+	on_plan: Optional[Callable[[int], None]] = None,
+	on_chunk_done: Optional[Callable[[int, int], None]] = None,
+) -> Tuple[str, Dict[str, Any]]:
+	"""Enhance ``test_cases`` with ``model`` and return ``(csv_text, meta)``.
+
+	In ``delta`` mode the suite is split into 模块/子模块 units by
+	``plan_enhance_units`` (the budget is also capped by the model's context
+	window). Each unit's share of a reply is cached by the unit's content, so
+	unchanged modules are not re-enhanced when another one is edited; only
+	the units without a cached delta are packed into chunks by
+	``plan_enhance_chunks``. Chunks run with up to ``concurrency`` parallel
+	calls, and all deltas are merged into the original rows at once so new
+	IDs never collide across chunks. A failed chunk leaves its rows as they
+	were. ``delta`` falls
+	back to a single ``full`` call when the input has no recognizable test
+	case table. ``on_plan(total)`` and ``on_chunk_done(done, total)`` report
+	progress.
+	"""
+
+	rows = parse_case_table(test_cases) if mode == "delta" else None
+	usage: Dict[str, int] = {}
+	meta: Dict[str, Any] = {"mode": "enhance", "enhance_mode": "delta" if rows else "full", "model_used": model, "use_vision": False}
+	if not rows:
+		if on_plan is not None:
+			on_plan(1)
+		reply = _call_enhance(client, model, _FULL_PROMPT.format(test_cases=test_cases), usage)
+		if on_chunk_done is not None:
+			on_chunk_done(1, 1)
+		# 宽松模式：尽量修复，不再拦截
+		csv_text, _, _ = normalize_csv(reply)
+		meta["usage"] = usage
+		return csv_text, meta
+
+	budget = _chunk_budget(model, int(chunk_tokens))
+	units = plan_enhance_units(rows, budget)
+	unit_keys = [
+		make_key({"enhance_group": rows_to_csv([rows[j] for j in indexes]).strip(), "config": {"text_model": model}})
+		for indexes in units
+	]
+	unit_delta: Dict[int, List[Tuple[str, List[str]]]] = {}
+	for u, key in enumerate(unit_keys):
+		cached = cache_get(key)
+		if cached:
+			unit_delta[u] = [(marker, list(row)) for marker, row in cached["result"]]
+	pending = [u for u in range(len(units)) if u not in unit_delta]
+	chunks = [
+		[pending[p] for p in chunk]
+		for chunk in plan_enhance_chunks(rows, [units[u] for u in pending], budget)
+	]
+	total = len(chunks)
+	if on_plan is not None:
+		on_plan(total)
+
+	chunk_usage: List[Dict[str, int]] = [{} for _ in chunks]
+	errors: Dict[int, str] = {}
+
+	def run_one(i: int) -> Tuple[int, Dict[int, List[Tuple[str, List[str]]]]]:
+		chunk_csv = rows_to_csv([rows[j] for u in chunks[i] for j in units[u]]).strip()
+		try:
+			reply = _call_enhance(client, model, _DELTA_PROMPT.format(test_cases=chunk_csv), chunk_usage[i])
+		except Exception as exc:  # noqa: BLE001 - the chunk's rows stay unchanged
+			print(f"用例完善第 {i + 1}/{total} 块失败: {exc}")
+			errors[i] = str(exc)
+			return i, {}
+		split = _split_delta_by_unit(rows, units, chunks[i], parse_enhance_delta(reply))
+		for u, part in split.items():
+			cache_set(unit_keys[u], {"result": part, "meta": {}})
+		return i, split
+
+	done = 0
+	if total > 1 and int(concurrency) > 1:
+		with ThreadPoolExecutor(max_workers=int(concurrency)) as ex:
+			futures = [ex.submit(run_one, i) for i in range(total)]
+			for fut in as_completed(futures):
+				_, split = fut.result()
+				unit_delta.update(split)
+				done += 1
+				if on_chunk_done is not None:
+					on_chunk_done(done, total)
+	else:
+		for i in range(total):
+			_, split = run_one(i)
+			unit_delta.update(split)
+			done += 1
+			if on_chunk_done is not None:
+				on_chunk_done(done, total)
+	if total and len(errors) == total:
+		raise RuntimeError(f"用例完善失败：{errors[0]}")
+
+	delta: List[Tuple[str, List[str]]] = []
+	for u in range(len(units)):
+		delta.extend(unit_delta.get(u, []))
+	merged, report = apply_enhance_delta(rows, delta)
+	for part in chunk_usage:
+		for k, v in part.items():
+			usage[k] = usage.get(k, 0) + v
+	meta["enhance_delta"] = dict(report, original_rows=len(rows))
+	meta["enhance_chunks"] = {
+		"total": total,
+		"groups": len(units),
+		"cached": len(units) - len(pending),
+		"failed": sorted(errors),
+		"errors": [errors[i] for i in sorted(errors)],
+	}
+	meta["usage"] = usage
+	return rows_to_csv(merged), meta
+
+
+__all__ = [
+	"ADDED_MARKER",
+	"MODIFIED_MARKER",
+	"parse_case_table",
+	"parse_enhance_delta",
+	"apply_enhance_delta",
+	"plan_enhance_units",
+	"plan_enhance_chunks",
+	"enhance_test_cases",
+]
@@ -0,0 +1,138 @@
+"""Content-addressed binary storage for KB images.
+
+KB sections reference images as ``kbimg:<doc_id>/<sha256>.<ext>`` instead of
+inline base64 data URLs. Bytes live under data/kb/<doc_id>/images/ on the
+filesystem, or in the ``kb_images`` table when DATABASE_URL is configured.
+Data URLs are only materialized when vision messages are built.
+"""
+
+from __future__ import annotations
+
+import base64
+import hashlib
+import re
+from pathlib import Path
+from typing import Mapping, Optional, Tuple, Union
+
+from backend.config import BASE_DIR
+from . import db as db_mod
+
+
+DATA_DIR = BASE_DIR / "data" / "kb"
+REF_PREFIX = "kbimg:"
+
+_EXT_BY_MIME = {
+    "image/jpeg": "jpg",
+    "image/png": "png",
+    "image/webp": "webp",
+    "image/gif": "gif",
+}
+_MIME_BY_EXT = {v: k for k, v in _EXT_BY_MIME.items()}
+
+ImageInput = Union[str, Tuple[bytes, str]]
+
+# Markdown image tag, as parse_prd_sections collects it
+_IMAGE_TAG_PATTERN = re.compile(r"(!\[.*?\]\()(.*?)(\))")
+
+
+def is_ref(value: object) -> bool:
+    return isinstance(value, str) and value.startswith(REF_PREFIX)
+
+
+def _parse_ref(ref: str) -> Tuple[str, str, str]:
+    """Return (doc_id, sha256, ext) for a ``kbimg:`` reference."""
+    body = ref[len(REF_PREFIX):]
+    doc_id, _, name = body.partition("/")
+    sha, _, ext = name.partition(".")
+    if not doc_id or len(sha) != 64:
+        raise ValueError(f"无效的图片引用: {ref[:80]}")
+    return doc_id, sha, ext or "jpg"
+
+
+def _image_path(doc_id: str, sha: str, ext: str) -> Path:
+    return DATA_DIR / doc_id / "images" / f"{sha}.{ext}"
+
+
+def decode_data_url(data_url: str) -> Tuple[bytes, str]:
+    """Split a base64 data URL into (bytes, mime)."""
+    header, _, payload = data_url.partition(",")
+    mime = header[len("data:"):].split(";")[0] or "image/jpeg"
+    return base64.b64decode(payload), mime
+
+
+def put(doc_id: str, data: bytes, mime: str = "image/jpeg") -> str:
+    """Store image bytes once (by content hash) and return their reference."""
+    sha = hashlib.sha256(data).hexdigest()
+    ext = _EXT_BY_MIME.get(mime, "jpg")
+    if db_mod.is_enabled():
+        db_mod.put_kb_image(sha, mime, data)
+    else:
+        path = _image_path(doc_id, sha, ext)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(path.suffix + ".tmp")
+            tmp.write_bytes(data)
+            tmp.replace(path)
+    return f"{REF_PREFIX}{doc_id}/{sha}.{ext}"
+
+
+def externalize(doc_id: str, image: ImageInput) -> str:
+    """Convert raw bytes or an inline data URL into a stored reference.
+
+    Remote URLs and existing references are returned unchanged.
+    """
+    if isinstance(image, tuple):
+        data, mime = image
+        return put(doc_id, data, mime)
+    if isinstance(image, str) and image.startswith("data:image"):
+        data, mime = decode_data_url(image)
+        return put(doc_id, data, mime)
+    return image
+
+
+def rewrite_image_tags(text: str, url_to_ref: Mapping[str, str]) -> str:
+    """Point ``![alt](url)`` tags at stored references (``url_to_ref``).
+
+    Used at ingest so inline data URLs leave the section text along with the
+    image list; tags whose URL is not in the map are left as they are.
+    """
+    if not text or not url_to_ref:
+        return text
+
+    def swap(m: "re.Match[str]") -> str:
+        ref = url_to_ref.get(m.group(2).strip())
+        return m.group(1) + ref + m.group(3) if ref else m.group(0)
+
+    return _IMAGE_TAG_PATTERN.sub(swap, text)
+
+
+def get_bytes(ref: str) -> Optional[Tuple[bytes, str]]:
+    """Load (bytes, mime) for a reference, or None when missing."""
+    doc_id, sha, ext = _parse_ref(ref)
+    if db_mod.is_enabled():
+        return db_mod.get_kb_image(sha)
+    path = _image_path(doc_id, sha, ext)
+    if not path.exists():
+        return None
+    return path.read_bytes(), _MIME_BY_EXT.get(ext, "image/jpeg")
+
+
+def to_data_url(ref: str) -> Optional[str]:
+    """Materialize a reference as a base64 data URL for vision messages."""
+    loaded = get_bytes(ref)
+    if loaded is None:
+        return None
+    data, mime = loaded
+    return f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
+
+
+__all__ = [
+    "REF_PREFIX",
+    "is_ref",
+    "decode_data_url",
+    "put",
+    "externalize",
+    "rewrite_image_tags",
+    "get_bytes",
+    "to_data_url",
+]
@@ -1,26 +1,50 @@
-"""Async job runner with in-memory store and optional Redis mirroring for progress and ETA."""
+"""Async job runner with in-memory store and optional Redis mirroring for progress and ETA.
+
+Job results are kept apart from the job status so that polling stays cheap:
+the status carries only the result's ETag and size, and the result text is
+fetched once via ``get_job_result`` / ``get_job_result_rows``.
+"""
 
 from __future__ import annotations
 
+import csv
+import hashlib
+import io
 import threading
 import time
 import uuid
-from typing import Any, Dict, List
+from collections import OrderedDict
+from typing import Any, Dict, List, Tuple
 import os
 import json
 
 from flask import current_app
 
 from backend.services import (
+    batch_limits_for_models,
     create_openai_client,
+    generate_incremental_csv,
     build_vision_messages,
-    download_and_process_image,
+    download_and_encode_image,
     call_model_with_retries,
-    create_batches_from_sections,
-    merge_csv_texts,
-    validate_strict_csv,
-    coerce_to_strict_csv,
-    parse_prd_sections,
+    SQA_SYSTEM_PROMPT,
+    compare_batch_planners,
+    merge_csv_rows,
+    make_row_repairer,
+    enhance_test_cases,
+    rows_to_csv,
+    record_output_usage,
+    summarize_image_dedup,
+    summarize_image_tokens,
+    summarize_image_payload,
+    summarize_batch_models,
+    select_batch_model,
+    summarize_prompt_compaction,
+    summarize_prompt_cache,
+    start_image_prefetch,
+    parse_prd_sections_cached,
+    plan_prd_batches,
+    prune_section_images,
     make_key,
     cache_get,
     cache_set,
@@ -32,17 +56,32 @@ from backend.config import (
     DISABLE_VISION_DEFAULT,
     IMAGE_MAX_SIZE_DEFAULT,
     IMAGE_QUALITY_DEFAULT,
-    MAX_IMAGES_PER_BATCH_DEFAULT,
-    MAX_SECTION_CHARS_DEFAULT,
     BATCH_INFERENCE_CONCURRENCY_DEFAULT,
     IMAGE_DOWNLOAD_CONCURRENCY_DEFAULT,
+    IMAGE_DEDUP_DISTANCE_DEFAULT,
+    IMAGE_CROP_MARGINS_DEFAULT,
+    IMAGE_TOKEN_BUDGET_DEFAULT,
+    IMAGE_BYTE_BUDGET_DEFAULT,
+    BATCH_PLANNER_DEFAULT,
+    BATCH_LOCALITY_WINDOW_DEFAULT,
+    PROMPT_COMPACTION_DEFAULT,
+    TEXT_BATCH_ROUTING_DEFAULT,
+    CASE_DEDUP_THRESHOLD_DEFAULT,
+    ROW_REPAIR_DEFAULT,
+    ENHANCE_MODE_DEFAULT,
+    ENHANCE_CHUNK_TOKENS_DEFAULT,
 )
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 _JOBS: Dict[str, Dict[str, Any]] = {}
+_RESULTS: Dict[str, str] = {}
 _LOCK = threading.Lock()
-_ENHANCE_MAX_SECONDS = 240  # hard timeout guard for enhance jobs (UI shouldn't wait forever)
+# Parsed result rows for paginated reads, keyed by result ETag
+_ROWS_CACHE: "OrderedDict[str, Tuple[List[str], List[List[str]]]]" = OrderedDict()
+_ROWS_CACHE_MAX = 8
+_JOB_TTL_SECONDS = 60 * 60 * 24
+_ENHANCE_MAX_SECONDS = 240  # hard timeout guard for enhance jobs without progress (UI shouldn't wait forever)
 
 # Optional Redis for cross-process persistence
 _redis = None
@@ -67,12 +106,29 @@ def _redis_set(job_id: str) -> None:
         with _LOCK:
             data = _JOBS.get(job_id)
         if data is not None:
-            _redis.set(f"jobs:{job_id}", json.dumps(data, ensure_ascii=False), ex=60 * 60 * 24)
+            _redis.set(f"jobs:{job_id}", json.dumps(data, ensure_ascii=False), ex=_JOB_TTL_SECONDS)
     except Exception:
         pass
 
 
+def _store_result(job_id: str, result: Any) -> Dict[str, Any]:
+    """Keep the result text outside the job dict; return the status fields describing it."""
+
+    text = "" if result is None else str(result)
+    data = text.encode("utf-8")
+    with _LOCK:
+        _RESULTS[job_id] = text
+    if _redis is not None:
+        try:
+            _redis.set(f"jobs:{job_id}:result", text, ex=_JOB_TTL_SECONDS)
+        except Exception:
+            pass
+    return {"result_etag": hashlib.sha1(data).hexdigest(), "result_bytes": len(data)}
+
+
 def _update(job_id: str, **kwargs: Any) -> None:
+    if "result" in kwargs:
+        kwargs.update(_store_result(job_id, kwargs.pop("result")))
     with _LOCK:
         _JOBS[job_id].update(kwargs)
     _redis_set(job_id)
@@ -87,9 +143,11 @@ def start_generate_job(payload: Dict[str, Any]) -> str:
             "progress": {"current": 0, "total": 0},
             "eta_seconds": None,
             "error": None,
-            "result": None,
+            "result_etag": None,
+            "result_bytes": 0,
             "meta": None,
             "started_at": None,
+            "prefetch": None,
         }
     _redis_set(job_id)
     t = threading.Thread(target=_run_job, args=(job_id, payload), daemon=True)
@@ -106,13 +164,13 @@ def get_job(job_id: str) -> Dict[str, Any] | None:
                 job = json.loads(raw)
                 # Watchdog for enhance
                 if job.get("type") == "enhance" and job.get("status") == "running":
-                    st = job.get("started_at")
+                    st = job.get("progress_at") or job.get("started_at")
                     if st and (time.time() - float(st)) > _ENHANCE_MAX_SECONDS:
                         job["status"] = "error"
                         job["error"] = f"任务超时（>{_ENHANCE_MAX_SECONDS}s），已取消。请检查网络与模型配置后重试。"
                         # mirror back change
                         try:
-                            _redis.set(f"jobs:{job_id}", json.dumps(job, ensure_ascii=False), ex=60 * 60 * 24)
+                            _redis.set(f"jobs:{job_id}", json.dumps(job, ensure_ascii=False), ex=_JOB_TTL_SECONDS)
                         except Exception:
                             pass
                 return job
@@ -122,7 +180,7 @@ def get_job(job_id: str) -> Dict[str, Any] | None:
         job = _JOBS.get(job_id)
     # Watchdog: auto-timeout enhance jobs to avoid endless spinners in UI
     if job and job.get("type") == "enhance" and job.get("status") == "running":
-        st = job.get("started_at")
+        st = job.get("progress_at") or job.get("started_at")
         if st and (time.time() - float(st)) > _ENHANCE_MAX_SECONDS:
             job["status"] = "error"
             job["error"] = f"任务超时（>{_ENHANCE_MAX_SECONDS}s），已取消。请检查网络与模型配置后重试。"
@@ -130,9 +188,44 @@ def get_job(job_id: str) -> Dict[str, Any] | None:
     return job
 
 
+def get_job_result(job_id: str) -> str | None:
+    """Full result text of a finished job, or ``None`` when there is none."""
+
+    if _redis is not None:
+        try:
+            raw = _redis.get(f"jobs:{job_id}:result")
+            if raw is not None:
+                return raw
+        except Exception:
+            pass
+    with _LOCK:
+        return _RESULTS.get(job_id)
+
+
+def get_job_result_rows(job_id: str, etag: str) -> Tuple[List[str], List[List[str]]] | None:
+    """Result CSV of a job as ``(header, rows)``, parsed once per ``etag``."""
+
+    with _LOCK:
+        parsed = _ROWS_CACHE.get(etag)
+        if parsed is not None:
+            _ROWS_CACHE.move_to_end(etag)
+            return parsed
+    text = get_job_result(job_id)
+    if text is None:
+        return None
+    rows = [r for r in csv.reader(io.StringIO(text)) if any(c.strip() for c in r)]
+    parsed = (rows[0] if rows else [], rows[1:])
+    with _LOCK:
+        _ROWS_CACHE[etag] = parsed
+        while len(_ROWS_CACHE) > _ROWS_CACHE_MAX:
+            _ROWS_CACHE.popitem(last=False)
+    return parsed
+
+
 def _run_job(job_id: str, data: Dict[str, Any]) -> None:
     _update(job_id, status="running", started_at=time.time())
     start_ts = time.time()
+    prefetcher = None
     try:
         new_prd_content = data.get("new_prd")
         old_prd_content = data.get("old_prd")
@@ -156,12 +249,37 @@ def _run_job(job_id: str, data: Dict[str, Any]) -> None:
         user_text_model = user_config.get("text_model")
         user_vision_model = user_config.get("vision_model")
         user_disable_vision = user_config.get("disable_vision", DISABLE_VISION_DEFAULT)
-        user_max_images_per_batch = user_config.get("max_images_per_batch") or MAX_IMAGES_PER_BATCH_DEFAULT
+        # Defaults sized to the registered limits of the models in use
+        model_limits = batch_limits_for_models([user_vision_model, user_text_model])
+        user_max_images_per_batch = user_config.get("max_images_per_batch") or model_limits["max_images"]
         user_image_max_size = user_config.get("image_max_size") or IMAGE_MAX_SIZE_DEFAULT
         user_image_quality = user_config.get("image_quality") or IMAGE_QUALITY_DEFAULT
-        user_max_section_chars = user_config.get("max_section_chars") or MAX_SECTION_CHARS_DEFAULT
+        user_max_section_chars = user_config.get("max_section_chars") or model_limits["max_section_chars"]
         user_batch_infer_conc = user_config.get("batch_inference_concurrency") or BATCH_INFERENCE_CONCURRENCY_DEFAULT
         user_image_dl_conc = user_config.get("image_download_concurrency") or IMAGE_DOWNLOAD_CONCURRENCY_DEFAULT
+        user_image_dedup_distance = user_config.get("image_dedup_distance")
+        if user_image_dedup_distance is None:
+            user_image_dedup_distance = IMAGE_DEDUP_DISTANCE_DEFAULT
+        user_image_crop_margins = user_config.get("image_crop_margins", IMAGE_CROP_MARGINS_DEFAULT)
+        user_image_token_budget = user_config.get("image_token_budget") or IMAGE_TOKEN_BUDGET_DEFAULT
+        user_image_byte_budget = user_config.get("image_byte_budget") or IMAGE_BYTE_BUDGET_DEFAULT
+        user_prompt_compaction = user_config.get("prompt_compaction", PROMPT_COMPACTION_DEFAULT)
+        user_batch_planner = user_config.get("batch_planner") or BATCH_PLANNER_DEFAULT
+        user_locality_window = user_config.get("batch_locality_window") or BATCH_LOCALITY_WINDOW_DEFAULT
+        user_output_token_budget = user_config.get("output_token_budget")
+        if user_output_token_budget is None:
+            user_output_token_budget = model_limits["max_output_tokens"]
+        # Image-free batches go to the text model alone, so they are sized to its own limits
+        text_limits = batch_limits_for_models([user_text_model])
+        user_text_max_section_chars = user_config.get("max_section_chars") or text_limits["max_section_chars"]
+        user_text_output_token_budget = user_config.get("output_token_budget")
+        if user_text_output_token_budget is None:
+            user_text_output_token_budget = text_limits["max_output_tokens"]
+        user_route_text_batches = user_config.get("route_text_batches", TEXT_BATCH_ROUTING_DEFAULT)
+        user_case_dedup_threshold = user_config.get("case_dedup_threshold")
+        if user_case_dedup_threshold is None:
+            user_case_dedup_threshold = CASE_DEDUP_THRESHOLD_DEFAULT
+        user_row_repair = user_config.get("row_repair", ROW_REPAIR_DEFAULT)
 
         # Cache lookup before heavy work
         cache_key = make_key({
@@ -177,24 +295,45 @@ def _run_job(job_id: str, data: Dict[str, Any]) -> None:
         user_client = create_openai_client(user_api_key, user_base_url)
         prompt_template_full, prompt_template_diff = current_app.config["PROMPT_TEMPLATES"]
 
-        # Incremental (text) mode always single batch
+        # Incremental mode: section-level diff, only added/modified sections are generated
         if old_prd_content and old_prd_content.strip():
-            final_prompt = prompt_template_diff.format(
-                old_prd_content=old_prd_content,
-                new_prd_content=new_prd_content,
-            )
-            messages = [
-                {"role": "system", "content": "你是一名顶级的、经验丰富的软件测试保证（SQA）工程师。请始终使用简体中文输出。"},
-                {"role": "user", "content": final_prompt},
-            ]
-            completion = user_client.chat.completions.create(
-                model=user_text_model,
-                messages=messages,
-                max_tokens=4096,
+
+            def on_batch_done(done: int, total: int) -> None:
+                elapsed = time.time() - start_ts
+                _update(
+                    job_id,
+                    progress={"current": done, "total": total},
+                    eta_seconds=int(elapsed / max(1, done) * (total - done)),
+                )
+
+            ai_response, meta = generate_incremental_csv(
+                user_client,
+                old_prd_content,
+                new_prd_content or "",
+                prompt_template_diff,
+                text_model=user_text_model,
+                vision_model=user_vision_model,
+                use_vision=not user_disable_vision,
+                max_images=int(user_max_images_per_batch),
+                max_section_chars=int(user_max_section_chars),
+                dedup_threshold=float(user_case_dedup_threshold),
+                row_repair=bool(user_row_repair),
+                concurrency=int(user_batch_infer_conc),
+                vision_options={
+                    "use_deepseek": bool(user_base_url) and "deepseek" in str(user_base_url).lower(),
+                    "image_max_size": user_image_max_size,
+                    "image_quality": user_image_quality,
+                    "image_download_concurrency": int(user_image_dl_conc),
+                    "image_dedup_distance": int(user_image_dedup_distance),
+                    "image_crop_margins": bool(user_image_crop_margins),
+                    "image_token_budget": int(user_image_token_budget),
+                    "image_byte_budget": int(user_image_byte_budget),
+                    "compact_prompt": bool(user_prompt_compaction),
+                },
+                on_plan=lambda total: _update(job_id, progress={"current": 0, "total": total}),
+                on_batch_done=on_batch_done,
             )
-            ai_response = completion.choices[0].message.content
-            _update(job_id, progress={"current": 1, "total": 1}, eta_seconds=0)
-            meta = {"mode": "incremental", "model_used": user_text_model, "use_vision": False}
+            _update(job_id, eta_seconds=0)
             cache_set(cache_key, {"result": ai_response, "meta": meta})
             _update(job_id, status="done", result=ai_response, meta=meta)
             return
@@ -203,17 +342,13 @@ def _run_job(job_id: str, data: Dict[str, Any]) -> None:
         if user_disable_vision:
             final_prompt = prompt_template_full.format(prd_content=new_prd_content)
             messages = [
-                {"role": "system", "content": "你是一名资深SQA工程师。请严格基于以下PRD生成测试用例，使用简体中文，不得编造无关场景。"},
+                {"role": "system", "content": SQA_SYSTEM_PROMPT},
                 {"role": "user", "content": final_prompt},
             ]
-            completion = user_client.chat.completions.create(
-                model=user_text_model,
-                messages=messages,
-                max_tokens=4096,
-            )
-            ai_response = completion.choices[0].message.content
+            usage: Dict[str, int] = {}
+            ai_response = call_model_with_retries(user_client, user_text_model, messages, usage=usage)
             _update(job_id, progress={"current": 1, "total": 1}, eta_seconds=0)
-            meta = {"mode": "full-text-fallback", "model_used": user_text_model, "use_vision": False}
+            meta = {"mode": "full-text-fallback", "model_used": user_text_model, "use_vision": False, "usage": usage}
             cache_set(cache_key, {"result": ai_response, "meta": meta})
             _update(job_id, status="done", result=ai_response, meta=meta)
             return
@@ -221,32 +356,55 @@ def _run_job(job_id: str, data: Dict[str, Any]) -> None:
         if not user_vision_model:
             raise RuntimeError("缺少视觉模型名称")
 
-        sections = parse_prd_sections(new_prd_content)
+        sections = parse_prd_sections_cached(new_prd_content)
         total_images = sum(len(s["images"]) for s in sections)
         if total_images == 0:
             final_prompt = prompt_template_full.format(prd_content=new_prd_content)
             messages = [
-                {"role": "system", "content": "你是一名资深SQA工程师。请严格基于以下PRD生成测试用例，使用简体中文，不得编造无关场景。"},
+                {"role": "system", "content": SQA_SYSTEM_PROMPT},
                 {"role": "user", "content": final_prompt},
             ]
-            completion = user_client.chat.completions.create(
-                model=user_text_model,
-                messages=messages,
-                max_tokens=4096,
-            )
-            ai_response = completion.choices[0].message.content
+            usage: Dict[str, int] = {}
+            ai_response = call_model_with_retries(user_client, user_text_model, messages, usage=usage)
             _update(job_id, progress={"current": 1, "total": 1}, eta_seconds=0)
-            meta = {"mode": "full-no-images", "model_used": user_text_model, "use_vision": False}
+            meta = {"mode": "full-no-images", "model_used": user_text_model, "use_vision": False, "usage": usage}
             cache_set(cache_key, {"result": ai_response, "meta": meta})
             _update(job_id, status="done", result=ai_response, meta=meta)
             return
 
-        batches = create_batches_from_sections(sections, user_max_images_per_batch, user_max_section_chars)
+        use_deepseek = bool(user_base_url) and "deepseek" in str(user_base_url).lower()
+
+        # Start fetching every image now so downloads overlap earlier batches
+        if not use_deepseek:
+            prefetcher = start_image_prefetch(
+                sections,
+                vision_model=user_vision_model,
+                image_max_size=user_image_max_size,
+                image_quality=user_image_quality,
+                image_crop_margins=bool(user_image_crop_margins),
+                image_byte_budget=int(user_image_byte_budget),
+                concurrency=int(user_image_dl_conc),
+                on_progress=lambda p: _update(job_id, prefetch=p),
+            )
+        # Drop near-duplicate images before planning, so batch sizes count only the kept ones
+        if int(user_image_dedup_distance) >= 0:
+            prune_section_images(sections, int(user_image_dedup_distance), prefetcher=prefetcher)
+        sections, batches = plan_prd_batches(
+            new_prd_content,
+            user_max_images_per_batch,
+            user_max_section_chars,
+            planner=user_batch_planner,
+            locality_window=int(user_locality_window),
+            max_output_tokens=int(user_output_token_budget),
+            split_by_modality=bool(user_route_text_batches),
+            text_max_section_chars=int(user_text_max_section_chars),
+            text_max_output_tokens=int(user_text_output_token_budget),
+            sections=sections,
+        )
+
         total_batches = len(batches)
         _update(job_id, progress={"current": 0, "total": total_batches})
 
-        use_deepseek = bool(user_base_url) and "deepseek" in str(user_base_url).lower()
-
         def run_one(i_b):
             i, b = i_b
             t0 = time.time()
@@ -259,22 +417,32 @@ def _run_job(job_id: str, data: Dict[str, Any]) -> None:
                 image_max_size=user_image_max_size,
                 image_quality=user_image_quality,
                 image_download_concurrency=int(user_image_dl_conc),
+                image_dedup_distance=int(user_image_dedup_distance),
+                vision_model=user_vision_model,
+                image_crop_margins=bool(user_image_crop_margins),
+                image_token_budget=int(user_image_token_budget),
+                image_byte_budget=int(user_image_byte_budget),
+                compact_prompt=bool(user_prompt_compaction),
+                prefetcher=prefetcher,
+            )
+            batch_model = select_batch_model(
+                b, user_vision_model, user_text_model, route_text_batches=bool(user_route_text_batches)
             )
             try:
-                resp = call_model_with_retries(user_client, user_vision_model, msgs)
+                resp = call_model_with_retries(user_client, batch_model, msgs, usage=b.setdefault("usage", {}))
             except Exception:
                 # degrade to text only
                 combined_text = "\n\n".join([f"## {s['title']}\n{s['text']}" for s in b["sections"]])
                 final_prompt2 = prompt_template_full.format(prd_content=combined_text)
-                completion = user_client.chat.completions.create(
-                    model=user_text_model,
-                    messages=[
-                        {"role": "system", "content": "你是一名资深SQA工程师。请严格基于以下PRD生成测试用例，使用简体中文，不得编造无关场景。"},
+                resp = call_model_with_retries(
+                    user_client,
+                    user_text_model,
+                    [
+                        {"role": "system", "content": SQA_SYSTEM_PROMPT},
                         {"role": "user", "content": final_prompt2},
                     ],
-                    max_tokens=4096,
+                    usage=b.setdefault("usage", {}),
                 )
-                resp = completion.choices[0].message.content
             dt = time.time() - t0
             # update progress and ETA
             with _LOCK:
@@ -303,14 +471,15 @@ def _run_job(job_id: str, data: Dict[str, Any]) -> None:
                 _, r = run_one((i, b))
                 responses.append(r)
 
-        final_response = merge_csv_texts(responses)
-        ok, reason = validate_strict_csv(final_response)
-        if not ok:
-            repaired = coerce_to_strict_csv(final_response)
-            ok2, reason2 = validate_strict_csv(repaired)
-            if not ok2:
-                raise RuntimeError(f"AI 输出不是规范 CSV：{reason2}")
-            final_response = repaired
+        output_usage = record_output_usage(batches, responses)
+        case_rows, csv_report = merge_csv_rows(
+            responses,
+            dedup_threshold=float(user_case_dedup_threshold),
+            repair=make_row_repairer(user_client, user_text_model, batches) if user_row_repair else None,
+        )
+        if not csv_report["ok"]:
+            raise RuntimeError(f"AI 输出不是规范 CSV：{csv_report['reason']}")
+        final_response = rows_to_csv(case_rows)
 
         meta = {
             "mode": "full-vision-multimodal",
@@ -320,11 +489,39 @@ def _run_job(job_id: str, data: Dict[str, Any]) -> None:
             "total_images": total_images,
             "total_sections": len(sections),
         }
+        if int(user_image_dedup_distance) >= 0:
+            meta["image_dedup"] = summarize_image_dedup(batches)
+        meta["image_tokens"] = summarize_image_tokens(batches)
+        meta["image_payload"] = summarize_image_payload(batches)
+        meta["prompt_compaction"] = summarize_prompt_compaction(batches)
+        meta["prompt_cache"] = summarize_prompt_cache(batches)
+        meta["csv_repairs"] = csv_report
+        meta["case_dedup"] = csv_report["dedup"]
+        meta["row_repair"] = csv_report["row_repair"]
+        meta["output_tokens"] = output_usage
+        meta["batches_by_model"] = summarize_batch_models(
+            batches, user_vision_model, user_text_model, route_text_batches=bool(user_route_text_batches)
+        )
+        meta["batch_plan"] = compare_batch_planners(
+            sections,
+            user_max_images_per_batch,
+            user_max_section_chars,
+            planner=user_batch_planner,
+            locality_window=int(user_locality_window),
+            max_output_tokens=int(user_output_token_budget),
+            split_by_modality=bool(user_route_text_batches),
+            text_max_section_chars=int(user_text_max_section_chars),
+            text_max_output_tokens=int(user_text_output_token_budget),
+            batches=batches,
+        )
 
         cache_set(cache_key, {"result": final_response, "meta": meta})
         _update(job_id, status="done", result=final_response, meta=meta, eta_seconds=0)
     except Exception as exc:  # noqa: BLE001
         _update(job_id, status="error", error=str(exc))
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
 
 def start_enhance_job(payload: Dict[str, Any]) -> str:
     """Start an async enhance job with simple progress and CSV repair."""
@@ -336,7 +533,8 @@ def start_enhance_job(payload: Dict[str, Any]) -> str:
             "progress": {"current": 0, "total": 1},
             "eta_seconds": None,
             "error": None,
-            "result": None,
+            "result_etag": None,
+            "result_bytes": 0,
             "meta": None,
             "started_at": None,
         }
@@ -374,47 +572,31 @@ def start_enhance_job(payload: Dict[str, Any]) -> str:
                 raise RuntimeError("缺少必要配置：请在模型配置中填写 API Key 和 文本模型名称。")
 
             client = create_openai_client(user_api_key, user_base_url)
-            enhance_prompt = f"""你是一位专业的测试工程师。请分析以下测试用例，并进行完善和补充：
-
-【现有测试用例（原文）】
-{test_cases}
-
-【完善目标】
-1. 用户场景补充：添加更多正向流程、边界条件
-2. 异常场景补充：错误处理、异常输入、网络异常等
-3. 测试步骤完善：步骤清晰、可执行
-4. 预期结果优化：明确具体、可验证
-5. 覆盖度提升：识别遗漏并补充
-
-【输出格式（严格）】
-- 仅输出 CSV 文本，不要输出 Markdown、代码块或其它说明。
-- 第一行必须是表头，列为：用例ID,模块,子模块,测试项,前置条件,操作步骤,预期结果,用例类型
-- 新增的测试用例在“用例ID”列以“[新增] ”前缀标注，例如：[新增] TC-登录-密码错误-0007
-- 使用英文逗号分隔；如单元格内含逗号或换行，请用双引号包裹，并将内部双引号转义为两个双引号。
-
-请直接输出完善后的完整 CSV 内容。"""
+            start_ts = time.time()
+
+            def on_plan(total: int) -> None:
+                _update(job_id, progress={"current": 0, "total": total})
+
+            def on_chunk_done(done: int, total: int) -> None:
+                now = time.time()
+                _update(
+                    job_id,
+                    progress={"current": done, "total": total},
+                    progress_at=now,
+                    eta_seconds=int((now - start_ts) / max(1, done) * (total - done)),
+                )
 
-            result_text = call_model_with_retries(
+            result_text, meta = enhance_test_cases(
                 client,
                 user_text_model,
-                [
-                    {"role": "system", "content": "你是一位经验丰富的测试工程师，擅长设计全面的测试用例。"},
-                    {"role": "user", "content": enhance_prompt},
-                ],
-                max_tokens=4096,
-                timeout=180,
-                extra_kwargs={"temperature": 0.7},
+                test_cases,
+                mode=user_config.get("enhance_mode") or ENHANCE_MODE_DEFAULT,
+                chunk_tokens=int(user_config.get("enhance_chunk_tokens") or ENHANCE_CHUNK_TOKENS_DEFAULT),
+                concurrency=int(user_config.get("batch_inference_concurrency") or BATCH_INFERENCE_CONCURRENCY_DEFAULT),
+                on_plan=on_plan,
+                on_chunk_done=on_chunk_done,
             )
-            _update(job_id, progress={"current": 1, "total": 1}, eta_seconds=0)
-
-            ok, _ = validate_strict_csv(result_text)
-            if not ok:
-                repaired = coerce_to_strict_csv(result_text)
-                ok2, _ = validate_strict_csv(repaired)
-                if ok2:
-                    result_text = repaired
 
-            meta = {"mode": "enhance", "model_used": user_text_model, "use_vision": False}
             cache_set(cache_key, {"result": result_text, "meta": meta})
             _update(job_id, status="done", result=result_text, meta=meta, eta_seconds=0)
         except Exception as exc:  # noqa: BLE001
@@ -425,7 +607,7 @@ def start_enhance_job(payload: Dict[str, Any]) -> str:
 
 
 def start_kb_ingest_job(payload: Dict[str, Any]) -> str:
-    """Ingest a PRD into the local KB with preprocessed images (data URLs)."""
+    """Ingest a PRD into the local KB with preprocessed images (binary blobs)."""
     job_id = uuid.uuid4().hex
     with _LOCK:
         _JOBS[job_id] = {
@@ -434,7 +616,8 @@ def start_kb_ingest_job(payload: Dict[str, Any]) -> str:
             "progress": {"current": 0, "total": 0},
             "eta_seconds": None,
             "error": None,
-            "result": None,
+            "result_etag": None,
+            "result_bytes": 0,
             "meta": None,
             "started_at": None,
         }
@@ -448,22 +631,28 @@ def start_kb_ingest_job(payload: Dict[str, Any]) -> str:
             if not prd_content.strip():
                 raise RuntimeError("PRD 内容不能为空")
 
-            sections = parse_prd_sections(prd_content)
+            sections = parse_prd_sections_cached(prd_content)
             total_sections = len(sections)
             _update(job_id, progress={"current": 0, "total": total_sections})
 
-            # Preprocess images into data URLs to avoid re-downloading later
+            # Preprocess images into encoded bytes to avoid re-downloading later;
+            # the KB stores them as blobs referenced by content hash
             for i, s in enumerate(sections):
                 imgs = s.get("images", []) or []
-                processed: List[str] = []
+                processed: List[Any] = []
+                sources: List[str] = []
                 for url in imgs:
                     if isinstance(url, str) and url.startswith("data:image"):
                         processed.append(url)
+                        sources.append(url)
                     else:
-                        data_url = download_and_process_image(url)
-                        if data_url:
-                            processed.append(data_url)
+                        encoded = download_and_encode_image(url)
+                        if encoded:
+                            processed.append(encoded)
+                            sources.append(url)
                 s["images"] = processed
+                # Lets the KB point the text's image tags at the stored blobs
+                s["image_sources"] = sources
                 _update(job_id, progress={"current": i + 1, "total": total_sections})
 
             doc_id = kb_create_doc_from_sections(name, sections)
@@ -479,4 +668,11 @@ def start_kb_ingest_job(payload: Dict[str, Any]) -> str:
     return job_id
 
 
-__all__ = ["start_generate_job", "get_job", "start_enhance_job", "start_kb_ingest_job"]
+__all__ = [
+    "start_generate_job",
+    "get_job",
+    "get_job_result",
+    "get_job_result_rows",
+    "start_enhance_job",
+    "start_kb_ingest_job",
+]
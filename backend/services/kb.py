@@ -2,7 +2,10 @@
 
 Defaults to filesystem JSON under data/kb/<doc_id>/doc.json.
 When DATABASE_URL is configured, uses PostgreSQL via SQLAlchemy instead.
-Supports embedding vectorization when EMBEDDING_API_KEY is set.
+Section images are stored as binary blobs (see image_store) and referenced
+by content hash, so documents stay small to load and search.
+Supports embedding vectorization when EMBEDDING_API_KEY is set; similarity
+search goes through an in-process vector index (see vector_index).
 """
 
 from __future__ import annotations
@@ -12,11 +15,21 @@ import os
 import time
 import uuid
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
-
-from backend.config import BASE_DIR
+from typing import Any, Dict, List, Optional
+
+from backend.config import (
+    BASE_DIR,
+    KB_ANN_INDEX_DEFAULT,
+    KB_ANN_MIN_ROWS_DEFAULT,
+    KB_ANN_NLIST_DEFAULT,
+    KB_ANN_NPROBE_DEFAULT,
+    KB_INDEX_DIR,
+)
 from . import db as db_mod
 from . import embeddings as emb_mod
+from . import image_store
+from .ann_index import IndexStore, IvfFlat
+from .vector_index import KbVectorIndex, np
 
 
 DATA_DIR = BASE_DIR / "data" / "kb"
@@ -35,6 +48,7 @@ def save_doc(doc: Dict[str, Any]) -> None:
     dd = _doc_dir(doc_id)
     with (dd / "doc.json").open("w", encoding="utf-8") as f:
         json.dump(doc, f, ensure_ascii=False, indent=2)
+    _INDEX.add_doc(doc)
 
 
 def load_doc(doc_id: str) -> Optional[Dict[str, Any]]:
@@ -48,6 +62,26 @@ def load_doc(doc_id: str) -> Optional[Dict[str, Any]]:
         return json.load(f)
 
 
+def _list_doc_ids() -> List[str]:
+    if db_mod.is_enabled():
+        return db_mod.list_doc_ids()
+    return [child.name for child in DATA_DIR.iterdir() if (child / "doc.json").exists()]
+
+
+# Per-process index over section embeddings; loads lazily on first search.
+# With KB_ANN_INDEX it is persisted under KB_INDEX_DIR and searched by IVF once large.
+if KB_ANN_INDEX_DEFAULT and np is not None:
+    _INDEX = KbVectorIndex(
+        _list_doc_ids,
+        load_doc,
+        ann=IvfFlat(nlist=KB_ANN_NLIST_DEFAULT, nprobe=KB_ANN_NPROBE_DEFAULT),
+        store=IndexStore(KB_INDEX_DIR),
+        ann_min_rows=KB_ANN_MIN_ROWS_DEFAULT,
+    )
+else:
+    _INDEX = KbVectorIndex(_list_doc_ids, load_doc)
+
+
 def list_docs() -> List[Dict[str, Any]]:
     if db_mod.is_enabled():
         return db_mod.list_docs()
@@ -75,7 +109,20 @@ def list_docs() -> List[Dict[str, Any]]:
 def create_doc_from_sections(name: str, sections: List[Dict[str, Any]]) -> str:
     doc_id = uuid.uuid4().hex
     created_at = int(time.time())
-    
+
+    # Move image bytes / inline data URLs into the blob store; sections keep only refs,
+    # in the image list and in the text's image tags. ``image_sources`` (optional)
+    # gives the original URL of each entry of ``images`` when those are encoded bytes.
+    for sec in sections:
+        images = sec.get("images") or []
+        sources = sec.pop("image_sources", None) or images
+        refs = [image_store.externalize(doc_id, img) for img in images]
+        url_to_ref = {
+            src: ref for src, ref in zip(sources, refs) if isinstance(src, str) and src != ref
+        }
+        sec["images"] = refs
+        sec["text"] = image_store.rewrite_image_tags(sec.get("text") or "", url_to_ref)
+
     # Generate embeddings for each section if embedding is enabled
     if emb_mod.is_enabled():
         for sec in sections:
@@ -88,12 +135,13 @@ def create_doc_from_sections(name: str, sections: List[Dict[str, Any]]) -> str:
     
     if db_mod.is_enabled():
         db_mod.create_doc_from_sections(name or f"doc-{doc_id[:6]}", created_at, sections, doc_id)
+        _INDEX.add_doc({"doc_id": doc_id, "name": name or f"doc-{doc_id[:6]}", "sections": sections})
         return doc_id
     payload = {
         "doc_id": doc_id,
         "name": name or f"doc-{doc_id[:6]}",
         "created_at": created_at,
-        # sections: [{title, text, images: [data_url or url], embedding}]
+        # sections: [{title, text, images: [kbimg ref or url], embedding}]
         "sections": sections,
     }
     save_doc(payload)
@@ -121,65 +169,7 @@ def search_similar_sections(query: str, top_k: int = 5, doc_id: Optional[str] =
         print(f"Failed to embed query: {exc}")
         return []
     
-    results: List[Tuple[float, Dict[str, Any]]] = []
-    
-    if db_mod.is_enabled():
-        # Search in database
-        if doc_id:
-            doc = db_mod.load_doc(doc_id)
-            if not doc:
-                return []
-            docs_to_search = [doc]
-        else:
-            # Search all docs
-            all_docs = db_mod.list_docs()
-            docs_to_search = [db_mod.load_doc(d["doc_id"]) for d in all_docs if db_mod.load_doc(d["doc_id"])]
-        
-        for doc in docs_to_search:
-            if not doc:
-                continue
-            for sec in doc.get("sections", []):
-                if sec.get("embedding"):
-                    sim = emb_mod.cosine_similarity(query_embedding, sec["embedding"])
-                    results.append((sim, {
-                        "doc_id": doc["doc_id"],
-                        "doc_name": doc.get("name"),
-                        "title": sec.get("title"),
-                        "text": sec.get("text"),
-                        "images": sec.get("images", []),
-                        "similarity": sim,
-                    }))
-    else:
-        # Search in filesystem JSON
-        if doc_id:
-            doc = load_doc(doc_id)
-            if not doc:
-                return []
-            docs_to_search = [doc]
-        else:
-            docs_to_search = []
-            for child in DATA_DIR.iterdir():
-                if child.is_dir():
-                    d = load_doc(child.name)
-                    if d:
-                        docs_to_search.append(d)
-        
-        for doc in docs_to_search:
-            for sec in doc.get("sections", []):
-                if sec.get("embedding"):
-                    sim = emb_mod.cosine_similarity(query_embedding, sec["embedding"])
-                    results.append((sim, {
-                        "doc_id": doc["doc_id"],
-                        "doc_name": doc.get("name"),
-                        "title": sec.get("title"),
-                        "text": sec.get("text"),
-                        "images": sec.get("images", []),
-                        "similarity": sim,
-                    }))
-    
-    # Sort by similarity descending and return top_k
-    results.sort(key=lambda x: x[0], reverse=True)
-    return [r[1] for r in results[:top_k]]
+    return _INDEX.search(query_embedding, top_k=top_k, doc_id=doc_id)
 
 
 __all__ = [
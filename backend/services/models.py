@@ -0,0 +1,254 @@
+"""Model capability registry: context window, output limit, image support and throughput.
+
+Capabilities come from pattern-based defaults below, overridden by a JSON
+file (``MODEL_CAPABILITIES_FILE``) and/or inline JSON (``MODEL_CAPABILITIES``),
+both shaped ``{"<regex>": {"context_window": ..., ...}}``. Overrides are
+checked before the defaults; the first matching pattern wins, and unset keys
+fall through to the generic entry. Observed output tokens/sec are tracked
+per model at runtime.
+"""
+
+from __future__ import annotations
+
+import json
+import re
+import threading
+from typing import Any, Dict, Iterable, List, Tuple
+
+from backend.config import (
+	MODEL_CAPABILITIES_FILE,
+	MODEL_CAPABILITIES_JSON,
+	MAX_IMAGES_PER_BATCH_DEFAULT,
+	MAX_SECTION_CHARS_DEFAULT,
+	OUTPUT_TOKEN_BUDGET_DEFAULT,
+)
+
+from .compaction import estimate_text_tokens
+
+
+class PromptTooLarge(ValueError):
+	"""Raised before sending a request that cannot fit the model's limits."""
+
+
+# context_window / max_output in tokens; image_tokens is a flat per-image
+# estimate used for budget checks (sizing policies in vision.py are exact);
+# max_images caps images per request where the API enforces one.
+_DEFAULT_CAPABILITIES: List[Tuple[str, Dict[str, Any]]] = [
+	(r"gpt-4o-mini", {"context_window": 128_000, "max_output": 16_384, "images": True, "image_tokens": 1_500}),
+	(r"gpt-4o", {"context_window": 128_000, "max_output": 16_384, "images": True, "image_tokens": 800}),
+	(r"gpt-4\.1", {"context_window": 1_000_000, "max_output": 32_768, "images": True, "image_tokens": 800}),
+	(r"gpt-4-turbo|gpt-4-vision", {"context_window": 128_000, "max_output": 4_096, "images": True, "image_tokens": 800}),
+	(r"gpt-3\.5", {"context_window": 16_385, "max_output": 4_096, "images": False}),
+	(r"\bo1\b|\bo3\b|\bo4", {"context_window": 200_000, "max_output": 100_000, "images": True, "image_tokens": 800}),
+	(r"claude", {"context_window": 200_000, "max_output": 8_192, "images": True, "image_tokens": 1_600}),
+	(r"deepseek-vl", {"context_window": 4_096, "max_output": 2_048, "images": True, "image_tokens": 600}),
+	(r"deepseek", {"context_window": 64_000, "max_output": 8_192, "images": False}),
+	(r"qwen.*vl|qvq", {"context_window": 32_768, "max_output": 8_192, "images": True, "image_tokens": 1_280}),
+	(r"qwen", {"context_window": 131_072, "max_output": 8_192, "images": False}),
+	(r"glm-4v", {"context_window": 8_192, "max_output": 1_024, "images": True, "image_tokens": 1_600, "max_images": 1}),
+	(r"glm-4\.\d+v", {"context_window": 65_536, "max_output": 16_384, "images": True, "image_tokens": 1_600}),
+	(r"glm", {"context_window": 128_000, "max_output": 4_096, "images": False}),
+	(r"gemini", {"context_window": 1_000_000, "max_output": 8_192, "images": True, "image_tokens": 258}),
+	(r"vision|-vl\b|-v\b", {"images": True}),
+]
+
+# Unknown models keep the global limits: no context check, 4096 output
+_GENERIC_CAPABILITIES: Dict[str, Any] = {
+	"context_window": None,
+	"max_output": 4_096,
+	"images": True,
+	"image_tokens": 1_000,
+	"tokens_per_sec": None,
+}
+
+# Vision variants of otherwise text-only families (deepseek-vl2, glm-4.5v, xxx-vision) keep image
+# support even when a built-in family pattern above says otherwise
+_VISION_NAME = re.compile(r"vision|-vl|\dv\b|\dv-", re.IGNORECASE)
+
+# Context-size suffix in names like doubao-lite-4k, moonshot-v1-32k, doubao-pro-128k
+_CONTEXT_SUFFIX = re.compile(r"(?<![\d.])(\d{1,4})k\b", re.IGNORECASE)
+
+# Room for the system prompt, template instructions and numbering rules
+_PROMPT_OVERHEAD_TOKENS = 2_000
+# Minimum output a request must leave room for to be worth sending
+_MIN_OUTPUT_TOKENS = 512
+# Smallest text budget a batch is planned with, unless the context is smaller still
+_MIN_SECTION_CHARS = 2_000
+# Text budget conversion: PRDs are mostly CJK, about one token per character
+_CHARS_PER_TOKEN = 1.0
+# Keep the planner's predicted output a little under the hard output limit
+_OUTPUT_HEADROOM = 0.88
+
+_LOCK = threading.Lock()
+_OVERRIDES: List[Tuple[str, Dict[str, Any]]] | None = None
+_THROUGHPUT: Dict[str, float] = {}
+
+
+def _load_overrides() -> List[Tuple[str, Dict[str, Any]]]:
+	global _OVERRIDES
+	if _OVERRIDES is not None:
+		return _OVERRIDES
+	entries: List[Tuple[str, Dict[str, Any]]] = []
+	sources: List[str] = []
+	try:
+		if MODEL_CAPABILITIES_FILE and MODEL_CAPABILITIES_FILE.exists():
+			sources.append(MODEL_CAPABILITIES_FILE.read_text(encoding="utf-8"))
+	except OSError as exc:
+		print(f"读取模型能力配置失败: {exc}")
+	if MODEL_CAPABILITIES_JSON:
+		sources.append(MODEL_CAPABILITIES_JSON)
+	# Inline env JSON is read last but should win, so it goes first
+	for raw in reversed(sources):
+		try:
+			data = json.loads(raw)
+		except ValueError as exc:
+			print(f"模型能力配置不是合法 JSON: {exc}")
+			continue
+		if isinstance(data, dict):
+			entries.extend((str(k), dict(v)) for k, v in data.items() if isinstance(v, dict))
+	_OVERRIDES = entries
+	return entries
+
+
+def get_model_capabilities(model_name: str | None) -> Dict[str, Any]:
+	"""Capabilities for ``model_name`` (override > default pattern > name suffix > generic)."""
+
+	caps = dict(_GENERIC_CAPABILITIES)
+	name = (model_name or "").lower()
+	matched: Dict[str, Any] | None = None
+	builtin = False
+	if name:
+		overrides = _load_overrides()
+		for n, (pattern, entry) in enumerate(overrides + _DEFAULT_CAPABILITIES):
+			if re.search(pattern, name, re.IGNORECASE):
+				matched = entry
+				builtin = n >= len(overrides)
+				break
+		suffix = _CONTEXT_SUFFIX.search(name)
+		if suffix and (matched is None or "context_window" not in matched):
+			caps["context_window"] = int(suffix.group(1)) * 1024
+			caps["max_output"] = min(caps["max_output"], caps["context_window"])
+	if matched:
+		caps.update(matched)
+		if builtin and not caps.get("images") and _VISION_NAME.search(name):
+			caps["images"] = True
+	with _LOCK:
+		observed = _THROUGHPUT.get(name)
+	if observed:
+		caps["tokens_per_sec"] = round(observed, 1)
+	return caps
+
+
+def record_model_throughput(model_name: str | None, output_tokens: int, seconds: float) -> None:
+	"""Fold one call's output tokens/sec into the model's running average."""
+
+	if not model_name or output_tokens <= 0 or seconds <= 0:
+		return
+	rate = output_tokens / seconds
+	key = model_name.lower()
+	with _LOCK:
+		prev = _THROUGHPUT.get(key)
+		_THROUGHPUT[key] = rate if prev is None else 0.8 * prev + 0.2 * rate
+
+
+def estimate_message_tokens(messages: Iterable[Dict[str, Any]], image_tokens: int = 1_000) -> int:
+	"""Rough prompt size of chat messages: text estimate plus a flat cost per image part."""
+
+	total = 0
+	for message in messages:
+		content = message.get("content")
+		if isinstance(content, str):
+			total += estimate_text_tokens(content) + 4
+			continue
+		for part in content or []:
+			if part.get("type") == "text":
+				total += estimate_text_tokens(part.get("text", ""))
+			elif part.get("type") == "image_url":
+				total += int(image_tokens)
+		total += 4
+	return total
+
+
+def plan_request(model_name: str | None, messages: List[Dict[str, Any]], max_tokens: int | None = None) -> int:
+	"""Return the ``max_tokens`` to send, or raise ``PromptTooLarge``.
+
+	``max_tokens`` is capped by the model's output limit (``None`` means use the
+	limit) and by what is left of the context window after the prompt.
+	"""
+
+	caps = get_model_capabilities(model_name)
+	has_images = any(
+		isinstance(m.get("content"), list) and any(p.get("type") == "image_url" for p in m["content"])
+		for m in messages
+	)
+	if has_images and not caps.get("images", True):
+		raise PromptTooLarge(f"模型 {model_name} 不支持图片输入")
+	limit = int(caps.get("max_output") or 4_096)
+	wanted = limit if max_tokens is None else min(int(max_tokens), limit)
+	context = caps.get("context_window")
+	if not context:
+		return wanted
+	prompt_tokens = estimate_message_tokens(messages, int(caps.get("image_tokens") or 1_000))
+	room = int(context) - prompt_tokens
+	if room < min(_MIN_OUTPUT_TOKENS, wanted):
+		raise PromptTooLarge(
+			f"提示词约 {prompt_tokens} tokens，超出模型 {model_name} 的上下文窗口 {context}"
+		)
+	return min(wanted, room)
+
+
+def batch_limits_for_models(models: Iterable[str | None]) -> Dict[str, int]:
+	"""Default batch limits that fit every model in ``models``.
+
+	Each model's limits come from the registry, in both directions: the
+	predicted output budget is its output limit (which is also what requests
+	send as ``max_tokens``) less some headroom, and a known context window
+	bounds the text budget after that output, the prompt overhead and the
+	images a batch may carry. The result is the tightest limit over
+	``models``. Models without a known context window keep the global
+	defaults, and ``OUTPUT_TOKEN_BUDGET=0`` still disables output budgeting.
+	"""
+
+	max_images = MAX_IMAGES_PER_BATCH_DEFAULT
+	max_chars: int | None = None
+	output_budget: int | None = None
+	for model in models:
+		if not model:
+			continue
+		caps = get_model_capabilities(model)
+		if caps.get("max_images"):
+			max_images = min(max_images, int(caps["max_images"]))
+		max_output = int(caps.get("max_output") or 4_096)
+		context = caps.get("context_window")
+		if context:
+			context = int(context)
+			image_room = max_images * int(caps.get("image_tokens") or 0) if caps.get("images") else 0
+			usable = context - min(max_output, context) - _PROMPT_OVERHEAD_TOKENS - image_room
+			# The floor must itself fit next to the prompt overhead and the minimum output
+			floor = min(_MIN_SECTION_CHARS, int((context - _MIN_OUTPUT_TOKENS - _PROMPT_OVERHEAD_TOKENS) * _CHARS_PER_TOKEN))
+			chars = max(floor, int(usable * _CHARS_PER_TOKEN), 1)
+			# Small contexts cannot fit a full max_output next to a floor-sized prompt
+			out_room = max(_MIN_OUTPUT_TOKENS, context - _PROMPT_OVERHEAD_TOKENS - int(chars / _CHARS_PER_TOKEN))
+			budget = int(min(max_output, out_room) * _OUTPUT_HEADROOM)
+		else:
+			chars = MAX_SECTION_CHARS_DEFAULT
+			budget = min(OUTPUT_TOKEN_BUDGET_DEFAULT, int(max_output * _OUTPUT_HEADROOM))
+		max_chars = chars if max_chars is None else min(max_chars, chars)
+		output_budget = budget if output_budget is None else min(output_budget, budget)
+	if OUTPUT_TOKEN_BUDGET_DEFAULT <= 0:
+		output_budget = 0
+	return {
+		"max_images": max_images,
+		"max_section_chars": MAX_SECTION_CHARS_DEFAULT if max_chars is None else max_chars,
+		"max_output_tokens": OUTPUT_TOKEN_BUDGET_DEFAULT if output_budget is None else output_budget,
+	}
+
+
+__all__ = [
+	"PromptTooLarge",
+	"get_model_capabilities",
+	"record_model_throughput",
+	"estimate_message_tokens",
+	"plan_request",
+	"batch_limits_for_models",
+]
@@ -0,0 +1,187 @@
+"""Output-size estimates for batch planning, calibrated from past jobs.
+
+Each section's expected CSV rows are predicted from simple features
+(requirement bullets, table rows, images, sub-headings, text length), then
+scaled by a correction factor and tokens-per-row learned from finished
+batches. Calibration lives in ``OUTPUT_CALIBRATION_PATH``
+(data/calibration/output_model.json by default).
+"""
+
+from __future__ import annotations
+
+import json
+import re
+import threading
+from typing import Any, Dict, List, Sequence
+
+from backend.config import OUTPUT_CALIBRATION_PATH
+
+from .compaction import estimate_text_tokens
+
+
+CALIBRATION_PATH = OUTPUT_CALIBRATION_PATH
+
+# Rows per feature before calibration; tuned on typical PRDs
+_ROW_WEIGHTS = {
+	"base": 1.0,
+	"bullets": 0.8,
+	"table_rows": 0.5,
+	"images": 1.0,
+	"headings": 1.0,
+	"per_1k_tokens": 2.0,
+}
+_DEFAULT_MODEL = {"row_factor": 1.0, "tokens_per_row": 80.0, "samples": 0}
+# CSV header plus slack for the model's framing
+OUTPUT_OVERHEAD_TOKENS = 40
+_EMA_ALPHA = 0.2
+
+_BULLET_PATTERN = re.compile(r"^\s*(?:[-*+]|\d+[.)、])\s*\S", re.MULTILINE)
+_TABLE_ROW_PATTERN = re.compile(r"^\s*\|(?!\s*:?-+:?\s*\|)", re.MULTILINE)
+_HEADING_PATTERN = re.compile(r"^#{3,6}\s", re.MULTILINE)
+
+_LOCK = threading.Lock()
+_MODEL: Dict[str, Any] | None = None
+
+
+def _load_model() -> Dict[str, Any]:
+	global _MODEL
+	if _MODEL is None:
+		model = dict(_DEFAULT_MODEL)
+		try:
+			with CALIBRATION_PATH.open("r", encoding="utf-8") as f:
+				model.update(json.load(f))
+		except (OSError, ValueError):
+			pass
+		_MODEL = model
+	return _MODEL
+
+
+def output_model() -> Dict[str, Any]:
+	"""Current calibration (``row_factor``, ``tokens_per_row``, ``samples``)."""
+
+	with _LOCK:
+		return dict(_load_model())
+
+
+def output_model_version() -> tuple:
+	"""Coarse calibration fingerprint, so memoized plans refresh when it moves."""
+
+	model = output_model()
+	return (round(model["row_factor"], 1), int(model["tokens_per_row"] // 10))
+
+
+def section_features(section: Dict) -> Dict[str, int]:
+	text = section.get("text", "")
+	return {
+		"bullets": len(_BULLET_PATTERN.findall(text)),
+		"table_rows": len(_TABLE_ROW_PATTERN.findall(text)),
+		"images": len(section.get("images", [])),
+		"headings": len(_HEADING_PATTERN.findall(text)),
+		"tokens": estimate_text_tokens(text),
+	}
+
+
+def predict_section_rows(section: Dict, model: Dict[str, Any] | None = None) -> float:
+	model = model or output_model()
+	f = section_features(section)
+	rows = (
+		_ROW_WEIGHTS["base"]
+		+ _ROW_WEIGHTS["bullets"] * f["bullets"]
+		+ _ROW_WEIGHTS["table_rows"] * f["table_rows"]
+		+ _ROW_WEIGHTS["images"] * f["images"]
+		+ _ROW_WEIGHTS["headings"] * f["headings"]
+		+ _ROW_WEIGHTS["per_1k_tokens"] * f["tokens"] / 1000.0
+	)
+	return rows * float(model["row_factor"])
+
+
+def predict_section_output_tokens(section: Dict, model: Dict[str, Any] | None = None) -> int:
+	"""Expected CSV output tokens for one section (without the per-call overhead)."""
+
+	model = model or output_model()
+	return int(predict_section_rows(section, model) * float(model["tokens_per_row"]))
+
+
+def predict_batch_output_tokens(sections: Sequence[Dict]) -> int:
+	model = output_model()
+	return OUTPUT_OVERHEAD_TOKENS + sum(predict_section_output_tokens(s, model) for s in sections)
+
+
+def _csv_rows(text: str) -> int:
+	lines = [ln for ln in text.replace("\r\n", "\n").split("\n") if ln.strip()]
+	return max(0, len(lines) - 1)
+
+
+def record_output_usage(batches: List[Dict], responses: Sequence[str], *, max_tokens: int = 4096) -> Dict[str, Any]:
+	"""Store predicted vs actual output per batch and fold the results into the calibration.
+
+	Sets ``batch["output_tokens"] = {"predicted", "actual", "rows", "truncated"}``.
+	``actual`` is the provider's ``completion_tokens`` from ``batch["usage"]``
+	(``call_model_with_retries(usage=...)``), estimated from the text when the
+	provider reports none. A batch is truncated when its reply stopped at the
+	output limit (``usage["truncated"]``); without usage it falls back to
+	comparing against ``max_tokens``. Empty and truncated responses are
+	reported but not learned from. Returns a summary for job meta.
+	"""
+
+	per_batch: List[Dict[str, int]] = []
+	learn_rows = learn_pred_rows = learn_tokens = 0.0
+	model = output_model()
+	for batch, resp in zip(batches, responses):
+		provider = batch.get("usage") or {}
+		actual = int(provider.get("completion_tokens") or 0) or estimate_text_tokens(resp or "")
+		if "truncated" in provider:
+			truncated = int(provider["truncated"]) > 0
+		else:
+			truncated = actual >= 0.97 * max_tokens
+		rows = _csv_rows(resp or "")
+		predicted = int(batch.get("predicted_output_tokens") or 0)
+		if predicted <= OUTPUT_OVERHEAD_TOKENS:
+			# Planned without an output budget: predict now for the record
+			predicted = predict_batch_output_tokens(batch["sections"])
+		usage = {"predicted": predicted, "actual": actual, "rows": rows, "truncated": int(truncated)}
+		batch["output_tokens"] = usage
+		per_batch.append(usage)
+		if rows > 0 and not truncated:
+			learn_rows += rows
+			learn_pred_rows += sum(predict_section_rows(s, model) for s in batch["sections"])
+			learn_tokens += actual
+
+	if learn_rows > 0 and learn_pred_rows > 0:
+		with _LOCK:
+			current = _load_model()
+			a = _EMA_ALPHA
+			target = current["row_factor"] * (learn_rows / learn_pred_rows)
+			# Clamp so one odd job cannot swing the planner too far
+			current["row_factor"] = min(5.0, max(0.2, (1 - a) * current["row_factor"] + a * target))
+			current["tokens_per_row"] = (1 - a) * current["tokens_per_row"] + a * (learn_tokens / learn_rows)
+			current["samples"] = int(current.get("samples", 0)) + 1
+			try:
+				CALIBRATION_PATH.parent.mkdir(parents=True, exist_ok=True)
+				with CALIBRATION_PATH.open("w", encoding="utf-8") as f:
+					json.dump(current, f)
+			except OSError as exc:
+				print(f"保存输出规模校准失败: {exc}")
+
+	predicted_total = sum(p["predicted"] for p in per_batch)
+	actual_total = sum(p["actual"] for p in per_batch)
+	return {
+		"predicted": predicted_total,
+		"actual": actual_total,
+		"truncated_batches": sum(p["truncated"] for p in per_batch),
+		"per_batch": per_batch,
+		"calibration": output_model(),
+	}
+
+
+__all__ = [
+	"CALIBRATION_PATH",
+	"OUTPUT_OVERHEAD_TOKENS",
+	"output_model",
+	"output_model_version",
+	"section_features",
+	"predict_section_rows",
+	"predict_section_output_tokens",
+	"predict_batch_output_tokens",
+	"record_output_usage",
+]
@@ -2,93 +2,332 @@
 
 from __future__ import annotations
 
-from typing import Dict, List, Tuple
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+import hashlib
+import io
+import json
 import re
+import threading
 
 from backend.config import (
 	MAX_IMAGES_PER_BATCH_DEFAULT,
 	MAX_SECTION_CHARS_DEFAULT,
+	BATCH_PLANNER_DEFAULT,
+	BATCH_LOCALITY_WINDOW_DEFAULT,
+	PARSE_CACHE_MAX_ENTRIES_DEFAULT,
+	PARSE_CACHE_MAX_MB_DEFAULT,
+	OUTPUT_TOKEN_BUDGET_DEFAULT,
 )
 
+from .output_budget import (
+	OUTPUT_OVERHEAD_TOKENS,
+	output_model,
+	output_model_version,
+	predict_section_output_tokens,
+)
+
+
+_IMAGE_PATTERN = re.compile(r"!\[.*?\]\((.*?)\)")
+
 
 def extract_images_from_markdown(markdown_text: str) -> List[Tuple[str, int]]:
 	"""Return all image URLs with their position in the markdown."""
 
-	pattern = r"!\[.*?\]\((.*?)\)"
 	matches: List[Tuple[str, int]] = []
-	for match in re.finditer(pattern, markdown_text):
+	for match in _IMAGE_PATTERN.finditer(markdown_text):
 		url = match.group(1).strip()
 		if url:
 			matches.append((url, match.start()))
 	return matches
 
 
-def parse_prd_sections(markdown_text: str) -> List[Dict]:
-	"""Split markdown into sections and attach images to each section."""
+def _iter_lines(markdown: str | Iterable[str]) -> Iterator[str]:
+	if isinstance(markdown, str):
+		return iter(io.StringIO(markdown))
+	return iter(markdown)
+
+
+_SUBHEADING_PATTERN = re.compile(r"^(#{3,6})\s+(.*)$")
+_LIST_ITEM_PATTERN = re.compile(r"^\s*(?:[-*+]|\d+[.)])\s")
+
+
+def parse_prd_sections(markdown_text: str | Iterable[str]) -> List[Dict]:
+	"""Split markdown into sections and attach images to each section.
+
+	Single pass over an iterator of lines (a string or e.g. an open file):
+	section text is collected in list buffers, images are attached to the
+	section they appear in, and character offsets are tracked as lines are
+	consumed. Sections with no text are dropped together with their images.
+
+	Sections are cut at ``#``/``##`` headings. The rest of the heading tree is
+	kept too: ``path`` holds the section's heading path (``#`` parent first)
+	and ``subsections`` lists the ``###``-``######`` headings inside it as
+	``{"title", "level", "start", "end"}`` spans of ``text``, which the batch
+	planner uses to split oversized sections.
+	"""
 
 	sections: List[Dict] = []
-	lines = markdown_text.split('\n')
 
-	current_section = {"title": "前言", "text": "", "images": [], "start_pos": 0, "end_pos": 0}
+	title = "前言"
+	level = 1
+	h1_title: str | None = None
+	buf: List[str] = []
+	buf_len = 0
+	subsections: List[Dict] = []
+	images: List[str] = []
+	start_pos = 0
 	current_pos = 0
+	# An input ending in a newline (or empty) has a trailing empty line
+	trailing_empty_line = True
 
-	for line in lines:
+	def flush(end_pos: int) -> None:
+		raw_text = "".join(buf)
+		text = raw_text.strip()
+		if text:
+			lead = len(raw_text) - len(raw_text.lstrip())
+			spans: List[Dict] = []
+			for i, sub in enumerate(subsections):
+				end = buf_len
+				for nxt in subsections[i + 1:]:
+					if nxt["level"] <= sub["level"]:
+						end = nxt["start"]
+						break
+				spans.append({
+					"title": sub["title"],
+					"level": sub["level"],
+					"start": max(0, sub["start"] - lead),
+					"end": min(len(text), max(0, end - lead)),
+				})
+			path = [h1_title, title] if level == 2 and h1_title else [title]
+			sections.append({
+				"title": title,
+				"text": text,
+				"images": images,
+				"start_pos": start_pos,
+				"end_pos": end_pos,
+				"path": path,
+				"subsections": spans,
+			})
+
+	for raw in _iter_lines(markdown_text):
+		trailing_empty_line = raw.endswith("\n")
+		line = raw[:-1] if trailing_empty_line else raw
 		line_len = len(line) + 1  # include newline
 
-		if line.startswith('# ') or line.startswith('## '):
-			if current_section["text"].strip():
-				current_section["end_pos"] = current_pos
-				current_section["text"] = current_section["text"].strip()
-				sections.append(current_section)
-
-			title = line.lstrip('#').strip()
-			current_section = {
-				"title": title or "无标题章节",
-				"text": "",
-				"images": [],
-				"start_pos": current_pos,
-				"end_pos": 0,
-			}
+		if line.startswith("# ") or line.startswith("## "):
+			flush(current_pos)
+			title = line.lstrip("#").strip() or "无标题章节"
+			level = 1 if line.startswith("# ") else 2
+			if level == 1:
+				h1_title = title
+			buf = []
+			buf_len = 0
+			subsections = []
+			images = []
+			start_pos = current_pos
 		else:
-			current_section["text"] += line + '\n'
+			if line.startswith("###"):
+				m = _SUBHEADING_PATTERN.match(line)
+				if m:
+					subsections.append({
+						"title": m.group(2).strip("# ").strip() or "无标题章节",
+						"level": len(m.group(1)),
+						"start": buf_len,
+					})
+			buf.append(line)
+			buf.append("\n")
+			buf_len += line_len
+
+		if "![" in line:
+			for match in _IMAGE_PATTERN.finditer(line):
+				url = match.group(1).strip()
+				if url:
+					images.append(url)
 
 		current_pos += line_len
 
-	if current_section["text"].strip():
-		current_section["end_pos"] = current_pos
-		current_section["text"] = current_section["text"].strip()
-		sections.append(current_section)
+	if trailing_empty_line:
+		current_pos += 1
+	flush(current_pos)
+	return sections
 
-	all_images = extract_images_from_markdown(markdown_text)
-	for section in sections:
-		section["images"] = [
-			img_url for img_url, pos in all_images if section["start_pos"] <= pos < section["end_pos"]
-		]
 
-	return sections
+def _pack_units(units: List[str], max_chars: int) -> List[str]:
+	"""Greedily join consecutive text units into chunks of at most ``max_chars``."""
 
+	chunks: List[str] = []
+	cur: List[str] = []
+	cur_len = 0
+	for unit in units:
+		if cur and cur_len + len(unit) > max_chars:
+			chunks.append("".join(cur))
+			cur, cur_len = [], 0
+		cur.append(unit)
+		cur_len += len(unit)
+	if cur:
+		chunks.append("".join(cur))
+	return chunks
 
-def create_batches_from_sections(
+
+def _split_paragraphs(text: str, max_chars: int) -> List[str]:
+	"""Split text at paragraph, then list-item, then line boundaries; hard-cut only as a last resort."""
+
+	units: List[str] = []
+	paragraph: List[str] = []
+	for line in text.splitlines(keepends=True):
+		paragraph.append(line)
+		if not line.strip():
+			units.append("".join(paragraph))
+			paragraph = []
+	if paragraph:
+		units.append("".join(paragraph))
+
+	fine: List[str] = []
+	for unit in units:
+		if len(unit) <= max_chars:
+			fine.append(unit)
+			continue
+		items: List[str] = []
+		cur: List[str] = []
+		for line in unit.splitlines(keepends=True):
+			if cur and _LIST_ITEM_PATTERN.match(line):
+				items.append("".join(cur))
+				cur = []
+			cur.append(line)
+		if cur:
+			items.append("".join(cur))
+		for item in items:
+			if len(item) <= max_chars:
+				fine.append(item)
+				continue
+			for line in item.splitlines(keepends=True):
+				for i in range(0, len(line), max_chars):
+					fine.append(line[i:i + max_chars])
+
+	chunks = [c.strip() for c in _pack_units(fine, max_chars)]
+	return [c for c in chunks if c]
+
+
+def _split_text_pieces(path: List[str], text: str, subsections: List[Dict], max_chars: int) -> List[Tuple[List[str], str]]:
+	"""Recursively split by the shallowest subsection level, then by paragraphs."""
+
+	if len(text) <= max_chars:
+		return [(path, text)] if text.strip() else []
+
+	if subsections:
+		top = min(sub["level"] for sub in subsections)
+		cuts = [sub for sub in subsections if sub["level"] == top]
+		pieces: List[Tuple[List[str], str, List[Dict]]] = []
+		if cuts[0]["start"] > 0:
+			pieces.append((path, text[:cuts[0]["start"]], []))
+		for k, cut in enumerate(cuts):
+			start = cut["start"]
+			end = cuts[k + 1]["start"] if k + 1 < len(cuts) else len(text)
+			nested = [
+				{**sub, "start": sub["start"] - start, "end": min(sub["end"], end) - start}
+				for sub in subsections
+				if start < sub["start"] < end and sub["level"] > top
+			]
+			pieces.append((path + [cut["title"]], text[start:end], nested))
+		result: List[Tuple[List[str], str]] = []
+		for p_path, p_text, p_subs in pieces:
+			result.extend(_split_text_pieces(p_path, p_text.rstrip(), p_subs, max_chars))
+		return result
+
+	return [(path, part) for part in _split_paragraphs(text, max_chars)]
+
+
+def split_oversized_section(section: Dict, max_chars: int = MAX_SECTION_CHARS_DEFAULT) -> List[Dict]:
+	"""Split a section longer than ``max_chars`` into pieces that each fit.
+
+	Descends into ``###``-``######`` subsections first, then falls back to
+	paragraph/list boundaries. Each piece's title carries its heading path
+	(``父章节 > 子章节``) so the model keeps the context, and each image goes
+	with the piece whose text contains it.
+	"""
+
+	text = section.get("text", "")
+	if max_chars <= 0 or len(text) <= max_chars:
+		return [section]
+
+	title = section.get("title", "无标题章节")
+	path = list(section.get("path") or [title])
+	raw_pieces = _split_text_pieces(path, text, section.get("subsections") or [], max_chars)
+
+	# Count how often each piece path occurs so paragraph parts can be numbered
+	totals: Dict[Tuple[str, ...], int] = {}
+	for p_path, _ in raw_pieces:
+		totals[tuple(p_path)] = totals.get(tuple(p_path), 0) + 1
+
+	remaining = list(section.get("images", []))
+	pieces: List[Dict] = []
+	seen: Dict[Tuple[str, ...], int] = {}
+	for p_path, p_text in raw_pieces:
+		key = tuple(p_path)
+		seen[key] = seen.get(key, 0) + 1
+		p_title = " > ".join(p_path)
+		if totals[key] > 1:
+			p_title += f"（{seen[key]}/{totals[key]}）"
+		p_images: List[str] = []
+		if "![" in p_text:
+			for url, _ in extract_images_from_markdown(p_text):
+				if url in remaining:
+					remaining.remove(url)
+					p_images.append(url)
+		pieces.append({
+			"title": p_title,
+			"text": p_text,
+			"images": p_images,
+			"start_pos": section.get("start_pos", 0),
+			"end_pos": section.get("end_pos", 0),
+			"path": list(p_path),
+		})
+
+	if not pieces:
+		return [section]
+	# Images not found in any piece's text (e.g. in the heading line) stay with the first piece
+	pieces[0]["images"] = remaining + pieces[0]["images"]
+	# Pre-planning image dedup (prune_section_images): aliases on every piece, records once
+	if section.get("image_aliases"):
+		for piece in pieces:
+			piece["image_aliases"] = section["image_aliases"]
+	if section.get("merged_images"):
+		pieces[0]["merged_images"] = section["merged_images"]
+	return pieces
+
+
+def _expand_sections(
 	sections: List[Dict],
-	max_images: int = MAX_IMAGES_PER_BATCH_DEFAULT,
-	max_section_chars: int = MAX_SECTION_CHARS_DEFAULT,
+	max_images: int,
+	max_section_chars: int,
+	max_output_tokens: int = 0,
 ) -> List[Dict]:
-	"""Group sections into batches respecting image and text thresholds.
+	"""Split sections so each fits the text budget, the image cap and the output budget on its own."""
 
-	Notes:
-	- Enforces the image cap strictly: if a single section contains more
-	  images than ``max_images``, the section will be split into multiple
-	  pseudo-sections, each carrying the same text but only a slice of the
-	  image URLs so that no batch ever exceeds the cap due to one large section.
-	"""
+	text_fitted: List[Dict] = []
+	for section in sections:
+		text_fitted.extend(split_oversized_section(section, max_section_chars))
 
-	if max_images <= 0:
-		max_images = MAX_IMAGES_PER_BATCH_DEFAULT
+	if max_output_tokens > 0:
+		# Dense sections would overflow the model's output even when alone in a batch:
+		# cut them into proportionally smaller pieces along the same boundaries
+		output_fitted: List[Dict] = []
+		model = output_model()
+		for section in text_fitted:
+			predicted = predict_section_output_tokens(section, model) + OUTPUT_OVERHEAD_TOKENS
+			text_len = len(section.get("text", ""))
+			if predicted <= max_output_tokens or text_len < 400:
+				output_fitted.append(section)
+				continue
+			limit = max(200, int(text_len * max_output_tokens / predicted * 0.9))
+			output_fitted.extend(split_oversized_section(section, limit))
+		text_fitted = output_fitted
 
 	# Expand sections so that any section with too many images is split
 	# into multiple smaller pseudo-sections with sliced image arrays.
 	expanded_sections: List[Dict] = []
-	for section in sections:
+	for section in text_fitted:
 		images = list(section.get("images", []))
 		if len(images) <= max_images or not images:
 			expanded_sections.append(section)
@@ -99,6 +338,8 @@ def create_batches_from_sections(
 			chunk_imgs = images[i : i + max_images]
 			expanded_sections.append(
 				{
+					# keep any extra keys callers attached (e.g. diff context)
+					**section,
 					"title": section.get("title", "无标题章节"),
 					"text": section.get("text", ""),
 					"images": chunk_imgs,
@@ -107,24 +348,51 @@ def create_batches_from_sections(
 					"end_pos": section.get("end_pos", 0),
 				}
 			)
+	return expanded_sections
 
+
+def _new_batch() -> Dict:
+	return {"sections": [], "total_images": 0, "total_chars": 0, "predicted_output_tokens": OUTPUT_OVERHEAD_TOKENS}
+
+
+def _add_to_batch(batch: Dict, section: Dict, output_tokens: int = 0) -> None:
+	batch["sections"].append(section)
+	batch["total_images"] += len(section.get("images", []))
+	batch["total_chars"] += len(section.get("text", ""))
+	batch["predicted_output_tokens"] += output_tokens
+
+
+def _output_costs(sections: List[Dict], max_output_tokens: int) -> List[int]:
+	if max_output_tokens <= 0:
+		return [0] * len(sections)
+	model = output_model()
+	return [predict_section_output_tokens(s, model) for s in sections]
+
+
+def _pack_greedy(
+	sections: List[Dict],
+	max_images: int,
+	max_section_chars: int,
+	max_output_tokens: int = 0,
+) -> List[Dict]:
 	batches: List[Dict] = []
-	current_batch = {"sections": [], "total_images": 0, "total_chars": 0}
+	current_batch = _new_batch()
+	outs = _output_costs(sections, max_output_tokens)
+	output_cap = max_output_tokens if max_output_tokens > 0 else float("inf")
 
-	for section in expanded_sections:
+	for section, section_out in zip(sections, outs):
 		section_images = len(section.get("images", []))
 		section_chars = len(section.get("text", ""))
 
 		if current_batch["sections"] and (
 			current_batch["total_images"] + section_images > max_images
 			or current_batch["total_chars"] + section_chars > max_section_chars
+			or current_batch["predicted_output_tokens"] + section_out > output_cap
 		):
 			batches.append(current_batch)
-			current_batch = {"sections": [], "total_images": 0, "total_chars": 0}
+			current_batch = _new_batch()
 
-		current_batch["sections"].append(section)
-		current_batch["total_images"] += section_images
-		current_batch["total_chars"] += section_chars
+		_add_to_batch(current_batch, section, section_out)
 
 	if current_batch["sections"]:
 		batches.append(current_batch)
@@ -132,8 +400,360 @@ def create_batches_from_sections(
 	return batches
 
 
+def _pack_binpack(
+	sections: List[Dict],
+	max_images: int,
+	max_section_chars: int,
+	window: int,
+	max_output_tokens: int = 0,
+) -> List[Dict]:
+	"""First-fit-decreasing by (chars, images, output) cost with a locality window.
+
+	A section may only join a batch whose sections all lie within ``window``
+	positions of it, so related content stays together. Sections inside a
+	batch, and the batches themselves, are returned in document order.
+	"""
+
+	n = len(sections)
+	chars = [len(sec.get("text", "")) for sec in sections]
+	imgs = [len(sec.get("images", [])) for sec in sections]
+	outs = _output_costs(sections, max_output_tokens)
+	output_cap = max_output_tokens - OUTPUT_OVERHEAD_TOKENS if max_output_tokens > 0 else float("inf")
+
+	def cost(i: int) -> float:
+		return max(
+			chars[i] / max(1, max_section_chars),
+			imgs[i] / max(1, max_images),
+			outs[i] / output_cap if max_output_tokens > 0 else 0.0,
+		)
+
+	# bins: [member indices, chars, images, lowest index, highest index, output tokens]
+	bins: List[List[Any]] = []
+	bin_of: Dict[int, int] = {}
+	for i in sorted(range(n), key=lambda k: (-cost(k), k)):
+		candidates = sorted({bin_of[j] for j in range(i - window, i + window + 1) if j in bin_of})
+		placed = False
+		for b in candidates:
+			members, b_chars, b_imgs, lo, hi, b_out = bins[b]
+			if (
+				b_chars + chars[i] <= max_section_chars
+				and b_imgs + imgs[i] <= max_images
+				and b_out + outs[i] <= output_cap
+				and max(hi, i) - min(lo, i) <= window
+			):
+				members.append(i)
+				bins[b] = [members, b_chars + chars[i], b_imgs + imgs[i], min(lo, i), max(hi, i), b_out + outs[i]]
+				bin_of[i] = b
+				placed = True
+				break
+		if not placed:
+			bin_of[i] = len(bins)
+			bins.append([[i], chars[i], imgs[i], i, i, outs[i]])
+
+	batches: List[Dict] = []
+	for members, *_ in sorted(bins, key=lambda b: b[3]):
+		batch = _new_batch()
+		for i in sorted(members):
+			_add_to_batch(batch, sections[i], outs[i])
+		batches.append(batch)
+	return batches
+
+
+def create_batches_from_sections(
+	sections: List[Dict],
+	max_images: int = MAX_IMAGES_PER_BATCH_DEFAULT,
+	max_section_chars: int = MAX_SECTION_CHARS_DEFAULT,
+	*,
+	planner: str = BATCH_PLANNER_DEFAULT,
+	locality_window: int = BATCH_LOCALITY_WINDOW_DEFAULT,
+	max_output_tokens: int = OUTPUT_TOKEN_BUDGET_DEFAULT,
+	split_by_modality: bool = False,
+	text_max_section_chars: int = 0,
+	text_max_output_tokens: int | None = None,
+) -> List[Dict]:
+	"""Group sections into batches respecting image and text thresholds.
+
+	Notes:
+	- Enforces the text budget: a section longer than ``max_section_chars`` is
+	  first split along its subsection headings, then at paragraph/list
+	  boundaries (see ``split_oversized_section``), so no batch exceeds it.
+	- Enforces the image cap strictly: if a single section contains more
+	  images than ``max_images``, the section will be split into multiple
+	  pseudo-sections, each carrying the same text but only a slice of the
+	  image URLs so that no batch ever exceeds the cap due to one large section.
+	- With ``max_output_tokens`` > 0, the predicted CSV output of each batch
+	  (see ``output_budget``) is kept under it as well, so dense batches are not
+	  truncated by the model's output limit; the prediction is stored in
+	  ``batch["predicted_output_tokens"]``.
+	- ``planner="greedy"`` fills batches sequentially; ``planner="binpack"``
+	  packs first-fit-decreasing within ``locality_window`` sections, which
+	  usually needs fewer batches (falls back to greedy when it does not). Both return batches in document order, so
+	  per-batch test-case ID ranges stay stable and ordered.
+	- With ``split_by_modality``, image-free sections are packed into their own
+	  batches (``batch["modality"] = "text"``, free of the image cap) and the
+	  rest into ``"vision"`` batches, so text-only work can go to the text model.
+	  Those text batches use ``text_max_section_chars`` / ``text_max_output_tokens``
+	  (the text model's own limits) when given, instead of the shared ones.
+	"""
+
+	if max_images <= 0:
+		max_images = MAX_IMAGES_PER_BATCH_DEFAULT
+	max_output_tokens = max(0, int(max_output_tokens or 0))
+
+	if split_by_modality:
+		text_chars = int(text_max_section_chars or 0) or max_section_chars
+		text_output = max_output_tokens if text_max_output_tokens is None else max(0, int(text_max_output_tokens))
+		limits = {"vision": (max_section_chars, max_output_tokens), "text": (text_chars, text_output)}
+		expanded_sections = []
+		for section in sections:
+			chars, output = limits["vision" if section.get("images") else "text"]
+			expanded_sections.extend(_expand_sections([section], max_images, chars, output))
+		position = {id(s): i for i, s in enumerate(expanded_sections)}
+		planned: List[Dict] = []
+		for modality, wants_images in (("vision", True), ("text", False)):
+			group = [s for s in expanded_sections if bool(s.get("images")) == wants_images]
+			chars, output = limits[modality]
+			for batch in _plan_group(group, max_images, chars, output, planner, locality_window):
+				batch["modality"] = modality
+				planned.append(batch)
+		# Interleave back into document order by each batch's first section
+		planned.sort(key=lambda b: position[id(b["sections"][0])])
+		return planned
+	expanded_sections = _expand_sections(sections, max_images, max_section_chars, max_output_tokens)
+	return _plan_group(expanded_sections, max_images, max_section_chars, max_output_tokens, planner, locality_window)
+
+
+def _plan_group(
+	expanded_sections: List[Dict],
+	max_images: int,
+	max_section_chars: int,
+	max_output_tokens: int,
+	planner: str,
+	locality_window: int,
+) -> List[Dict]:
+	greedy = _pack_greedy(expanded_sections, max_images, max_section_chars, max_output_tokens)
+	if planner == "binpack":
+		packed = _pack_binpack(
+			expanded_sections, max_images, max_section_chars, max(1, int(locality_window)), max_output_tokens
+		)
+		# A narrow window can fragment more than sequential filling; never do worse
+		if len(packed) < len(greedy):
+			return packed
+	return greedy
+
+
+def batch_plan_stats(
+	batches: List[Dict],
+	max_images: int = MAX_IMAGES_PER_BATCH_DEFAULT,
+	max_section_chars: int = MAX_SECTION_CHARS_DEFAULT,
+	max_output_tokens: int = 0,
+) -> Dict[str, Any]:
+	"""Batch count and mean fill ratio (binding dimension of each batch, 0-1)."""
+
+	if not batches:
+		return {"batches": 0, "fill_ratio": 0.0}
+	fills = [
+		min(
+			1.0,
+			max(
+				b["total_chars"] / max(1, max_section_chars),
+				b["total_images"] / max(1, max_images),
+				b.get("predicted_output_tokens", 0) / max_output_tokens if max_output_tokens > 0 else 0.0,
+			),
+		)
+		for b in batches
+	]
+	return {"batches": len(batches), "fill_ratio": round(sum(fills) / len(fills), 3)}
+
+
+def compare_batch_planners(
+	sections: List[Dict],
+	max_images: int = MAX_IMAGES_PER_BATCH_DEFAULT,
+	max_section_chars: int = MAX_SECTION_CHARS_DEFAULT,
+	*,
+	planner: str = BATCH_PLANNER_DEFAULT,
+	locality_window: int = BATCH_LOCALITY_WINDOW_DEFAULT,
+	max_output_tokens: int = OUTPUT_TOKEN_BUDGET_DEFAULT,
+	split_by_modality: bool = False,
+	text_max_section_chars: int = 0,
+	text_max_output_tokens: int | None = None,
+	batches: List[Dict] | None = None,
+) -> Dict[str, Any]:
+	"""Stats for ``planner`` next to the greedy baseline, for job meta.
+
+	``batches`` is the plan already made for ``planner`` with these limits
+	(e.g. by ``plan_prd_batches``); it is reused, so only the greedy baseline
+	is planned here, and nothing when ``planner`` is greedy itself.
+	"""
+
+	if max_images <= 0:
+		max_images = MAX_IMAGES_PER_BATCH_DEFAULT
+	max_output_tokens = max(0, int(max_output_tokens or 0))
+
+	def plan(name: str) -> List[Dict]:
+		return create_batches_from_sections(
+			sections,
+			max_images,
+			max_section_chars,
+			planner=name,
+			locality_window=locality_window,
+			max_output_tokens=max_output_tokens,
+			split_by_modality=split_by_modality,
+			text_max_section_chars=text_max_section_chars,
+			text_max_output_tokens=text_max_output_tokens,
+		)
+
+	chosen_batches = batches if batches is not None else plan(planner)
+	greedy_batches = chosen_batches if planner == "greedy" else plan("greedy")
+	chosen = batch_plan_stats(chosen_batches, max_images, max_section_chars, max_output_tokens)
+	greedy = batch_plan_stats(greedy_batches, max_images, max_section_chars, max_output_tokens)
+	return {
+		"planner": planner,
+		**chosen,
+		"greedy_batches": greedy["batches"],
+		"greedy_fill_ratio": greedy["fill_ratio"],
+		"calls_saved": greedy["batches"] - chosen["batches"],
+		"max_output_tokens": max_output_tokens,
+		"predicted_output_tokens": sum(b["predicted_output_tokens"] for b in chosen_batches),
+		"text_batches": sum(1 for b in chosen_batches if b.get("modality") == "text"),
+	}
+
+
+# --- Memoized parse / batch plan ---
+
+# Bump whenever parse_prd_sections or the planners change their output
+PARSER_VERSION = "3"
+
+_MEMO: "OrderedDict[Tuple, Tuple[Any, int]]" = OrderedDict()
+_MEMO_LOCK = threading.Lock()
+_MEMO_STATS = {"hits": 0, "misses": 0, "bytes": 0}
+
+
+def _memo_get(key: Tuple) -> Any:
+	with _MEMO_LOCK:
+		entry = _MEMO.get(key)
+		if entry is None:
+			_MEMO_STATS["misses"] += 1
+			return None
+		_MEMO.move_to_end(key)
+		_MEMO_STATS["hits"] += 1
+		return entry[0]
+
+
+def _memo_put(key: Tuple, value: Any, weight: int) -> None:
+	max_bytes = PARSE_CACHE_MAX_MB_DEFAULT * 1024 * 1024
+	if PARSE_CACHE_MAX_ENTRIES_DEFAULT <= 0 or weight > max_bytes:
+		return
+	with _MEMO_LOCK:
+		old = _MEMO.pop(key, None)
+		if old is not None:
+			_MEMO_STATS["bytes"] -= old[1]
+		_MEMO[key] = (value, weight)
+		_MEMO_STATS["bytes"] += weight
+		while _MEMO and (len(_MEMO) > PARSE_CACHE_MAX_ENTRIES_DEFAULT or _MEMO_STATS["bytes"] > max_bytes):
+			_, (_, w) = _MEMO.popitem(last=False)
+			_MEMO_STATS["bytes"] -= w
+
+
+def _copy_section(section: Dict) -> Dict:
+	# Callers prune/rewrite image lists in place; never hand out the cached ones
+	return {**section, "images": list(section.get("images", []))}
+
+
+def _copy_batches(batches: List[Dict]) -> List[Dict]:
+	return [{**b, "sections": [_copy_section(s) for s in b["sections"]]} for b in batches]
+
+
+def parse_prd_sections_cached(markdown_text: str) -> List[Dict]:
+	"""``parse_prd_sections`` memoized by (content hash, parser version)."""
+
+	weight = len(markdown_text.encode("utf-8"))
+	key = ("sections", hashlib.sha256(markdown_text.encode("utf-8")).hexdigest(), PARSER_VERSION)
+	sections = _memo_get(key)
+	if sections is None:
+		sections = parse_prd_sections(markdown_text)
+		_memo_put(key, sections, weight)
+	return [_copy_section(s) for s in sections]
+
+
+def plan_prd_batches(
+	markdown_text: str,
+	max_images: int = MAX_IMAGES_PER_BATCH_DEFAULT,
+	max_section_chars: int = MAX_SECTION_CHARS_DEFAULT,
+	*,
+	planner: str = BATCH_PLANNER_DEFAULT,
+	locality_window: int = BATCH_LOCALITY_WINDOW_DEFAULT,
+	max_output_tokens: int = OUTPUT_TOKEN_BUDGET_DEFAULT,
+	split_by_modality: bool = False,
+	text_max_section_chars: int = 0,
+	text_max_output_tokens: int | None = None,
+	sections: List[Dict] | None = None,
+) -> Tuple[List[Dict], List[Dict]]:
+	"""Parsed sections and their batch plan, memoized by content hash and batch limits.
+
+	Repeat runs on the same PRD (retries, async job after a preview, config
+	tweaks that do not touch the limits) skip both parsing and planning. Fresh
+	copies are returned on every call, so callers may mutate them freely.
+	``sections`` plans already parsed and edited sections instead (e.g. with
+	duplicate images pruned, see ``prune_section_images``); the plan is then
+	also keyed by their image lists.
+	"""
+
+	digest = hashlib.sha256(markdown_text.encode("utf-8")).hexdigest()
+	images_digest = None
+	if sections is not None:
+		images_digest = hashlib.sha256(
+			json.dumps([s.get("images", []) for s in sections]).encode("utf-8")
+		).hexdigest()
+	key = (
+		"plan",
+		digest,
+		PARSER_VERSION,
+		int(max_images),
+		int(max_section_chars),
+		planner,
+		int(locality_window),
+		int(max_output_tokens or 0),
+		output_model_version() if max_output_tokens else None,
+		bool(split_by_modality),
+		int(text_max_section_chars or 0) if split_by_modality else 0,
+		text_max_output_tokens if split_by_modality else None,
+		images_digest,
+	)
+	batches = _memo_get(key)
+	if batches is None:
+		batches = create_batches_from_sections(
+			sections if sections is not None else parse_prd_sections_cached(markdown_text),
+			max_images,
+			max_section_chars,
+			planner=planner,
+			locality_window=locality_window,
+			max_output_tokens=max_output_tokens,
+			split_by_modality=split_by_modality,
+			text_max_section_chars=text_max_section_chars,
+			text_max_output_tokens=text_max_output_tokens,
+		)
+		# The plan holds roughly one more copy of the text
+		_memo_put(key, batches, len(markdown_text.encode("utf-8")))
+	if sections is None:
+		sections = parse_prd_sections_cached(markdown_text)
+	return sections, _copy_batches(batches)
+
+
+def parse_cache_stats() -> Dict[str, int]:
+	with _MEMO_LOCK:
+		return {**_MEMO_STATS, "entries": len(_MEMO)}
+
+
 __all__ = [
 	"extract_images_from_markdown",
 	"parse_prd_sections",
+	"split_oversized_section",
 	"create_batches_from_sections",
+	"batch_plan_stats",
+	"compare_batch_planners",
+	"PARSER_VERSION",
+	"parse_prd_sections_cached",
+	"plan_prd_batches",
+	"parse_cache_stats",
 ]
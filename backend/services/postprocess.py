@@ -4,10 +4,13 @@ plus validation utilities for strict CSV enforcement.
 
 from __future__ import annotations
 
-from typing import Iterable, List, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
 import csv
 import re
 import io
+import itertools
+
+from .dedup import dedupe_case_rows
 
 
 def sanitize_table_rows(markdown_text: str) -> str:
@@ -28,50 +31,6 @@ def sanitize_table_rows(markdown_text: str) -> str:
 	return '\n'.join(lines)
 
 
-def deduplicate_test_case_ids(markdown_text: str) -> str:
-	"""Detect duplicate test case IDs and reassign unique identifiers."""
-
-	lines = markdown_text.splitlines()
-	seen_ids = set()
-	result_lines: List[str] = []
-	counter = 1
-
-	id_pattern = re.compile(r'(TC-[A-Z]+-[A-Z]+)-(\d+)')
-
-	for line in lines:
-		if not line.strip().startswith('|'):
-			result_lines.append(line)
-			continue
-
-		cells = [cell.strip() for cell in line.split('|')]
-
-		if len(cells) > 2 and ('用例ID' in cells[1] or ':---' in cells[1]):
-			result_lines.append(line)
-			continue
-
-		if len(cells) > 1 and cells[1]:
-			original_id = cells[1]
-			if original_id.startswith('TC-'):
-				if original_id in seen_ids:
-					match = id_pattern.match(original_id)
-					prefix = match.group(1) if match else 'TC-AUTO'
-
-					new_id = f"{prefix}-{counter:04d}"
-					while new_id in seen_ids:
-						counter += 1
-						new_id = f"{prefix}-{counter:04d}"
-
-					cells[1] = new_id
-					seen_ids.add(new_id)
-				else:
-					seen_ids.add(original_id)
-				counter += 1
-
-		result_lines.append('|'.join(cells))
-
-	return '\n'.join(result_lines)
-
-
 def merge_markdown_tables(responses: Iterable[str]) -> str:
 	"""Combine multiple markdown tables keeping only the first header."""
 
@@ -106,7 +65,6 @@ def merge_markdown_tables(responses: Iterable[str]) -> str:
 
 __all__ = [
 	"sanitize_table_rows",
-	"deduplicate_test_case_ids",
 	"merge_markdown_tables",
 ]
 
@@ -116,8 +74,18 @@ __all__ = [
 def merge_csv_texts(chunks: Iterable[str]) -> str:
 	"""Merge multiple CSV texts keeping the first header only.
 
-	Assumes each chunk is plain CSV text with first line as header.
+	Chunks are parsed into rows (see ``merge_csv_rows``), so quoted cells
+	spanning lines stay intact. When no chunk has a recognizable header the
+	texts are concatenated line by line, dropping each chunk's first line.
 	"""
+	chunks = list(chunks)
+	rows, report = merge_csv_rows(chunks, renumber=False)
+	if report["ok"]:
+		return rows_to_csv(rows)
+	return _concat_csv_texts(chunks)
+
+
+def _concat_csv_texts(chunks: Iterable[str]) -> str:
 	header: str | None = None
 	rows: List[str] = []
 
@@ -157,6 +125,9 @@ EXPECTED_HEADER = [
 ]
 
 
+__all__.append("EXPECTED_HEADER")
+
+
 def _strip_code_fences(text: str) -> str:
 	s = text.strip()
 	if s.startswith("```") and s.endswith("```"):
@@ -167,131 +138,290 @@ def _strip_code_fences(text: str) -> str:
 	return text
 
 
-def validate_strict_csv(csv_text: str) -> Tuple[bool, str]:
-	"""Validate CSV content strictly against EXPECTED_HEADER schema.
+# --- Single-pass CSV normalization ---
+
+def _find_header(line: str) -> str | None:
+	"""Return the delimiter ('，' or ',') if ``line`` is the expected header."""
+
+	if [c.strip() for c in line.split(',')] == EXPECTED_HEADER:
+		return ','
+	if [c.strip() for c in line.split('，')] == EXPECTED_HEADER:
+		return '，'
+	if "用例ID" in line and "用例类型" in line:
+		comma = line.count(',')
+		cncomma = line.count('，')
+		if comma >= 7 or cncomma >= 7:
+			return '，' if cncomma > comma else ','
+	return None
+
+
+def _new_report() -> Dict[str, Any]:
+	return {
+		"ok": False,
+		"reason": "",
+		"rows": 0,
+		"repairs": {
+			"preamble_lines": 0,
+			"fence_lines": 0,
+			"repeated_headers": 0,
+			"blank_rows": 0,
+			"padded": 0,
+			"merged": 0,
+			"missing_header": 0,
+			"commentary": 0,
+			"cn_comma": False,
+		},
+	}
+
+
+def _split_delimiter(line: str) -> str:
+	return '，' if line.count('，') > line.count(',') else ','
+
+
+def _first_data_line(lines: Iterator[str], expected_len: int) -> Tuple[str | None, str | None, int]:
+	"""Find the first line that splits into ``expected_len`` or more cells.
+
+	Returns ``(line, delimiter, skipped)`` where ``skipped`` counts the
+	non-blank lines before it; ``line`` is ``None`` when there is none.
+	"""
 
-	Returns (ok, reason). When ok is False, reason contains a brief message.
+	skipped = 0
+	for line in lines:
+		stripped = line.strip()
+		if not stripped:
+			continue
+		delimiter = _split_delimiter(stripped)
+		if not stripped.startswith("```") and len(next(csv.reader([stripped], delimiter=delimiter))) >= expected_len:
+			return line, delimiter, skipped
+		skipped += 1
+	return None, None, skipped
+
+
+def iter_normalized_csv(
+	csv_text: str,
+	report: Dict[str, Any] | None = None,
+	*,
+	assume_header: bool = False,
+) -> Iterator[Tuple[List[str], str]]:
+	"""Yield repaired 8-column data rows of ``csv_text`` as ``(row, status)`` in one pass.
+
+	Text before the header (code fences, explanations) is skipped, a Chinese-comma
+	header switches the delimiter, fence lines, blank rows and repeated headers
+	are dropped, rows with extra cells have the tail merged into the last cell
+	(status ``"merged"``) and short rows are padded (``"padded"``); others are
+	``"ok"``. Cells are stripped. Quoted cells may span lines.
+
+	With ``assume_header`` a reply that starts straight with data rows (no
+	header line) is read as if it had the canonical header: rows start at the
+	first line with a full set of cells (``missing_header`` repair). Without
+	it, or when no line has enough cells, the text is rejected.
+
+	When ``report`` is given it is filled with the verdict (``ok``/``reason``),
+	the number of rows yielded and per-repair counts once iteration ends.
 	"""
+
+	if report is None:
+		report = {}
+	report.update(_new_report())
+	repairs = report["repairs"]
 	if not csv_text or not csv_text.strip():
-		return False, "输出为空"
+		report["reason"] = "输出为空"
+		return
 
-	csv_text = _strip_code_fences(csv_text)
-	normalized = csv_text.replace("\r\n", "\n").replace("\r", "\n").lstrip("\ufeff")
-	reader = csv.reader(normalized.split("\n"))
+	# newline=None folds \r\n and \r into \n while reading line by line
+	lines = io.StringIO(csv_text.lstrip("\ufeff"), newline=None)
+	delimiter = None
+	for line in lines:
+		delimiter = _find_header(line.strip())
+		if delimiter is not None:
+			break
+		if line.strip():
+			repairs["preamble_lines"] += 1
+	expected_len = len(EXPECTED_HEADER)
+	if delimiter is None and assume_header:
+		lines = io.StringIO(csv_text.lstrip("\ufeff"), newline=None)
+		first, delimiter, skipped = _first_data_line(lines, expected_len)
+		if first is not None:
+			repairs["preamble_lines"] = skipped
+			repairs["missing_header"] = 1
+			lines = itertools.chain([first], lines)
+	if delimiter is None:
+		report["reason"] = "未找到表头：" + ",".join(EXPECTED_HEADER)
+		return
+
+	payload: Iterable[str] = lines
+	if delimiter == '，':
+		repairs["cn_comma"] = True
+		payload = (ln.replace('，', ',') for ln in lines)
+
+	for r in csv.reader(payload):
+		if not any(cell.strip() for cell in r):
+			repairs["blank_rows"] += 1
+			continue
+		if len(r) == 1 and r[0].strip().startswith("```"):
+			repairs["fence_lines"] += 1
+			continue
+		cells = [cell.strip() for cell in r]
+		if cells[:expected_len] == EXPECTED_HEADER:
+			repairs["repeated_headers"] += 1
+			continue
+		status = "ok"
+		if len(cells) > expected_len:
+			cells = cells[: expected_len - 1] + [",".join(r[expected_len - 1:]).strip()]
+			status = "merged"
+		elif len(cells) < expected_len:
+			cells = cells + [""] * (expected_len - len(cells))
+			status = "padded"
+		if status != "ok":
+			repairs[status] += 1
+		report["rows"] += 1
+		yield cells, status
+
+	report["ok"] = report["rows"] > 0
+	if not report["ok"]:
+		report["reason"] = "没有数据行"
+
+
+def normalize_csv(csv_text: str) -> Tuple[str, bool, Dict[str, Any]]:
+	"""Validate and repair ``csv_text`` in a single parse.
+
+	Returns ``(text, ok, report)``: the
+	re-serialized CSV when the result is valid, otherwise the input unchanged,
+	plus the report filled by ``iter_normalized_csv``.
+	"""
 
-	try:
-		rows = list(reader)
-	except Exception as exc:  # noqa: BLE001
-		return False, f"CSV 解析失败: {exc}"
+	report: Dict[str, Any] = {}
+	text = rows_to_csv(row for row, _status in iter_normalized_csv(csv_text, report))
+	if not report["ok"]:
+		return csv_text, False, report
+	return text, True, report
 
-	if not rows:
-		return False, "没有任何行"
 
-	header = [col.strip() for col in rows[0]]
-	if header != EXPECTED_HEADER:
-		return False, (
-			"表头不符合规范，应为：" + ",".join(EXPECTED_HEADER)
-		)
+# --- Row-level batch merge ---
 
-	if len(rows) < 2:
-		return False, "没有数据行"
+_CASE_ID_PATTERN = re.compile(r"^(.*?)-?(\d+)$")
+# 测试项, 操作步骤, 预期结果 must not be empty
+REQUIRED_COLUMNS = (3, 5, 6)
 
-	# Ensure every row has the same number of columns
-	expected_len = len(EXPECTED_HEADER)
-	for idx, r in enumerate(rows[1:], start=2):
-		if len(r) != expected_len:
-			return False, f"第 {idx} 行列数不一致，应为 {expected_len} 列"
 
-	return True, ""
+# An ID starts with an ASCII letter/digit, contains a digit and has no spaces or sentence punctuation
+_CASE_ID_LIKE = re.compile(r"^[A-Za-z0-9][^\s,，。；;：:！!？?]{0,79}$")
+
 
+def looks_like_case_id(cell: str) -> bool:
+	return bool(_CASE_ID_LIKE.match(cell)) and any(ch.isdigit() for ch in cell)
 
-__all__.extend(["validate_strict_csv", "EXPECTED_HEADER"])
 
+def row_is_malformed(row: List[str], status: str) -> bool:
+	"""True for rows that had to be padded/merged or have an empty required field."""
 
-# --- CSV auto-repair (best-effort) ---
+	return status != "ok" or any(not row[i] for i in REQUIRED_COLUMNS)
 
-def coerce_to_strict_csv(csv_text: str) -> str:
-	"""Best-effort repair to produce a valid 8-column CSV.
 
-	Strategy:
-	- Strip surrounding code fences/BOM and normalize newlines
-	- Locate a header line that matches EXPECTED_HEADER either with ',' or '，'
-	- If the header uses Chinese comma, convert delimiters to ',' for the whole text
-	- Parse rows with csv.reader; for each row:
-	  * If len(row) > 8: merge tail into the last cell with commas
-	  * If len(row) < 8: right-pad empty strings
-	  * Skip blank-only lines
-	- Rebuild CSV with the exact expected header
+def row_is_commentary(row: List[str], status: str) -> bool:
+	"""True for prose the model wrote around the table (\"以上为全部用例。\").
 
-	This does not try to be perfect; it aims to avoid trivial 500s caused by
-	model outputs like a trailing explanation line or a stray comma.
+	That is a single-cell row, or a malformed row that does not start with a
+	case ID. Well-formed rows are kept even without an ID (they get one when
+	renumbered).
 	"""
 
-	if not csv_text:
-		return ""
+	if status == "padded" and not any(row[1:]):
+		return True
+	return not looks_like_case_id(row[0]) and row_is_malformed(row, status)
 
-	text = _strip_code_fences(csv_text).lstrip("\ufeff")
-	text = text.replace("\r\n", "\n").replace("\r", "\n")
-	lines = [ln for ln in text.split("\n") if ln.strip() != ""]
-	if not lines:
-		return ""
 
-	# Find header line index and detect delimiter
-	head_idx = -1
-	uses_cn_comma = False
-	for i, ln in enumerate(lines):
-		# Exact English comma header
-		if [c.strip() for c in ln.split(',')] == EXPECTED_HEADER:
-			head_idx = i
-			break
-		# Chinese comma variant
-		if [c.strip() for c in ln.split('，')] == EXPECTED_HEADER:
-			head_idx = i
-			uses_cn_comma = True
-			break
+def renumber_case_ids(rows: List[List[str]]) -> int:
+	"""Give every row a unique ``用例ID`` in place; return how many changed.
 
-	if head_idx == -1:
-		# Try a fuzzy match: line contains most header tokens and at least 7 commas
-		for i, ln in enumerate(lines):
-			comma = ln.count(',')
-			cncomma = ln.count('，')
-			if ("用例ID" in ln and "用例类型" in ln) and (comma >= 7 or cncomma >= 7):
-				head_idx = i
-				uses_cn_comma = cncomma > comma
-				break
-
-	if head_idx == -1:
-		# No recognizable header; nothing we can do safely
-		return csv_text
-
-	payload_lines = lines[head_idx:]
-	joined = "\n".join(payload_lines)
-	if uses_cn_comma:
-		joined = joined.replace('，', ',')
-
-	# Feed to CSV reader and coerce row widths
-	reader = csv.reader(io.StringIO(joined))
-	rows = list(reader)
-	if not rows:
-		return csv_text
+	IDs keep the model's ``TC-[模块]-[功能]`` prefix and get a 4-digit
+	sequence number from the row's position in the merged output, so the
+	result depends only on row order. Rows without an ID get ``TC-AUTO``.
+	"""
 
-	expected_len = len(EXPECTED_HEADER)
-	result_io = io.StringIO()
-	writer = csv.writer(result_io, lineterminator="\r\n")
-	writer.writerow(EXPECTED_HEADER)
+	changed = 0
+	for n, row in enumerate(rows, start=1):
+		old_id = row[0].strip()
+		match = _CASE_ID_PATTERN.match(old_id)
+		prefix = (match.group(1) if match else old_id) or "TC-AUTO"
+		new_id = f"{prefix}-{n:04d}"
+		if new_id != old_id:
+			row[0] = new_id
+			changed += 1
+	return changed
+
+
+def merge_csv_rows(
+	chunks: Iterable[str],
+	*,
+	renumber: bool = True,
+	dedup_threshold: float = 0.0,
+	repair: Callable[[List[List[str]], List[Dict[str, Any]]], Dict[str, Any]] | None = None,
+) -> Tuple[List[List[str]], Dict[str, Any]]:
+	"""Parse each batch's CSV once and merge the rows in batch order.
+
+	Each chunk goes through ``iter_normalized_csv``. Commentary rows
+	(``row_is_commentary``) are dropped; the remaining malformed rows
+	(``row_is_malformed``), which all start with a case ID, are handed to
+	``repair(rows, flagged)`` as ``{"index", "batch", "status"}`` entries to
+	fix in place (see ``repair.make_row_repairer``). A positive
+	``dedup_threshold`` then drops near-duplicate cases
+	(``dedupe_case_rows``) and, with ``renumber``, ``用例ID`` is reassigned
+	globally (``renumber_case_ids``). Returns ``(rows, report)`` where the
+	report has the verdict, row/batch counts, indexes of chunks without
+	usable rows (``failed_batches``; a chunk that lacks only the header line
+	still counts), renumbered IDs, the summed repair counts, the model repair
+	result under ``row_repair`` and the removed duplicates under ``dedup``.
+	Serialize with ``rows_to_csv``.
+	"""
 
-	for r in rows[1:]:
-		# Skip completely empty rows
-		if not any(cell.strip() for cell in r):
+	rows: List[List[str]] = []
+	flagged: List[Dict[str, Any]] = []
+	report = _new_report()
+	report.update({"batches": 0, "failed_batches": [], "renumbered": 0, "row_repair": None})
+	totals = report["repairs"]
+	for idx, chunk in enumerate(chunks):
+		report["batches"] += 1
+		if not chunk or not chunk.strip():
+			report["failed_batches"].append(idx)
 			continue
-		if len(r) > expected_len:
-			merged_last = ",".join(r[expected_len - 1:]).strip()
-			r = r[: expected_len - 1] + [merged_last]
-		elif len(r) < expected_len:
-			r = r + [""] * (expected_len - len(r))
-		writer.writerow([cell.strip() for cell in r])
+		chunk_report: Dict[str, Any] = {}
+		for row, status in iter_normalized_csv(chunk, chunk_report, assume_header=True):
+			if row_is_commentary(row, status):
+				totals["commentary"] += 1
+				continue
+			if row_is_malformed(row, status):
+				flagged.append({"index": len(rows), "batch": idx, "status": status})
+			rows.append(row)
+		if not chunk_report["ok"]:
+			report["failed_batches"].append(idx)
+		for key, value in chunk_report["repairs"].items():
+			totals[key] = (totals[key] or value) if isinstance(value, bool) else totals[key] + value
+	if repair is not None and flagged:
+		report["row_repair"] = repair(rows, flagged)
+	rows, removed = dedupe_case_rows(rows, dedup_threshold)
+	report["rows"] = len(rows)
+	report["ok"] = bool(rows)
+	if not rows:
+		report["reason"] = "没有数据行"
+	if renumber:
+		report["renumbered"] = renumber_case_ids(rows)
+	for entry in removed:
+		# Point at the representative's final ID
+		entry["kept_id"] = rows[entry.pop("kept_index")][0]
+	report["dedup"] = {"threshold": dedup_threshold, "removed": len(removed), "removed_rows": removed}
+	return rows, report
+
+
+def rows_to_csv(rows: Iterable[List[str]]) -> str:
+	"""Serialize data rows under ``EXPECTED_HEADER`` (CRLF, minimal quoting)."""
+
+	out = io.StringIO()
+	writer = csv.writer(out, lineterminator="\r\n")
+	writer.writerow(EXPECTED_HEADER)
+	writer.writerows(rows)
+	return out.getvalue()
 
-	return result_io.getvalue()
 
+__all__.extend(["iter_normalized_csv", "normalize_csv", "REQUIRED_COLUMNS", "looks_like_case_id", "row_is_malformed", "row_is_commentary", "renumber_case_ids", "merge_csv_rows", "rows_to_csv"])
 
-__all__.append("coerce_to_strict_csv")
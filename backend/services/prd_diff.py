@@ -0,0 +1,366 @@
+"""Section-aligned PRD diffing and delta-only test case generation."""
+
+from __future__ import annotations
+
+import difflib
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from backend.config import (
+	CASE_DEDUP_THRESHOLD_DEFAULT,
+	ROW_REPAIR_DEFAULT,
+	DIFF_SIMILARITY_THRESHOLD_DEFAULT,
+	DIFF_UNIT_CHARS_DEFAULT,
+	MAX_IMAGES_PER_BATCH_DEFAULT,
+	MAX_SECTION_CHARS_DEFAULT,
+	PROMPT_COMPACTION_DEFAULT,
+)
+
+from .client_factory import call_model_with_retries, summarize_prompt_cache
+from .compaction import compact_prd_text
+from .output_budget import record_output_usage
+from .parsing import create_batches_from_sections, parse_prd_sections_cached, split_oversized_section
+from .postprocess import merge_csv_rows, merge_csv_texts, rows_to_csv
+from .repair import make_row_repairer
+from .vision import build_vision_messages
+
+
+_DIFF_SYSTEM_PROMPT = "你是一名顶级的、经验丰富的软件测试保证（SQA）工程师。请始终使用简体中文输出。"
+
+ADDED = "added"
+REMOVED = "removed"
+MODIFIED = "modified"
+UNCHANGED = "unchanged"
+
+
+def _diff_units(sections: List[Dict], unit_chars: int) -> List[Dict]:
+	"""Break sections into heading-path units small enough to diff precisely."""
+
+	units: List[Dict] = []
+	for section in sections:
+		for piece in split_oversized_section(section, unit_chars):
+			path = list(piece.get("path") or [piece.get("title", "")])
+			text = piece.get("text", "")
+			units.append(
+				{
+					"path": path,
+					"title": " > ".join(p for p in path if p) or piece.get("title", "无标题章节"),
+					"text": text,
+					"images": list(piece.get("images", [])),
+					"digest": hashlib.sha1(text.strip().encode("utf-8")).hexdigest(),
+				}
+			)
+	return units
+
+
+def _shingles(unit: Dict) -> frozenset:
+	cached = unit.get("_shingles")
+	if cached is None:
+		text = " ".join(unit["text"].split())
+		cached = frozenset(hash(text[i : i + 4]) for i in range(max(1, len(text) - 3)))
+		unit["_shingles"] = cached
+	return cached
+
+
+def _similarity(a: Dict, b: Dict) -> float:
+	"""Jaccard similarity of character 4-gram sets; a shared heading path adds a small boost."""
+
+	if a["digest"] == b["digest"]:
+		return 1.0
+	sa, sb = _shingles(a), _shingles(b)
+	union = len(sa | sb)
+	score = len(sa & sb) / union if union else 0.0
+	if a["path"] == b["path"]:
+		score = min(1.0, score + 0.2)
+	return score
+
+
+def _pair_range(
+	old_units: List[Dict],
+	new_units: List[Dict],
+	threshold: float,
+) -> Tuple[List[Tuple[int, int, float]], List[int], List[int]]:
+	"""Pair units inside one non-equal region: identical text, same path, then similarity."""
+
+	pairs: List[Tuple[int, int, float]] = []
+	free_old = list(range(len(old_units)))
+	free_new = list(range(len(new_units)))
+
+	# Moved or re-titled units with identical text
+	for j in list(free_new):
+		for i in free_old:
+			if old_units[i]["digest"] == new_units[j]["digest"]:
+				pairs.append((i, j, 1.0))
+				free_old.remove(i)
+				free_new.remove(j)
+				break
+
+	for j in list(free_new):
+		for i in free_old:
+			if old_units[i]["path"] == new_units[j]["path"]:
+				pairs.append((i, j, _similarity(old_units[i], new_units[j])))
+				free_old.remove(i)
+				free_new.remove(j)
+				break
+
+	scored = sorted(
+		(
+			(_similarity(old_units[i], new_units[j]), i, j)
+			for i in free_old
+			for j in free_new
+		),
+		reverse=True,
+	)
+	for score, i, j in scored:
+		if score < threshold:
+			break
+		if i in free_old and j in free_new:
+			pairs.append((i, j, score))
+			free_old.remove(i)
+			free_new.remove(j)
+	return pairs, free_old, free_new
+
+
+def diff_prd_sections(
+	old_sections: List[Dict],
+	new_sections: List[Dict],
+	*,
+	unit_chars: int = DIFF_UNIT_CHARS_DEFAULT,
+	similarity_threshold: float = DIFF_SIMILARITY_THRESHOLD_DEFAULT,
+) -> List[Dict]:
+	"""Align two parsed PRDs and classify each unit as added/removed/modified/unchanged.
+
+	Sections are cut into heading-path units (``split_oversized_section``), the
+	unit sequences are aligned by (path, content hash), and units in the
+	non-matching regions are paired by identical text, heading path and then
+	4-gram similarity.
+	Entries are returned in new-document order with removed units last; each
+	has ``status``, ``old``/``new`` units (``None`` when absent) and ``similarity``.
+	"""
+
+	old_units = _diff_units(old_sections, unit_chars)
+	new_units = _diff_units(new_sections, unit_chars)
+
+	def key(u: Dict) -> Tuple[str, ...]:
+		return tuple(u["path"]) + (u["digest"],)
+
+	matcher = difflib.SequenceMatcher(None, [key(u) for u in old_units], [key(u) for u in new_units], autojunk=False)
+	by_new: Dict[int, Dict] = {}
+	removed: List[Dict] = []
+	for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+		if tag == "equal":
+			for offset in range(i2 - i1):
+				by_new[j1 + offset] = {
+					"status": UNCHANGED,
+					"old": old_units[i1 + offset],
+					"new": new_units[j1 + offset],
+					"similarity": 1.0,
+				}
+			continue
+		pairs, free_old, free_new = _pair_range(old_units[i1:i2], new_units[j1:j2], similarity_threshold)
+		for i, j, score in pairs:
+			old_u, new_u = old_units[i1 + i], new_units[j1 + j]
+			same = old_u["digest"] == new_u["digest"] and old_u["images"] == new_u["images"]
+			by_new[j1 + j] = {
+				"status": UNCHANGED if same else MODIFIED,
+				"old": old_u,
+				"new": new_u,
+				"similarity": round(score, 3),
+			}
+		for j in free_new:
+			by_new[j1 + j] = {"status": ADDED, "old": None, "new": new_units[j1 + j], "similarity": 0.0}
+		for i in free_old:
+			removed.append({"status": REMOVED, "old": old_units[i1 + i], "new": None, "similarity": 0.0})
+
+	return [by_new[j] for j in range(len(new_units))] + removed
+
+
+def summarize_prd_diff(diff: List[Dict], *, max_titles: int = 50) -> Dict[str, Any]:
+	"""Counts per status plus (capped) titles of changed and removed units."""
+
+	counts = {ADDED: 0, REMOVED: 0, MODIFIED: 0, UNCHANGED: 0}
+	changed: List[str] = []
+	removed: List[str] = []
+	for entry in diff:
+		counts[entry["status"]] += 1
+		if entry["status"] in (ADDED, MODIFIED) and len(changed) < max_titles:
+			changed.append(entry["new"]["title"])
+		elif entry["status"] == REMOVED and len(removed) < max_titles:
+			removed.append(entry["old"]["title"])
+	return {**counts, "changed_titles": changed, "removed_titles": removed}
+
+
+def build_delta_sections(diff: List[Dict]) -> List[Dict]:
+	"""Pseudo-sections for added/modified units, carrying the old text as context."""
+
+	sections: List[Dict] = []
+	for entry in diff:
+		status = entry["status"]
+		if status not in (ADDED, MODIFIED):
+			continue
+		new_u = entry["new"]
+		tag = "新增" if status == ADDED else "修改"
+		sections.append(
+			{
+				"title": f"[{tag}] {new_u['title']}",
+				"text": new_u["text"],
+				"images": list(new_u["images"]),
+				"path": list(new_u["path"]),
+				"old_text": entry["old"]["text"] if entry["old"] else "",
+				"change": status,
+			}
+		)
+	return sections
+
+
+def _escape_braces(text: str) -> str:
+	return text.replace("{", "{{").replace("}", "}}")
+
+
+def _batch_old_content(batch: Dict) -> str:
+	parts = []
+	for s in batch["sections"]:
+		old_text = s.get("old_text") or "（旧版无此章节）"
+		parts.append(f"## {s['title']}\n{old_text}")
+	return "\n\n".join(parts)
+
+
+def _batch_new_content(batch: Dict) -> str:
+	return "\n\n".join(f"## {s['title']}\n{s['text']}" for s in batch["sections"])
+
+
+def generate_incremental_csv(
+	client: Any,
+	old_prd: str,
+	new_prd: str,
+	prompt_template_diff: str,
+	*,
+	text_model: str,
+	vision_model: Optional[str] = None,
+	use_vision: bool = False,
+	max_images: int = MAX_IMAGES_PER_BATCH_DEFAULT,
+	max_section_chars: int = MAX_SECTION_CHARS_DEFAULT,
+	unit_chars: int = DIFF_UNIT_CHARS_DEFAULT,
+	similarity_threshold: float = DIFF_SIMILARITY_THRESHOLD_DEFAULT,
+	dedup_threshold: float = CASE_DEDUP_THRESHOLD_DEFAULT,
+	row_repair: bool = ROW_REPAIR_DEFAULT,
+	concurrency: int = 1,
+	vision_options: Optional[Dict[str, Any]] = None,
+	on_batch_done: Optional[Callable[[int, int], None]] = None,
+	on_plan: Optional[Callable[[int], None]] = None,
+) -> Tuple[str, Dict[str, Any]]:
+	"""Generate test cases for the changed sections only and merge them into one CSV.
+
+	Each batch renders the diff prompt with the old and new versions of just
+	its sections. Batches with images go through the vision model when
+	``use_vision`` is set, falling back to text on failure like the full
+	pipeline. With ``row_repair`` malformed rows are re-asked from the text
+	model, and near-duplicate cases above ``dedup_threshold`` are dropped when
+	merging. ``on_plan(total)`` and ``on_batch_done(done, total)`` report progress.
+	"""
+
+	diff = diff_prd_sections(
+		parse_prd_sections_cached(old_prd),
+		parse_prd_sections_cached(new_prd),
+		unit_chars=unit_chars,
+		similarity_threshold=similarity_threshold,
+	)
+	delta = build_delta_sections(diff)
+	# Old and new text travel together, so plan against half the text budget
+	with_images = use_vision and bool(vision_model)
+	batches = create_batches_from_sections(
+		delta, max_images, max(1, max_section_chars // 2), split_by_modality=with_images
+	)
+	total = len(batches)
+	if on_plan is not None:
+		on_plan(total)
+	compact = (vision_options or {}).get("compact_prompt", PROMPT_COMPACTION_DEFAULT)
+
+	def run_one(i_b):
+		i, batch = i_b
+		old_content = _batch_old_content(batch)
+		new_content = _batch_new_content(batch)
+		if compact:
+			old_content = compact_prd_text(old_content)
+			new_content = compact_prd_text(new_content)
+		resp = ""
+		if with_images and batch["total_images"] > 0:
+			template = prompt_template_diff.format(
+				old_prd_content=_escape_braces(old_content),
+				new_prd_content="{prd_content}",
+			)
+			msgs = build_vision_messages(batch, template, i, total, vision_model=vision_model, **(vision_options or {}))
+			try:
+				resp = call_model_with_retries(client, vision_model, msgs, usage=batch.setdefault("usage", {}))
+			except Exception as exc:  # noqa: BLE001
+				print(f"增量第 {i + 1} 批视觉调用失败，降级为文本: {exc}")
+		if not resp:
+			final_prompt = prompt_template_diff.format(old_prd_content=old_content, new_prd_content=new_content)
+			try:
+				resp = call_model_with_retries(
+					client,
+					text_model,
+					[
+						{"role": "system", "content": _DIFF_SYSTEM_PROMPT},
+						{"role": "user", "content": final_prompt},
+					],
+					usage=batch.setdefault("usage", {}),
+				)
+			except Exception as exc:  # noqa: BLE001
+				print(f"增量第 {i + 1} 批失败: {exc}")
+				resp = ""
+		return i, resp
+
+	results: Dict[int, str] = {}
+	done = 0
+	if total > 1 and int(concurrency) > 1:
+		with ThreadPoolExecutor(max_workers=int(concurrency)) as ex:
+			futures = [ex.submit(run_one, (i, b)) for i, b in enumerate(batches)]
+			for fut in as_completed(futures):
+				i, resp = fut.result()
+				results[i] = resp
+				done += 1
+				if on_batch_done is not None:
+					on_batch_done(done, total)
+	else:
+		for i, b in enumerate(batches):
+			_, results[i] = run_one((i, b))
+			done += 1
+			if on_batch_done is not None:
+				on_batch_done(done, total)
+
+	responses = [results.get(i, "") for i in range(total)]
+	output_usage = record_output_usage(batches, responses)
+	case_rows, csv_report = merge_csv_rows(
+		responses,
+		dedup_threshold=dedup_threshold,
+		repair=make_row_repairer(client, text_model, batches) if row_repair else None,
+	)
+	if csv_report["ok"] or not any(responses):
+		csv_text = rows_to_csv(case_rows)
+	else:
+		csv_text = merge_csv_texts(responses)
+
+	meta = {
+		"mode": "incremental-sections",
+		"model_used": vision_model if with_images and any(b["total_images"] for b in batches) else text_model,
+		"use_vision": with_images and any(b["total_images"] for b in batches),
+		"total_batches": total,
+		"total_images": sum(b["total_images"] for b in batches),
+		"diff": summarize_prd_diff(diff),
+		"output_tokens": output_usage,
+		"prompt_cache": summarize_prompt_cache(batches),
+		"csv_repairs": csv_report,
+		"case_dedup": csv_report["dedup"],
+		"row_repair": csv_report["row_repair"],
+	}
+	return csv_text, meta
+
+
+__all__ = [
+	"diff_prd_sections",
+	"summarize_prd_diff",
+	"build_delta_sections",
+	"generate_incremental_csv",
+]
@@ -0,0 +1,163 @@
+"""Background image prefetcher shared by the batches of one generation run.
+
+Image URLs are enqueued as soon as the PRD is parsed, so downloads overlap
+batch planning and earlier batches' inference. Workers pause while buffered
+results exceed a memory budget; a batch asking for an image that has not
+started yet fetches it inline, so a full buffer can never deadlock.
+"""
+
+from __future__ import annotations
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from backend.config import (
+	IMAGE_DOWNLOAD_CONCURRENCY_DEFAULT,
+	IMAGE_PREFETCH_MEMORY_MB_DEFAULT,
+)
+
+
+class ImagePrefetcher:
+	"""Fetch images ahead of use with bounded concurrency and buffered bytes."""
+
+	def __init__(
+		self,
+		fetch: Callable[[str], Optional[Tuple[str, int]]],
+		*,
+		concurrency: int = IMAGE_DOWNLOAD_CONCURRENCY_DEFAULT,
+		memory_budget_bytes: int = IMAGE_PREFETCH_MEMORY_MB_DEFAULT * 1024 * 1024,
+		on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+	) -> None:
+		self._fetch = fetch
+		self._budget = max(1, int(memory_budget_bytes))
+		self._on_progress = on_progress
+		self._cond = threading.Condition()
+		# url -> "pending" | "running" | "done"
+		self._state: Dict[str, str] = {}
+		# url -> (data URL, baseline bytes) as returned by fetch
+		self._results: Dict[str, Optional[Tuple[str, int]]] = {}
+		# outstanding get() calls expected per url; buffered result is freed at zero
+		self._refs: Dict[str, int] = {}
+		self._buffered = 0
+		self._total = 0
+		self._done = 0
+		self._failed = 0
+		self._closed = False
+		self._executor = ThreadPoolExecutor(max_workers=max(1, int(concurrency)), thread_name_prefix="img-prefetch")
+
+	def __enter__(self) -> "ImagePrefetcher":
+		return self
+
+	def __exit__(self, *exc: Any) -> None:
+		self.close()
+
+	def submit(self, urls: Iterable[str]) -> None:
+		"""Enqueue URLs in the order they will be consumed."""
+		for url in urls:
+			with self._cond:
+				if self._closed:
+					return
+				self._refs[url] = self._refs.get(url, 0) + 1
+				if url in self._state:
+					continue
+				self._state[url] = "pending"
+				self._total += 1
+			self._executor.submit(self._work, url)
+		self._report()
+
+	def get(self, url: str) -> Optional[Tuple[str, int]]:
+		"""Return the processed image for ``url``, waiting for or performing the fetch."""
+		result = self.peek(url)
+		self.discard(url)
+		return result
+
+	def peek(self, url: str) -> Optional[Tuple[str, int]]:
+		"""Like ``get`` but keep the result buffered for the ``get`` that follows.
+
+		Used to inspect images (e.g. hash them for dedup) before batches exist;
+		every peeked URL must later be consumed by ``get`` or ``discard``.
+		"""
+		with self._cond:
+			state = self._state.get(url)
+			if state is None:
+				self._refs[url] = self._refs.get(url, 0) + 1
+				self._total += 1
+			inline = state in (None, "pending")
+			if inline:
+				self._state[url] = "running"
+		if inline:
+			self._run(url)
+		with self._cond:
+			while self._state.get(url) != "done":
+				self._cond.wait()
+			return self._results.get(url)
+
+	def discard(self, url: str) -> None:
+		"""Drop one expected use of ``url`` without reading it (e.g. a pruned image)."""
+		with self._cond:
+			self._refs[url] = self._refs.get(url, 1) - 1
+			if self._refs[url] <= 0:
+				self._release(url)
+
+	def progress(self) -> Dict[str, Any]:
+		with self._cond:
+			return {
+				"total": self._total,
+				"done": self._done,
+				"failed": self._failed,
+				"buffered_bytes": self._buffered,
+			}
+
+	def close(self) -> None:
+		with self._cond:
+			self._closed = True
+			self._cond.notify_all()
+		self._executor.shutdown(wait=False, cancel_futures=True)
+
+	# --- internals ---
+
+	def _work(self, url: str) -> None:
+		with self._cond:
+			while not self._closed and self._buffered >= self._budget and self._state.get(url) == "pending":
+				self._cond.wait(0.5)
+			if self._closed or self._state.get(url) != "pending":
+				return
+			self._state[url] = "running"
+		self._run(url)
+
+	def _run(self, url: str) -> None:
+		try:
+			result = self._fetch(url)
+		except Exception as exc:  # noqa: BLE001
+			print(f"预取图片失败 {url}: {exc}")
+			result = None
+		with self._cond:
+			self._results[url] = result
+			self._state[url] = "done"
+			self._buffered += len(result[0]) if result else 0
+			self._done += 1
+			if result is None:
+				self._failed += 1
+			self._cond.notify_all()
+		self._report()
+
+	def _release(self, url: str) -> None:
+		# caller holds the lock
+		result = self._results.pop(url, None)
+		self._buffered -= len(result[0]) if result else 0
+		self._refs.pop(url, None)
+		# a later unexpected get() re-fetches inline instead of reading a freed slot
+		self._state.pop(url, None)
+		self._cond.notify_all()
+
+	def _report(self) -> None:
+		if self._on_progress is None:
+			return
+		try:
+			self._on_progress(self.progress())
+		except Exception:  # noqa: BLE001
+			pass
+
+
+__all__ = ["ImagePrefetcher"]
@@ -2,6 +2,7 @@
 
 from __future__ import annotations
 
+import re
 from pathlib import Path
 from typing import Tuple
 
@@ -27,4 +28,29 @@ def load_prompt_templates() -> Tuple[str, str]:
 	return full_prompt, diff_prompt
 
 
-__all__ = ["load_prompt_templates"]
+# One system message for every generation call (vision and text batches, text
+# fallbacks), so the cached prompt prefix is shared; whether a PRD comes with
+# images is said in the user turn
+SQA_SYSTEM_PROMPT = "你是一名资深SQA工程师。请严格基于用户提供的PRD生成测试用例，使用简体中文，不得编造无关场景。"
+
+
+# Start of the content block in the templates ("--- PRD CONTENT ---", "--- OLD_PRD ---")
+_CONTENT_MARKER_PATTERN = re.compile(r"^--- .+ ---\s*$", re.MULTILINE)
+
+
+def split_prompt_template(template: str) -> Tuple[str, str]:
+	"""Split a template into (instructions, content_template).
+
+	Instructions are everything before the first content marker line (or the
+	``{prd_content}`` placeholder when there is none); they are identical for
+	every batch, so callers send them first to keep a cacheable prompt prefix.
+	"""
+
+	match = _CONTENT_MARKER_PATTERN.search(template)
+	cut = match.start() if match else template.find("{prd_content}")
+	if cut <= 0:
+		return "", template
+	return template[:cut].rstrip(), template[cut:]
+
+
+__all__ = ["SQA_SYSTEM_PROMPT", "load_prompt_templates", "split_prompt_template"]
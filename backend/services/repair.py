@@ -0,0 +1,155 @@
+"""Row-targeted repair: re-ask the text model only for malformed CSV rows.
+
+``merge_csv_rows`` flags rows whose column count had to be forced (extra
+cells merged, missing cells padded) or whose required fields are empty. The
+flagged rows, with the titles of the sections their batch covered, go to the
+text model in one compact request; fixed rows are spliced back in place.
+"""
+
+from __future__ import annotations
+
+import csv
+import io
+from typing import Any, Callable, Dict, List, Sequence
+
+from .client_factory import call_model_with_retries
+from .postprocess import EXPECTED_HEADER, REQUIRED_COLUMNS, _strip_code_fences
+
+
+# Rows per repair request; larger sets are sent in several requests
+_ROWS_PER_REQUEST = 60
+_MAX_SOURCE_CHARS = 120
+
+_REPAIR_SYSTEM_PROMPT = "你是一名资深SQA工程师，负责修复格式有误的测试用例 CSV 行。请始终使用简体中文输出。"
+_REPAIR_INSTRUCTIONS = (
+	"以下测试用例行在生成时格式有误（列数不对，或“测试项/操作步骤/预期结果”为空）。"
+	"请逐行修复：保留原有信息，按列含义重新拆分到正确的列，补全缺失的必填字段，不要新增或删除用例，“用例ID”保持不变。\n"
+	"【输出格式（严格 CSV）】仅输出 CSV，第一行表头为：行号," + ",".join(EXPECTED_HEADER) + "\n"
+	"“行号”原样保留输入中的编号；单元格内含逗号或换行时用双引号包裹。"
+)
+
+
+def _source_label(titles: Sequence[str]) -> str:
+	label = "、".join(t for t in titles if t)
+	return label if len(label) <= _MAX_SOURCE_CHARS else label[:_MAX_SOURCE_CHARS] + "…"
+
+
+def _build_request(rows: List[List[str]], flagged: List[Dict[str, Any]], sources: Sequence[Sequence[str]]) -> str:
+	out = io.StringIO()
+	writer = csv.writer(out, lineterminator="\n")
+	writer.writerow(["行号", "来源章节", "问题", "原始内容"])
+	for entry in flagged:
+		row = rows[entry["index"]]
+		# Padded rows carry trailing blanks that were not in the model output
+		cells = list(row)
+		while cells and not cells[-1] and entry["status"] == "padded":
+			cells.pop()
+		source = sources[entry["batch"]] if entry["batch"] < len(sources) else ()
+		problem = {"padded": "列数不足", "merged": "列数过多"}.get(entry["status"], "必填字段为空")
+		writer.writerow([entry["index"], _source_label(source), problem, ",".join(cells)])
+	return _REPAIR_INSTRUCTIONS + "\n\n--- 待修复行 ---\n" + out.getvalue()
+
+
+def _parse_fixed_rows(text: str) -> Dict[int, List[str]]:
+	"""Map row number -> fixed 8-column row, keeping only complete rows.
+
+	The caller still checks each row against the ID it was sent with.
+	"""
+
+	fixed: Dict[int, List[str]] = {}
+	width = len(EXPECTED_HEADER) + 1
+	for r in csv.reader(io.StringIO(_strip_code_fences(text or "").strip())):
+		if len(r) != width:
+			continue
+		try:
+			index = int(r[0].strip())
+		except ValueError:
+			continue  # header or stray text
+		cells = [c.strip() for c in r[1:]]
+		if any(not cells[i] for i in REQUIRED_COLUMNS):
+			continue
+		fixed[index] = cells
+	return fixed
+
+
+def repair_flagged_rows(
+	client: Any,
+	model: str,
+	rows: List[List[str]],
+	flagged: List[Dict[str, Any]],
+	*,
+	sources: Sequence[Sequence[str]] = (),
+) -> Dict[str, Any]:
+	"""Ask ``model`` to fix ``flagged`` rows and splice the results into ``rows``.
+
+	``flagged`` entries are ``{"index", "batch", "status"}`` from
+	``merge_csv_rows``; ``sources[batch]`` lists that batch's section titles.
+	Rows the model does not return in a valid shape, or returns under a
+	different ``用例ID`` (``id_mismatch``), keep their forced form. Returns
+	counts plus the provider token usage of the repair requests.
+	"""
+
+	usage: Dict[str, int] = {}
+	repaired = requests = id_mismatch = 0
+	errors: List[str] = []
+	for start in range(0, len(flagged), _ROWS_PER_REQUEST):
+		part = flagged[start:start + _ROWS_PER_REQUEST]
+		requests += 1
+		try:
+			resp = call_model_with_retries(
+				client,
+				model,
+				[
+					{"role": "system", "content": _REPAIR_SYSTEM_PROMPT},
+					{"role": "user", "content": _build_request(rows, part, sources)},
+				],
+				max_retries=1,
+				usage=usage,
+			)
+		except Exception as exc:  # noqa: BLE001 - keep the forced rows
+			print(f"用例行修复请求失败: {exc}")
+			errors.append(str(exc))
+			continue
+		fixed = _parse_fixed_rows(resp)
+		for entry in part:
+			cells = fixed.get(entry["index"])
+			if cells is None:
+				continue
+			if cells[0] != rows[entry["index"]][0]:
+				# A different ID means the model wrote another case instead of fixing this one
+				id_mismatch += 1
+				continue
+			rows[entry["index"]] = cells
+			repaired += 1
+	return {
+		"flagged": len(flagged),
+		"repaired": repaired,
+		"id_mismatch": id_mismatch,
+		"requests": requests,
+		"errors": errors,
+		"usage": usage,
+	}
+
+
+def make_row_repairer(
+	client: Any,
+	model: str | None,
+	batches: Sequence[Dict[str, Any]] = (),
+) -> Callable[[List[List[str]], List[Dict[str, Any]]], Dict[str, Any]] | None:
+	"""Bind ``repair_flagged_rows`` to a client/model for ``merge_csv_rows(repair=...)``.
+
+	Section titles come from ``batches`` (in the order the responses were
+	merged). Returns ``None`` without a model, which disables the stage.
+	"""
+
+	if not model:
+		return None
+	sources = [[s.get("title", "") for s in b.get("sections", [])] for b in batches]
+
+	def repair(rows: List[List[str]], flagged: List[Dict[str, Any]]) -> Dict[str, Any]:
+		return repair_flagged_rows(client, model, rows, flagged, sources=sources)
+
+	return repair
+
+
+__all__ = ["repair_flagged_rows", "make_row_repairer"]
@@ -0,0 +1,464 @@
+"""In-process vector index over knowledge base section embeddings.
+
+Embeddings are L2-normalized once and kept in one contiguous float32 matrix
+(rows grow by doubling) with a parallel list of section metadata, so a query
+is a single matrix-vector product plus ``argpartition`` for the top k.
+Documents are added incrementally on ingest and removed with tombstones
+(the matrix is compacted once a quarter of it is dead); other changes
+(documents written or removed by another worker) are picked up lazily by
+diffing the set of document IDs, at most every few seconds.
+
+With an ``IvfFlat`` (see ann_index) queries over large indexes score only
+the closest clusters, and with an ``IndexStore`` the index is persisted and
+shared between workers. Both are optional.
+
+NumPy is optional too: without it vectors are kept as normalized
+``array('f')`` rows and scored in pure Python (no ANN, no persistence),
+which is slower but still avoids reloading every document per query.
+"""
+
+from __future__ import annotations
+
+import heapq
+import math
+import operator
+import threading
+import time
+from array import array
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from .ann_index import IndexStore, IvfFlat
+
+try:
+    import numpy as np
+except Exception:  # noqa: BLE001 - optional dependency
+    np = None
+
+
+# How often a query re-checks the document list for changes made elsewhere
+_STALE_CHECK_SECONDS = 2.0
+_INITIAL_CAPACITY = 1024
+# Compact (and rewrite the store) once this share of rows is tombstoned
+_MAX_DEAD_RATIO = 0.25
+# Re-train the ANN clusters when the index has grown this much since training
+_RETRAIN_GROWTH = 4
+# Probed clusters covering more than this share of the rows are scanned exactly
+# instead: gathering most rows costs more than one contiguous matrix product
+_ANN_MAX_SCAN = 0.5
+
+
+def _normalize(vector: Iterable[float]) -> Any:
+    """Unit-length float32 copy of ``vector``, or ``None`` for a zero vector."""
+
+    if np is not None:
+        v = np.asarray(vector, dtype=np.float32)
+        norm = float(np.linalg.norm(v))
+        return v / norm if norm > 0 else None
+    v = array("f", vector)
+    norm = math.sqrt(sum(map(operator.mul, v, v)))
+    if norm == 0:
+        return None
+    return array("f", (x / norm for x in v))
+
+
+class KbVectorIndex:
+    """Top-k cosine search over the sections of all KB documents.
+
+    ``list_doc_ids`` returns the IDs of the stored documents and ``load_doc``
+    loads one (``{"doc_id", "name", "sections": [{"title", "text", "images",
+    "embedding"}]}``). Documents are treated as immutable; ``add_doc`` with a
+    known ID replaces it. ``ann`` is used once at least ``ann_min_rows`` rows
+    are live; ``store`` persists the index. Both require NumPy.
+    """
+
+    def __init__(
+        self,
+        list_doc_ids: Callable[[], Iterable[str]],
+        load_doc: Callable[[str], Optional[Dict[str, Any]]],
+        *,
+        ann: Optional[IvfFlat] = None,
+        store: Optional[IndexStore] = None,
+        ann_min_rows: int = 0,
+    ) -> None:
+        self._list_doc_ids = list_doc_ids
+        self._load_doc = load_doc
+        self._ann = ann if np is not None else None
+        self._store = store if np is not None else None
+        self._ann_min_rows = ann_min_rows
+        self._lock = threading.RLock()
+        self._checked_at: Optional[float] = None
+        self.skipped = 0  # embeddings whose dimension differs from the index
+        self._reset()
+
+    def _reset(self) -> None:
+        self._dim: Optional[int] = None
+        self._matrix: Any = None  # np.ndarray (capacity x dim) or list of array('f')
+        self._alive: Any = None  # np.ndarray of bool, parallel to the matrix
+        self._labels: Any = None  # np.ndarray of int32 ANN cluster per row (-1 = none)
+        self._size = 0
+        self._dead = 0
+        self._meta: List[Optional[Dict[str, Any]]] = []
+        self._doc_rows: Dict[str, List[int]] = {}
+        self._store_offsets: Optional[Dict[str, int]] = None
+        self._store_generation: Optional[int] = None
+        if self._ann is not None:
+            self._ann.load(None, 0)
+
+    def __len__(self) -> int:
+        return self._size - self._dead
+
+    @property
+    def vectorized(self) -> bool:
+        return np is not None
+
+    # --- maintenance ---
+
+    def add_doc(self, doc: Dict[str, Any]) -> int:
+        """Index (or re-index) ``doc``; return the number of sections added."""
+
+        with self._lock, self._store_lock():
+            self._sync_store()
+            if doc["doc_id"] in self._doc_rows:
+                self._remove_docs([doc["doc_id"]])
+            return self._append_doc(doc)
+
+    def remove_doc(self, doc_id: str) -> None:
+        with self._lock, self._store_lock():
+            self._sync_store()
+            if doc_id in self._doc_rows:
+                self._remove_docs([doc_id])
+
+    def refresh(self, force: bool = False) -> None:
+        """Sync with the stored documents: load new ones, drop removed ones."""
+
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._checked_at is not None and now - self._checked_at < _STALE_CHECK_SECONDS:
+                return
+            self._checked_at = now
+            with self._store_lock():
+                self._sync_store()
+                current = set(self._list_doc_ids())
+                gone = [d for d in self._doc_rows if d not in current]
+                if gone:
+                    self._remove_docs(gone)
+                for doc_id in current:
+                    if doc_id in self._doc_rows:
+                        continue
+                    doc = self._load_doc(doc_id)
+                    if doc:
+                        self._append_doc(doc)
+                    else:
+                        self._doc_rows[doc_id] = []
+
+    def _store_lock(self) -> Any:
+        if self._store is None:
+            return _NO_LOCK
+        return self._store.lock()
+
+    def _append_doc(self, doc: Dict[str, Any], *, persist: bool = True) -> int:
+        rows = self._doc_rows.setdefault(doc["doc_id"], [])
+        vectors: List[Any] = []
+        metas: List[Dict[str, Any]] = []
+        for sec in doc.get("sections", []):
+            embedding = sec.get("embedding")
+            if not embedding:
+                continue
+            if self._dim is None:
+                self._dim = len(embedding)
+            if len(embedding) != self._dim:
+                self.skipped += 1
+                continue
+            vector = _normalize(embedding)
+            if vector is None:
+                continue
+            vectors.append(vector)
+            metas.append(
+                {
+                    "doc_id": doc["doc_id"],
+                    "doc_name": doc.get("name"),
+                    "title": sec.get("title"),
+                    "text": sec.get("text"),
+                    "images": sec.get("images", []),
+                }
+            )
+        if not vectors:
+            return 0
+        if np is None:
+            if self._matrix is None:
+                self._matrix = []
+            for vector, meta in zip(vectors, metas):
+                self._matrix.append(vector)
+                self._meta.append(meta)
+                rows.append(self._size)
+                self._size += 1
+            return len(rows)
+        block = np.stack(vectors)
+        labels = self._ann.assign(block) if self._ann is not None and self._ann.trained else np.full(len(block), -1, np.int32)
+        self._append_rows(block, metas, labels)
+        if persist and self._store is not None:
+            self._store.set_dim(self._dim)
+            self._store.append(block, metas, labels)
+            self._store_offsets = self._store.offsets()
+            if self._store_generation is None:
+                self._store_generation = int(self._store.manifest()["generation"])
+        return len(rows)
+
+    def _append_rows(self, block: Any, metas: List[Dict[str, Any]], labels: Any) -> None:
+        """Append normalized rows in memory (NumPy mode), registering them per doc and cluster."""
+
+        needed = self._size + len(block)
+        if self._matrix is None:
+            capacity = max(_INITIAL_CAPACITY, needed)
+            self._matrix = np.empty((capacity, self._dim), dtype=np.float32)
+            self._alive = np.zeros(capacity, dtype=bool)
+            self._labels = np.full(capacity, -1, dtype=np.int32)
+        elif needed > self._matrix.shape[0]:
+            capacity = max(needed, self._matrix.shape[0] * 2)
+            for name, fill in (("_matrix", None), ("_alive", False), ("_labels", -1)):
+                old = getattr(self, name)
+                shape = (capacity,) + old.shape[1:]
+                grown = np.empty(shape, dtype=old.dtype) if fill is None else np.full(shape, fill, dtype=old.dtype)
+                grown[: self._size] = old[: self._size]
+                setattr(self, name, grown)
+        start = self._size
+        self._matrix[start:needed] = block
+        self._alive[start:needed] = True
+        self._labels[start:needed] = labels
+        for i, meta in enumerate(metas, start=start):
+            self._meta.append(meta)
+            self._doc_rows.setdefault(meta["doc_id"], []).append(i)
+        self._size = needed
+        if self._ann is not None and self._ann.trained:
+            assigned = labels >= 0
+            self._ann.add(np.arange(start, needed)[assigned], labels[assigned])
+
+    def _remove_docs(self, doc_ids: List[str], *, persist: bool = True, compact: bool = True) -> None:
+        removed = []
+        for doc_id in doc_ids:
+            rows = self._doc_rows.pop(doc_id, None)
+            if rows is None:
+                continue
+            removed.append(doc_id)
+            for i in rows:
+                self._meta[i] = None
+                if self._alive is not None:
+                    self._alive[i] = False
+            self._dead += len(rows)
+        if persist and removed and self._store is not None and self._store.manifest() is not None:
+            self._store.append_tombstones(removed)
+            self._store_offsets = self._store.offsets()
+        if compact and self._dead > self._size * _MAX_DEAD_RATIO:
+            self._compact()
+
+    def _compact(self, rewrite: bool = True) -> None:
+        """Drop tombstoned rows, renumber, and (unless told not to) rewrite the store."""
+
+        keep = [i for i in range(self._size) if self._meta[i] is not None]
+        position = {old: new for new, old in enumerate(keep)}
+        self._meta = [self._meta[i] for i in keep]
+        for rows in self._doc_rows.values():
+            rows[:] = [position[i] for i in rows]
+        self._size = len(keep)
+        self._dead = 0
+        if np is None:
+            self._matrix = [self._matrix[i] for i in keep] or None
+        else:
+            idx = np.asarray(keep, dtype=np.int64)
+            self._matrix = np.ascontiguousarray(self._matrix[idx]) if keep else None
+            self._alive = np.ones(len(keep), dtype=bool) if keep else None
+            self._labels = self._labels[idx] if keep else None
+            self._rebuild_ann_lists()
+        if not self._size:
+            self._dim = None
+        if rewrite:
+            self._rewrite_store()
+
+    def _rebuild_ann_lists(self) -> None:
+        if self._ann is None or not self._ann.trained:
+            return
+        self._ann.reset_lists()
+        if self._size:
+            labels = self._labels[: self._size]
+            assigned = np.flatnonzero(labels >= 0)
+            self._ann.add(assigned, labels[assigned])
+
+    def _rewrite_store(self) -> None:
+        if self._store is None or self._dim is None:
+            return
+        n = self._size
+        extra = {"trained_rows": self._ann.trained_rows if self._ann is not None else 0}
+        self._store_generation = self._store.rewrite(
+            self._dim,
+            self._matrix[:n],
+            self._meta[:n],
+            self._labels[:n],
+            self._ann.centroids if self._ann is not None else None,
+            extra,
+        )
+        self._store_offsets = self._store.offsets()
+
+    def _sync_store(self) -> None:
+        """Load rows/tombstones other workers persisted (call under the store lock)."""
+
+        if self._store is None:
+            return
+        manifest = self._store.manifest()
+        if manifest is None:
+            # First run with persistence: write out what is already indexed
+            if self._dim is not None:
+                if self._dead:
+                    self._compact()
+                else:
+                    self._rewrite_store()
+            return
+        if manifest["generation"] != self._store_generation or (self._dim is not None and manifest["dim"] != self._dim):
+            self._reset()
+            self._store_generation = int(manifest["generation"])
+            self._dim = int(manifest["dim"])
+            centroids = self._store.centroids()
+            if self._ann is not None and centroids is not None and centroids.shape[1] == self._dim:
+                self._ann.load(centroids, int(manifest.get("trained_rows") or 0))
+            data = self._store.read(None)
+        else:
+            data = self._store.read(self._store_offsets)
+        self._store_offsets = data["offsets"]
+        vectors, assign = data["vectors"], data["assign"]
+        usable = min(vectors.shape[0], len(assign))  # a torn append leaves a short tail
+        row = 0
+        start = 0
+        batch: List[Dict[str, Any]] = []
+        skip: Optional[str] = None
+        for record in data["records"] + [{"deleted": None}]:
+            deleted = "deleted" in record
+            if batch and (deleted or record["doc_id"] != batch[0]["doc_id"]):
+                self._load_rows(vectors[start:row], batch, assign[start:row])
+                batch = []
+            if deleted:
+                skip = None
+                if record["deleted"] in self._doc_rows:
+                    self._remove_docs([record["deleted"]], persist=False, compact=False)
+                continue
+            if row >= usable:
+                continue
+            doc_id = record["doc_id"]
+            if not batch and doc_id != skip:
+                # A doc appended twice (racing workers without flock) keeps its first copy
+                skip = doc_id if doc_id in self._doc_rows else None
+                start = row
+            if doc_id != skip:
+                batch.append(record)
+            row += 1
+        if self._dead > self._size * _MAX_DEAD_RATIO:
+            self._compact()
+
+    def _load_rows(self, vectors: Any, metas: List[Dict[str, Any]], labels: Any) -> None:
+        if self._ann is None or not self._ann.trained:
+            labels = np.full(len(metas), -1, np.int32)
+        self._append_rows(vectors, metas, labels)
+
+    def _maybe_train(self) -> None:
+        if self._ann is None or self._dim is None:
+            return
+        live = self._size - self._dead
+        if live < max(self._ann_min_rows, 1):
+            return
+        if self._ann.trained and live <= self._ann.trained_rows * _RETRAIN_GROWTH:
+            return
+        with self._store_lock():
+            self._sync_store()
+            if self._dead:
+                self._compact(rewrite=False)
+            self._ann.train(self._matrix[: self._size])
+            self._labels[: self._size] = self._ann.assign(self._matrix[: self._size])
+            self._rebuild_ann_lists()
+            self._rewrite_store()
+
+    # --- search ---
+
+    def search(
+        self,
+        query_embedding: List[float],
+        top_k: int = 5,
+        doc_id: Optional[str] = None,
+        nprobe: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """Sections most similar to ``query_embedding``, best first, with ``similarity``.
+
+        Large indexes with an ANN backend are searched approximately
+        (``nprobe`` overrides the configured number of probed clusters);
+        searches within one document are always exact.
+        """
+
+        self.refresh()
+        with self._lock:
+            if np is not None:
+                self._maybe_train()
+            if not len(self) or top_k <= 0 or len(query_embedding) != self._dim:
+                return []
+            query = _normalize(query_embedding)
+            if query is None:
+                return []
+            rows: Optional[List[int]] = None
+            if doc_id is not None:
+                rows = self._doc_rows.get(doc_id)
+                if not rows:
+                    return []
+            hits = self._top_k(query, int(top_k), rows, nprobe)
+            return [dict(self._meta[i], similarity=score) for score, i in hits]
+
+    def _top_k(self, query: Any, k: int, rows: Optional[List[int]], nprobe: Optional[int]) -> List[Tuple[float, int]]:
+        if np is None:
+            candidates = range(self._size) if rows is None else rows
+            vectors, meta = self._matrix, self._meta
+            return heapq.nlargest(
+                k,
+                ((sum(map(operator.mul, vectors[i], query)), i) for i in candidates if meta[i] is not None),
+                key=operator.itemgetter(0),
+            )
+        if rows is not None:
+            ids = np.asarray(rows)
+        elif self._ann is not None and self._ann.trained and len(self) >= self._ann_min_rows:
+            ids = self._ann.candidates(query, nprobe)
+            if len(ids) > self._size * _ANN_MAX_SCAN:
+                ids = np.flatnonzero(self._alive[: self._size]) if self._dead else None
+            else:
+                ids = ids[self._alive[ids]]
+        elif self._dead:
+            ids = np.flatnonzero(self._alive[: self._size])
+        else:
+            ids = None
+        scores = self._matrix[: self._size] @ query if ids is None else self._matrix[ids] @ query
+        k = min(k, scores.shape[0])
+        if not k:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k] if k < scores.shape[0] else np.arange(k)
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(float(scores[j]), int(j if ids is None else ids[j])) for j in top]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "sections": len(self),
+                "tombstoned": self._dead,
+                "docs": len(self._doc_rows),
+                "dim": self._dim,
+                "vectorized": self.vectorized,
+                "ann_clusters": len(self._ann.centroids) if self._ann is not None and self._ann.trained else 0,
+                "persisted": self._store is not None and self._store_generation is not None,
+                "skipped": self.skipped,
+            }
+
+
+class _NoLock:
+    def __enter__(self) -> None:
+        return None
+
+    def __exit__(self, *exc: Any) -> None:
+        return None
+
+
+_NO_LOCK = _NoLock()
+
+
+__all__ = ["KbVectorIndex"]
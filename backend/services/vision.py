@@ -3,88 +3,831 @@
 from __future__ import annotations
 
 import base64
+import hashlib
+import math
+import re
+import threading
 import time
+from collections import Counter, OrderedDict
 from io import BytesIO
-from typing import Dict, List
+from typing import Any, Dict, List, Tuple
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 
 import requests
 import urllib3
-from PIL import Image
+from PIL import Image, ImageChops, ImageFile
 
-from backend.config import IMAGE_MAX_SIZE_DEFAULT, IMAGE_QUALITY_DEFAULT
+from backend.config import (
+	IMAGE_MAX_SIZE_DEFAULT,
+	IMAGE_QUALITY_DEFAULT,
+	IMAGE_MAX_BYTES_DEFAULT,
+	IMAGE_CONNECT_TIMEOUT_DEFAULT,
+	IMAGE_READ_TIMEOUT_DEFAULT,
+	IMAGE_DEADLINE_SECONDS_DEFAULT,
+	IMAGE_DEDUP_DISTANCE_DEFAULT,
+	IMAGE_CROP_MARGINS_DEFAULT,
+	IMAGE_TOKEN_BUDGET_DEFAULT,
+	IMAGE_BYTE_BUDGET_DEFAULT,
+	PROMPT_COMPACTION_DEFAULT,
+	TEXT_BATCH_ROUTING_DEFAULT,
+)
+
+from . import image_store
+from .compaction import compact_prd_text, compaction_stats, count_numbered_images
+from .prefetch import ImagePrefetcher
+from .prompts import SQA_SYSTEM_PROMPT, split_prompt_template
 
 # Suppress warnings for requests made with verify=False when fetching images
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 
-def download_and_process_image(
+_DOWNLOAD_HEADERS = {
+	"User-Agent": (
+		"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
+		"AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+	),
+	"Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
+	"Accept-Encoding": "gzip, deflate, br",
+	"Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
+	"Connection": "keep-alive",
+}
+
+# Content types some CDNs send for images; anything else non-image is rejected early
+_GENERIC_CONTENT_TYPES = ("application/octet-stream", "binary/octet-stream", "")
+
+_CHUNK_SIZE = 64 * 1024
+
+
+class ImageRejected(Exception):
+	"""Raised when an image is refused (size cap, content type, deadline); never retried."""
+
+
+def fetch_image(
 	url: str,
+	*,
+	max_bytes: int = IMAGE_MAX_BYTES_DEFAULT,
+	connect_timeout: float = IMAGE_CONNECT_TIMEOUT_DEFAULT,
+	read_timeout: float = IMAGE_READ_TIMEOUT_DEFAULT,
+	deadline: float | None = None,
+) -> Image.Image:
+	"""Stream an image into PIL's incremental parser and return the decoded image.
+
+	- Rejects early on ``Content-Length`` above ``max_bytes`` or a non-image content type
+	- Aborts as soon as the streamed body exceeds ``max_bytes``
+	- ``deadline`` is an absolute ``time.monotonic()`` value bounding the whole fetch
+	- The sha256 of the source bytes is stored in ``img.info["source_sha256"]``
+	"""
+
+	def remaining() -> float:
+		if deadline is None:
+			return read_timeout
+		left = deadline - time.monotonic()
+		if left <= 0:
+			raise ImageRejected("超过单图下载时限")
+		return left
+
+	timeout = (min(connect_timeout, remaining()), min(read_timeout, remaining()))
+	with requests.get(url, timeout=timeout, headers=_DOWNLOAD_HEADERS, verify=False, stream=True) as response:
+		response.raise_for_status()
+
+		content_type = (response.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+		if not content_type.startswith("image/") and content_type not in _GENERIC_CONTENT_TYPES:
+			raise ImageRejected(f"非图片内容类型: {content_type}")
+
+		declared = response.headers.get("Content-Length")
+		if declared and declared.isdigit() and int(declared) > max_bytes:
+			raise ImageRejected(f"图片过大: {int(declared)} 字节 > {max_bytes}")
+
+		parser = ImageFile.Parser()
+		digest = hashlib.sha256()
+		received = 0
+		for chunk in response.iter_content(chunk_size=_CHUNK_SIZE):
+			if not chunk:
+				continue
+			received += len(chunk)
+			if received > max_bytes:
+				raise ImageRejected(f"图片过大: 已超过 {max_bytes} 字节")
+			remaining()
+			digest.update(chunk)
+			parser.feed(chunk)
+
+	try:
+		img = parser.close()
+	except Exception as exc:  # noqa: BLE001 - PIL raises several error types
+		raise ImageRejected(f"图片解码失败: {exc}") from exc
+	# Content hash of the source bytes; keys the encoder cache
+	img.info["source_sha256"] = digest.hexdigest()
+	return img
+
+
+def _to_rgb(img: Image.Image) -> Image.Image:
+	"""Flatten transparency onto a white background and return an RGB image."""
+
+	if img.mode in ("RGBA", "LA", "P"):
+		background = Image.new("RGB", img.size, (255, 255, 255))
+		if img.mode == "P":
+			img = img.convert("RGBA")
+		mask = img.split()[-1] if img.mode in ("RGBA", "LA") else None
+		background.paste(img, mask=mask)
+		return background
+	if img.mode != "RGB":
+		return img.convert("RGB")
+	return img
+
+
+# --- Model-aware sizing policies ---
+#
+# Vision models bill images by resolution. "tile" models (OpenAI GPT-4o family)
+# rescale to fit ``fit`` and a ``short_side`` cap, then charge per ``tile`` square;
+# "area" models (Claude) charge roughly pixels / ``pixels_per_token``; "patch"
+# models (Qwen-VL) charge per ``patch`` square. ``formats`` lists encodings the
+# byte-budget encoder may choose. The first matching pattern wins.
+
+_SIZING_POLICIES: List[Tuple[str, Dict[str, Any]]] = [
+	(r"gpt-4o-mini", {
+		"name": "openai-tile-mini", "kind": "tile", "tile": 512, "base_tokens": 2833,
+		"tile_tokens": 5667, "fit": 2048, "short_side": 768,
+		"formats": ("webp", "jpeg", "png"),
+	}),
+	(r"gpt-4o|gpt-4-turbo|gpt-4-vision|gpt-4\.1|gpt-4\.5|\bo1\b|\bo3\b", {
+		"name": "openai-tile", "kind": "tile", "tile": 512, "base_tokens": 85,
+		"tile_tokens": 170, "fit": 2048, "short_side": 768,
+		"formats": ("webp", "jpeg", "png"),
+	}),
+	(r"claude", {
+		"name": "anthropic-area", "kind": "area", "pixels_per_token": 750,
+		"max_edge": 1568, "max_pixels": 1_150_000, "formats": ("webp", "jpeg", "png"),
+	}),
+	(r"qwen.*vl|qvq", {
+		"name": "qwen-patch", "kind": "patch", "patch": 28, "max_pixels": 1280 * 28 * 28,
+		"formats": ("webp", "jpeg", "png"),
+	}),
+]
+
+# Unknown models only get JPEG, the one format every OpenAI-compatible endpoint accepts
+_DEFAULT_SIZING_POLICY: Dict[str, Any] = {
+	"name": "generic", "kind": "area", "pixels_per_token": 750, "formats": ("jpeg",),
+}
+
+# Snap down to a tile boundary when it costs at most this fraction of resolution
+_TILE_SNAP_SLACK = 0.2
+_MIN_IMAGE_EDGE = 256
+
+
+def select_sizing_policy(model_name: str | None) -> Dict[str, Any]:
+	"""Return the image sizing policy for a vision model name."""
+
+	name = (model_name or "").lower()
+	for pattern, policy in _SIZING_POLICIES:
+		if re.search(pattern, name):
+			return policy
+	return _DEFAULT_SIZING_POLICY
+
+
+def _provider_tile_dims(width: int, height: int, policy: Dict[str, Any]) -> Tuple[float, float]:
+	"""Dimensions a tile-billing provider rescales the image to before tiling."""
+
+	w, h = float(width), float(height)
+	fit = policy.get("fit")
+	if fit and max(w, h) > fit:
+		s = fit / max(w, h)
+		w, h = w * s, h * s
+	short = policy.get("short_side")
+	if short and min(w, h) > short:
+		s = short / min(w, h)
+		w, h = w * s, h * s
+	return w, h
+
+
+def estimate_image_tokens(width: int, height: int, policy: Dict[str, Any]) -> int:
+	"""Estimate vision input tokens for an image of the given size."""
+
+	kind = policy.get("kind")
+	if kind == "tile":
+		w, h = _provider_tile_dims(width, height, policy)
+		tile = policy["tile"]
+		tiles = math.ceil(w / tile) * math.ceil(h / tile)
+		return int(policy["base_tokens"] + policy["tile_tokens"] * tiles)
+	if kind == "patch":
+		patch = policy["patch"]
+		return math.ceil(width / patch) * math.ceil(height / patch)
+	return math.ceil(width * height / policy.get("pixels_per_token", 750))
+
+
+def plan_image_dimensions(
+	width: int,
+	height: int,
+	policy: Dict[str, Any],
 	max_size: int = IMAGE_MAX_SIZE_DEFAULT,
+) -> Tuple[int, int]:
+	"""Pick target dimensions (never upscaling) aligned to the policy's billing grid."""
+
+	scale = min(1.0, max_size / float(max(width, height)))
+	kind = policy.get("kind")
+
+	if kind == "tile":
+		# Sending more than the provider keeps only wastes payload
+		pw, ph = _provider_tile_dims(width, height, policy)
+		scale = min(scale, pw / width)
+		w, h = width * scale, height * scale
+		tile = policy["tile"]
+		# Smallest shrink that drops a whole row/column of tiles, if cheap enough
+		candidates = []
+		for d in (w, h):
+			snapped = math.floor(d / tile) * tile
+			if snapped and snapped < d and snapped / d >= 1.0 - _TILE_SNAP_SLACK:
+				candidates.append(snapped / d)
+		if candidates:
+			scale *= max(candidates)
+	elif kind == "area":
+		max_edge = policy.get("max_edge")
+		if max_edge:
+			scale = min(scale, max_edge / float(max(width, height)))
+		max_pixels = policy.get("max_pixels")
+		if max_pixels and width * height * scale * scale > max_pixels:
+			scale = math.sqrt(max_pixels / float(width * height))
+	elif kind == "patch":
+		max_pixels = policy.get("max_pixels")
+		if max_pixels and width * height * scale * scale > max_pixels:
+			scale = math.sqrt(max_pixels / float(width * height))
+
+	tw = max(1, int(width * scale))
+	th = max(1, int(height * scale))
+	if kind == "patch":
+		# Align to whole patches so the provider doesn't pad
+		patch = policy["patch"]
+		tw = max(patch, tw - tw % patch)
+		th = max(patch, th - th % patch)
+	return min(tw, width), min(th, height)
+
+
+def crop_uniform_margins(img: Image.Image, tolerance: int = 8, min_gain: float = 0.05) -> Image.Image:
+	"""Crop borders that match the top-left pixel colour when that saves ≥ ``min_gain`` area."""
+
+	background = Image.new(img.mode, img.size, img.getpixel((0, 0)))
+	diff = ImageChops.difference(img, background).convert("L")
+	bbox = diff.point(lambda p: 255 if p > tolerance else 0).getbbox()
+	if not bbox:
+		return img
+	pad = 4
+	left, top = max(0, bbox[0] - pad), max(0, bbox[1] - pad)
+	right, bottom = min(img.width, bbox[2] + pad), min(img.height, bbox[3] + pad)
+	if (right - left) * (bottom - top) > (1.0 - min_gain) * img.width * img.height:
+		return img
+	return img.crop((left, top, right, bottom))
+
+
+def _data_url_size(data_url: str) -> Tuple[int, int] | None:
+	try:
+		return Image.open(BytesIO(_decode_data_url(data_url))).size
+	except Exception:  # noqa: BLE001
+		return None
+
+
+def fit_images_to_token_budget(
+	images: List[Tuple[str, str]],
+	policy: Dict[str, Any],
+	token_budget: int,
 	quality: int = IMAGE_QUALITY_DEFAULT,
-) -> str | None:
-	"""Download an image, resize/compress it, and return a base64 data URL."""
+) -> Tuple[List[Tuple[str, str]], int]:
+	"""Lower resolution uniformly until the batch's estimated image tokens fit the budget.
 
-	max_retries = 3
-	retry_delay = 2
+	``images`` are (reference, data URL) pairs; returns the (possibly re-encoded)
+	pairs and their estimated token total.
+	"""
 
-	for attempt in range(max_retries):
-		try:
-			headers = {
-				"User-Agent": (
-					"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
-					"AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-				),
-				"Accept": "image/avif,image/webp,image/apng,image/svg+xml,image/*,*/*;q=0.8",
-				"Accept-Encoding": "gzip, deflate, br",
-				"Accept-Language": "zh-CN,zh;q=0.9,en;q=0.8",
-				"Connection": "keep-alive",
-			}
-
-			response = requests.get(
-				url,
-				timeout=15,
-				headers=headers,
-				verify=False,
-				stream=True,
-			)
-			response.raise_for_status()
+	sizes = [_data_url_size(u) for _, u in images]
+	total = sum(estimate_image_tokens(w, h, policy) for w, h in filter(None, sizes))
+	if token_budget <= 0 or total <= token_budget:
+		return images, total
 
-			img = Image.open(BytesIO(response.content))
+	factor = 1.0
+	planned = sizes
+	while total > token_budget:
+		factor *= 0.85
+		planned = []
+		for size in sizes:
+			if size is None:
+				planned.append(None)
+				continue
+			w, h = size
+			target = max(_MIN_IMAGE_EDGE, int(max(w, h) * factor))
+			planned.append(plan_image_dimensions(w, h, policy, target))
+		total = sum(estimate_image_tokens(w, h, policy) for w, h in filter(None, planned))
+		if all(p is None or max(p) <= _MIN_IMAGE_EDGE for p in planned):
+			break
+
+	resized: List[Tuple[str, str]] = []
+	for (ref, data_url), size, target in zip(images, sizes, planned):
+		if size is None or target is None or target == size:
+			resized.append((ref, data_url))
+			continue
+		img = _to_rgb(Image.open(BytesIO(_decode_data_url(data_url))))
+		img = img.resize(target, Image.Resampling.LANCZOS)
+		buffered = BytesIO()
+		img.save(buffered, format="JPEG", quality=quality, optimize=True)
+		resized.append((ref, "data:image/jpeg;base64," + base64.b64encode(buffered.getvalue()).decode("utf-8")))
+	return resized, total
+
+
+def summarize_image_tokens(batches: List[Dict]) -> Dict[str, Any]:
+	"""Collect per-batch image token estimates (set by build_vision_messages) for job meta."""
+
+	per_batch = [int(b.get("image_tokens") or 0) for b in batches]
+	return {"total": sum(per_batch), "per_batch": per_batch}
+
+
+# --- Byte-budget encoder ---
+
+_MIME_BY_FORMAT = {"jpeg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+_MIN_SEARCH_QUALITY = 35
+
+# (source sha256, size, quality, budget, formats) -> (bytes, mime, baseline bytes)
+_ENCODE_CACHE: "OrderedDict[Tuple[Any, ...], Tuple[bytes, str, int]]" = OrderedDict()
+_ENCODE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+_encode_cache_bytes = 0
+_ENCODE_LOCK = threading.Lock()
+
+
+def _save(img: Image.Image, fmt: str, quality: int) -> bytes:
+	buffered = BytesIO()
+	if fmt == "jpeg":
+		img.save(buffered, format="JPEG", quality=quality, optimize=True)
+	elif fmt == "webp":
+		img.save(buffered, format="WEBP", quality=quality, method=2)
+	else:
+		img.save(buffered, format="PNG")
+	return buffered.getvalue()
+
+
+def _search_quality(img: Image.Image, fmt: str, max_quality: int, byte_budget: int) -> Tuple[int, bytes] | None:
+	"""Highest quality in [_MIN_SEARCH_QUALITY, max_quality] whose encoding fits the budget."""
 
-			if img.mode in ("RGBA", "LA", "P"):
-				background = Image.new("RGB", img.size, (255, 255, 255))
-				if img.mode == "P":
-					img = img.convert("RGBA")
-				mask = img.split()[-1] if img.mode == "RGBA" else None
-				background.paste(img, mask=mask)
-				img = background
+	lo, hi = _MIN_SEARCH_QUALITY, max(_MIN_SEARCH_QUALITY, max_quality)
+	# Common case: the requested quality already fits
+	data = _save(img, fmt, hi)
+	if len(data) <= byte_budget:
+		return hi, data
+	hi -= 1
+	best: Tuple[int, bytes] | None = None
+	while lo <= hi:
+		mid = (lo + hi) // 2
+		data = _save(img, fmt, mid)
+		if len(data) <= byte_budget:
+			best = (mid, data)
+			lo = mid + 1
+		else:
+			hi = mid - 1
+	return best
 
-			img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
 
-			buffered = BytesIO()
-			img.save(buffered, format="JPEG", quality=quality, optimize=True)
-			img_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+def encode_image(
+	img: Image.Image,
+	*,
+	quality: int = IMAGE_QUALITY_DEFAULT,
+	byte_budget: int = IMAGE_BYTE_BUDGET_DEFAULT,
+	formats: Tuple[str, ...] = ("jpeg",),
+) -> Tuple[bytes, str, int]:
+	"""Encode an RGB image, returning (bytes, mime, baseline JPEG size).
+
+	Without a byte budget this is the fixed-quality JPEG encoder. With one, a
+	palette PNG is used for flat images (≤256 colours) when allowed and it
+	fits; otherwise each allowed lossy format is searched for the highest
+	quality that fits (ties go to the smaller file), and the smallest encoding
+	is used when nothing fits.
+	"""
+
+	baseline = _save(img, "jpeg", quality)
+	if byte_budget <= 0:
+		return baseline, "image/jpeg", len(baseline)
+
+	if "png" in formats and img.getcolors(256) is not None:
+		png = _save(img.convert("P", palette=Image.Palette.ADAPTIVE, colors=256), "png", 0)
+		# Lossless, within budget and no larger than the baseline: take it
+		if len(png) <= min(byte_budget, len(baseline)):
+			return png, "image/png", len(baseline)
+
+	candidates: List[Tuple[int, int, bytes, str]] = [(quality, -len(baseline), baseline, "jpeg")]
+	for fmt in formats:
+		if fmt == "jpeg" and len(baseline) <= byte_budget:
+			continue
+		if fmt in ("jpeg", "webp"):
+			found = _search_quality(img, fmt, quality, byte_budget)
+			if found is not None:
+				q, data = found
+				candidates.append((q, -len(data), data, fmt))
+
+	fitting = [c for c in candidates if len(c[2]) <= byte_budget]
+	if fitting:
+		_, _, data, fmt = max(fitting, key=lambda c: (c[0], c[1]))
+	else:
+		smallest = min(
+			[c[2:] for c in candidates]
+			+ [(_save(img, f, _MIN_SEARCH_QUALITY), f) for f in formats if f in ("jpeg", "webp")],
+			key=lambda c: len(c[0]),
+		)
+		data, fmt = smallest
+	return data, _MIME_BY_FORMAT[fmt], len(baseline)
+
+
+def _encode_cached(
+	img: Image.Image,
+	source_key: str | None,
+	*,
+	quality: int,
+	byte_budget: int,
+	formats: Tuple[str, ...],
+) -> Tuple[bytes, str, int]:
+	global _encode_cache_bytes
+	if not source_key or byte_budget <= 0:
+		return encode_image(img, quality=quality, byte_budget=byte_budget, formats=formats)
+	key = (source_key, img.size, quality, byte_budget, formats)
+	with _ENCODE_LOCK:
+		hit = _ENCODE_CACHE.get(key)
+		if hit is not None:
+			_ENCODE_CACHE.move_to_end(key)
+			return hit
+	encoded = encode_image(img, quality=quality, byte_budget=byte_budget, formats=formats)
+	with _ENCODE_LOCK:
+		if key not in _ENCODE_CACHE:
+			_ENCODE_CACHE[key] = encoded
+			_encode_cache_bytes += len(encoded[0])
+			while _encode_cache_bytes > _ENCODE_CACHE_MAX_BYTES and _ENCODE_CACHE:
+				_, old = _ENCODE_CACHE.popitem(last=False)
+				_encode_cache_bytes -= len(old[0])
+	return encoded
+
 
-			return f"data:image/jpeg;base64,{img_base64}"
+def _payload_bytes(data_url: str, baseline: int | None = None) -> Tuple[int, int]:
+	"""(bytes sent, baseline bytes) for a data URL; baseline defaults to sent."""
 
+	_, _, payload = data_url.partition(",")
+	sent = len(payload) * 3 // 4 - payload[-2:].count("=")
+	return sent, sent if baseline is None else baseline
+
+
+def summarize_image_payload(batches: List[Dict]) -> Dict[str, Any]:
+	"""Collect per-batch image payload bytes (set by build_vision_messages) for job meta."""
+
+	per_batch = [b.get("image_bytes") or {"sent": 0, "baseline": 0, "saved": 0} for b in batches]
+	sent = sum(p["sent"] for p in per_batch)
+	baseline = sum(p["baseline"] for p in per_batch)
+	return {"sent": sent, "baseline": baseline, "saved": baseline - sent, "per_batch": per_batch}
+
+
+def _download_and_encode(
+	url: str,
+	max_size: int = IMAGE_MAX_SIZE_DEFAULT,
+	quality: int = IMAGE_QUALITY_DEFAULT,
+	*,
+	max_bytes: int = IMAGE_MAX_BYTES_DEFAULT,
+	deadline_seconds: float = IMAGE_DEADLINE_SECONDS_DEFAULT,
+	policy: Dict[str, Any] | None = None,
+	crop_margins: bool = IMAGE_CROP_MARGINS_DEFAULT,
+	byte_budget: int = IMAGE_BYTE_BUDGET_DEFAULT,
+) -> Tuple[bytes, str, int] | None:
+	"""Download an image, resize/compress it, and return (bytes, mime, baseline bytes).
+
+	Target dimensions come from ``policy`` (see ``select_sizing_policy``),
+	bounded by ``max_size``; with ``byte_budget`` the encoder searches the
+	formats the policy allows. Transient network errors are retried while the
+	per-image deadline allows; rejected images (too large, wrong type,
+	undecodable) are skipped immediately.
+	"""
+
+	policy = policy or _DEFAULT_SIZING_POLICY
+
+	max_retries = 3
+	retry_delay = 2
+	deadline = time.monotonic() + max(1.0, float(deadline_seconds))
+
+	for attempt in range(max_retries):
+		try:
+			img = fetch_image(url, max_bytes=max_bytes, deadline=deadline)
+			source_key = img.info.get("source_sha256")
+			img = _to_rgb(img)
+			if crop_margins:
+				img = crop_uniform_margins(img)
+			target = plan_image_dimensions(img.width, img.height, policy, max_size)
+			if target != img.size:
+				img = img.resize(target, Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+			if source_key:
+				source_key = f"{source_key}:{int(crop_margins)}"
+			return _encode_cached(
+				img,
+				source_key,
+				quality=quality,
+				byte_budget=int(byte_budget or 0),
+				formats=tuple(policy.get("formats", ("jpeg",))),
+			)
+
+		except ImageRejected as exc:
+			print(f"跳过图片 {url}: {exc}")
+			return None
+		except requests.exceptions.HTTPError as exc:
+			status = exc.response.status_code if exc.response is not None else 0
+			retryable = status == 429 or status >= 500
+			if retryable and attempt < max_retries - 1 and time.monotonic() + retry_delay < deadline:
+				time.sleep(retry_delay)
+				continue
+			print(f"处理图片失败（HTTP {status}）{url}: {exc}")
+			return None
 		except requests.exceptions.SSLError as exc:
-			if attempt < max_retries - 1:
+			if attempt < max_retries - 1 and time.monotonic() + retry_delay < deadline:
 				time.sleep(retry_delay)
 				continue
-			print(f"处理图片失败（SSL 错误，已重试 {max_retries} 次）{url}: {exc}")
+			print(f"处理图片失败（SSL 错误，已尝试 {attempt + 1} 次）{url}: {exc}")
 			return None
 		except Exception as exc:
-			if attempt < max_retries - 1:
+			if attempt < max_retries - 1 and time.monotonic() + retry_delay < deadline:
 				time.sleep(retry_delay)
 				continue
-			print(f"处理图片失败（已重试 {max_retries} 次）{url}: {exc}")
+			print(f"处理图片失败（已尝试 {attempt + 1} 次）{url}: {exc}")
 			return None
 
 	return None
 
 
+def download_and_encode_image(
+	url: str,
+	max_size: int = IMAGE_MAX_SIZE_DEFAULT,
+	quality: int = IMAGE_QUALITY_DEFAULT,
+	**kwargs: Any,
+) -> Tuple[bytes, str] | None:
+	"""Download an image, resize/compress it, and return (encoded bytes, mime)."""
+
+	encoded = _download_and_encode(url, max_size, quality, **kwargs)
+	if encoded is None:
+		return None
+	data, mime, _ = encoded
+	return data, mime
+
+
+def _download_data_url(
+	url: str,
+	max_size: int = IMAGE_MAX_SIZE_DEFAULT,
+	quality: int = IMAGE_QUALITY_DEFAULT,
+	**kwargs: Any,
+) -> Tuple[str, int] | None:
+	"""Download an image and return (base64 data URL, baseline JPEG bytes)."""
+
+	encoded = _download_and_encode(url, max_size, quality, **kwargs)
+	if encoded is None:
+		return None
+	data, mime, baseline = encoded
+	return f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}", baseline
+
+
+def download_and_process_image(
+	url: str,
+	max_size: int = IMAGE_MAX_SIZE_DEFAULT,
+	quality: int = IMAGE_QUALITY_DEFAULT,
+	**kwargs: Any,
+) -> str | None:
+	"""Download an image, resize/compress it, and return a base64 data URL."""
+
+	encoded = _download_data_url(url, max_size, quality, **kwargs)
+	return encoded[0] if encoded else None
+
+
+def _is_local_image(ref: object) -> bool:
+	"""Preprocessed images: inline data URLs or KB blob-store references."""
+
+	return isinstance(ref, str) and (ref.startswith("data:image") or image_store.is_ref(ref))
+
+
+def _materialize_local_image(ref: str) -> str | None:
+	if image_store.is_ref(ref):
+		try:
+			return image_store.to_data_url(ref)
+		except Exception as exc:  # noqa: BLE001
+			print(f"读取知识库图片失败 {ref}: {exc}")
+			return None
+	return ref
+
+
+def _decode_data_url(data_url: str) -> bytes:
+	_, _, payload = data_url.partition(",")
+	return base64.b64decode(payload)
+
+
+def image_dhash(img: Image.Image, hash_size: int = 8) -> int:
+	"""Return a ``hash_size``² bit difference hash (dHash) of the image."""
+
+	if img.format == "JPEG":
+		# Let the JPEG decoder downscale in the DCT domain; far cheaper than a full decode
+		img.draft("L", (hash_size * 8, hash_size * 8))
+	small = img.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+	px = list(small.getdata())
+	bits = 0
+	width = hash_size + 1
+	for row in range(hash_size):
+		offset = row * width
+		for col in range(hash_size):
+			bits = (bits << 1) | (1 if px[offset + col] > px[offset + col + 1] else 0)
+	return bits
+
+
+def data_url_dhash(data_url: str) -> int | None:
+	"""dHash of an image data URL, or ``None`` when it cannot be decoded."""
+
+	try:
+		return image_dhash(Image.open(BytesIO(_decode_data_url(data_url))))
+	except Exception:  # noqa: BLE001
+		return None
+
+
+def hamming_distance(a: int, b: int) -> int:
+	return bin(a ^ b).count("1")
+
+
+def prune_near_duplicate_images(
+	images: List[Tuple[str, str]],
+	max_distance: int,
+) -> Tuple[List[Tuple[str, str]], List[Dict[str, Any]]]:
+	"""Collapse near-identical images, keeping the first of each group.
+
+	``images`` is a list of (original reference, data URL) pairs. Returns the
+	kept pairs in order plus a list of ``{"kept": ref, "merged": [refs]}``
+	records. Data-URL references are recorded by position to keep meta small.
+	"""
+
+	def ref_of(idx: int, ref: str) -> str:
+		return f"#{idx + 1}" if ref.startswith("data:") else ref
+
+	kept: List[Tuple[str, str]] = []
+	kept_hashes: List[int | None] = []
+	kept_refs: List[str] = []
+	merged_into: Dict[int, List[str]] = {}
+
+	for idx, (ref, data_url) in enumerate(images):
+		h = data_url_dhash(data_url)
+		match = -1
+		if h is not None:
+			for k, kh in enumerate(kept_hashes):
+				if kh is not None and hamming_distance(h, kh) <= max_distance:
+					match = k
+					break
+		if match >= 0:
+			merged_into.setdefault(match, []).append(ref_of(idx, ref))
+			continue
+		kept.append((ref, data_url))
+		kept_hashes.append(h)
+		kept_refs.append(ref_of(idx, ref))
+
+	merged = [{"kept": kept_refs[k], "merged": refs} for k, refs in sorted(merged_into.items())]
+	return kept, merged
+
+
+def prune_section_images(
+	sections: List[Dict],
+	max_distance: int,
+	*,
+	prefetcher: ImagePrefetcher | None = None,
+) -> int:
+	"""Drop near-duplicate images within each section in place, before batch planning.
+
+	Pruned images then also reduce the number of batches and calls. Local
+	images (data URLs / KB refs) are read directly; remote ones are taken
+	from ``prefetcher`` (which keeps kept images buffered for their batch and
+	frees pruned ones), so planning waits for the section's downloads.
+	Without a prefetcher, sections with remote images are left to
+	``build_vision_messages``. Merge records go to ``section["merged_images"]``
+	and ``section["image_aliases"]`` maps each dropped reference to the kept
+	one, so its tags in the text still point at an attachment. Returns the
+	number of images removed.
+	"""
+
+	removed = 0
+	for section in sections:
+		imgs = section.get("images") or []
+		if len(imgs) < 2:
+			continue
+		if prefetcher is None and not all(_is_local_image(u) for u in imgs):
+			continue
+		pairs = [
+			(u, (_materialize_local_image(u) if _is_local_image(u) else (prefetcher.peek(u) or ("",))[0]) or "")
+			for u in imgs
+		]
+		kept, merged = prune_near_duplicate_images(pairs, max_distance)
+		if not merged:
+			continue
+
+		def full_ref(ref: str) -> str:
+			# prune_near_duplicate_images records data-URL references by position
+			return pairs[int(ref[1:]) - 1][0] if ref.startswith("#") else ref
+
+		aliases = section.setdefault("image_aliases", {})
+		for record in merged:
+			for ref in record["merged"]:
+				aliases[full_ref(ref)] = full_ref(record["kept"])
+		kept_refs = [ref for ref, _ in kept]
+		if prefetcher is not None:
+			# One discard per dropped occurrence (the same URL may repeat in a section)
+			for ref, count in (Counter(imgs) - Counter(kept_refs)).items():
+				if not _is_local_image(ref):
+					for _ in range(count):
+						prefetcher.discard(ref)
+		section["images"] = kept_refs
+		section.setdefault("merged_images", []).extend(merged)
+		removed += len(imgs) - len(kept)
+	return removed
+
+
+def summarize_image_dedup(batches: List[Dict]) -> Dict[str, Any]:
+	"""Collect per-batch merge records (set by build_vision_messages) for job meta."""
+
+	per_batch = []
+	pruned = 0
+	for i, b in enumerate(batches):
+		merged = list(b.get("merged_images") or [])
+		for s in b.get("sections", []):
+			merged.extend(s.get("merged_images") or [])
+		if merged:
+			pruned += sum(len(m["merged"]) for m in merged)
+			per_batch.append({"batch": i + 1, "merged": merged})
+	return {"images_pruned": pruned, "batches": per_batch}
+
+
+def start_image_prefetch(
+	sections: List[Dict],
+	*,
+	vision_model: str | None = None,
+	image_max_size: int = IMAGE_MAX_SIZE_DEFAULT,
+	image_quality: int = IMAGE_QUALITY_DEFAULT,
+	image_crop_margins: bool = IMAGE_CROP_MARGINS_DEFAULT,
+	image_byte_budget: int = IMAGE_BYTE_BUDGET_DEFAULT,
+	concurrency: int = 4,
+	on_progress: Any = None,
+) -> ImagePrefetcher:
+	"""Start downloading every remote image in ``sections`` in the background.
+
+	Pass the returned prefetcher to ``build_vision_messages`` so batches pick up
+	ready images instead of fetching them when the batch is scheduled. The
+	caller owns the prefetcher and must ``close()`` it.
+	"""
+
+	policy = select_sizing_policy(vision_model)
+
+	def fetch(url: str) -> Tuple[str, int] | None:
+		return _download_data_url(
+			url,
+			image_max_size,
+			image_quality,
+			policy=policy,
+			crop_margins=image_crop_margins,
+			byte_budget=image_byte_budget,
+		)
+
+	prefetcher = ImagePrefetcher(fetch, concurrency=concurrency, on_progress=on_progress)
+	prefetcher.submit(
+		url
+		for section in sections
+		for url in (section.get("images") or [])
+		if isinstance(url, str) and not _is_local_image(url)
+	)
+	return prefetcher
+
+
+def select_batch_model(
+	batch: Dict,
+	vision_model: str | None,
+	text_model: str | None,
+	*,
+	route_text_batches: bool = TEXT_BATCH_ROUTING_DEFAULT,
+) -> str | None:
+	"""Model for one batch: image-free batches go to the text model when routing is on."""
+
+	if route_text_batches and text_model and not batch.get("total_images"):
+		return text_model
+	return vision_model
+
+
+def summarize_batch_models(
+	batches: List[Dict],
+	vision_model: str | None,
+	text_model: str | None,
+	*,
+	route_text_batches: bool = TEXT_BATCH_ROUTING_DEFAULT,
+) -> Dict[str, int]:
+	"""Batch count per model, for job meta."""
+
+	counts: Dict[str, int] = {}
+	for batch in batches:
+		model = select_batch_model(batch, vision_model, text_model, route_text_batches=route_text_batches)
+		counts[str(model)] = counts.get(str(model), 0) + 1
+	return counts
+
+
+# Shared by every batch; per-batch numbering goes in the variable part
+_ID_RULES = (
+	"【用例编号规则】用例 ID 格式为：TC-[模块]-[功能]-[序号]，序号为 4 位并连续递增，"
+	"每个用例 ID 的数字部分必须唯一，不得重复使用已出现的编号。"
+)
+
+
 def build_vision_messages(
 	batch: Dict,
 	prompt_template: str,
@@ -95,96 +838,215 @@ def build_vision_messages(
 	image_max_size: int = IMAGE_MAX_SIZE_DEFAULT,
 	image_quality: int = IMAGE_QUALITY_DEFAULT,
 	image_download_concurrency: int = 4,
+	image_dedup_distance: int | None = IMAGE_DEDUP_DISTANCE_DEFAULT,
+	vision_model: str | None = None,
+	image_crop_margins: bool = IMAGE_CROP_MARGINS_DEFAULT,
+	image_token_budget: int = IMAGE_TOKEN_BUDGET_DEFAULT,
+	prefetcher: ImagePrefetcher | None = None,
+	image_byte_budget: int = IMAGE_BYTE_BUDGET_DEFAULT,
+	compact_prompt: bool = PROMPT_COMPACTION_DEFAULT,
 ) -> List[Dict]:
-	"""Assemble chat messages containing text and optional images."""
+	"""Assemble chat messages containing text and optional images.
+
+	When ``image_dedup_distance`` is non-negative, near-duplicate images in the
+	batch are collapsed and the merges are recorded in ``batch["merged_images"]``.
+	Images are sized by the policy for ``vision_model``; the estimated image
+	tokens are stored in ``batch["image_tokens"]`` and, with a positive
+	``image_token_budget``, resolution is lowered until the batch fits.
+	Remote images come from ``prefetcher`` when one is given. Encoded payload
+	bytes versus the fixed-quality JPEG baseline go to ``batch["image_bytes"]``.
+	With ``compact_prompt``, section text goes through ``compact_prd_text``
+	(image tags become ``[图N]`` placeholders matching the attachment order)
+	and the estimated text tokens saved are stored in ``batch["prompt_tokens"]``.
+	A batch without images gets plain text messages (see ``select_batch_model``).
+	The system message (``SQA_SYSTEM_PROMPT``) and the start of the user
+	message (template instructions and ID rules) are the same for every batch;
+	whether images are attached, batch position and PRD text come after them.
+	"""
+
+	policy = select_sizing_policy(vision_model)
 
 	combined_text = "\n\n".join(
 		[f"## {section['title']}\n{section['text']}" for section in batch["sections"]]
 	)
 
+	# Invariant prefix (template instructions + ID rules) first and the
+	# per-batch part last, so provider prefix caches hit across batches and jobs
+	instructions, content_template = split_prompt_template(prompt_template)
+	prompt_prefix = (instructions + "\n\n" if instructions else "") + _ID_RULES
+
+	def render_prompt(image_index: Dict[str, int], modality_note: str = "") -> str:
+		text = combined_text
+		if compact_prompt:
+			text = compact_prd_text(combined_text, image_index)
+			batch["prompt_tokens"] = compaction_stats(combined_text, text)
+			# Only when a tag really became [图N]; unmatched tags are plain [图片]
+			if count_numbered_images(combined_text, image_index):
+				text += "\n\n（文中的 [图N] 指随附的第 N 张图片）"
+		return modality_note + batch_info + content_template.format(prd_content=text)
+
+	# IDs are renumbered globally when batches are merged (merge_csv_rows)
 	batch_info = ""
 	if total_batches > 1:
-		start_id = batch_index * 200 + 1
-		batch_info = (
-			f"\n\n【重要提示】这是第 {batch_index + 1}/{total_batches} 批次的 PRD 内容，"
-			"请基于本批次内容生成测试用例。\n"
-			f"【用例编号规则】本批次的用例 ID 必须从 {start_id:04d} 开始递增编号，"
-			"格式为：TC-[模块]-[功能]-{start_id:04d}、TC-[模块]-[功能]-{start_id + 1:04d}... 依次类推。\n"
-			"【严格要求】每个用例 ID 的数字部分必须唯一且连续递增，不得重复使用已出现的编号。"
-		)
-	else:
 		batch_info = (
-			"\n\n【用例编号规则】用例 ID 格式为：TC-[模块]-[功能]-[序号]，"
-			"序号从 0001 开始递增（0001、0002、0003...），每个 ID 必须唯一。"
+			f"【批次】这是第 {batch_index + 1}/{total_batches} 批次的 PRD 内容，请基于本批次内容生成测试用例。\n\n"
 		)
 
-	final_prompt = prompt_template.format(prd_content=combined_text) + batch_info
-
 	all_image_urls = []
 	for section in batch["sections"]:
 		all_image_urls.extend(section.get("images", []))
 
-	if use_deepseek:
-		image_section = "\n\n" + "\n".join([f"![图片]({url})" for url in all_image_urls])
-		messages = [
-			{
-				"role": "system",
-				"content": "你是一名资深SQA工程师。请严格基于以下PRD（包含文本和图片）生成测试用例，使用简体中文，不得编造无关场景。",
-			},
-			{"role": "user", "content": final_prompt + image_section},
+	if not all_image_urls:
+		# Plain string content, so image-free batches can go to a text-only model
+		return [
+			{"role": "system", "content": SQA_SYSTEM_PROMPT},
+			{"role": "user", "content": prompt_prefix + "\n\n" + render_prompt({})},
 		]
-		return messages
-
-	content: List[Dict] = [{"type": "text", "text": final_prompt}]
 
-	# If images are already data URLs (preprocessed), just attach them
-	if all(all_u.startswith("data:image") for all_u in all_image_urls if isinstance(all_u, str)) and all_image_urls:
-		for data_url in all_image_urls:
-			if isinstance(data_url, str) and data_url.startswith("data:image"):
-				content.append({"type": "image_url", "image_url": {"url": data_url}})
+	if use_deepseek:
+		# Only remote URLs are meaningful as text; local blobs can't be linked
+		linked = list(dict.fromkeys(url for url in all_image_urls if not _is_local_image(url)))
+		final_prompt = render_prompt(
+			{url: n for n, url in enumerate(linked, 1)},
+			"【说明】本批次 PRD 包含文本和图片，图片以链接形式列在末尾。\n\n",
+		)
+		if compact_prompt:
+			image_section = "\n\n" + "\n".join([f"图{n}: {url}" for n, url in enumerate(linked, 1)])
+		else:
+			image_section = "\n\n" + "\n".join([f"![图片]({url})" for url in linked])
 		messages = [
-			{
-				"role": "system",
-				"content": "你是一名资深SQA工程师。请严格基于以下PRD（包含文本和图片）生成测试用例，使用简体中文，不得编造无关场景。",
-			},
-			{"role": "user", "content": content},
+			{"role": "system", "content": SQA_SYSTEM_PROMPT},
+			{"role": "user", "content": prompt_prefix + "\n\n" + final_prompt + image_section},
 		]
 		return messages
 
-	# Concurrent image processing with bounded workers (download + resize)
-	if image_download_concurrency > 1 and len(all_image_urls) > 1:
+	# (original reference, data URL) pairs in document order
+	processed: List[Tuple[str, str]] = []
+
+	# Preprocessed images (data URLs / KB blob refs) are materialized locally;
+	# everything else is downloaded + resized with bounded concurrency.
+	remote_urls = [u for u in all_image_urls if not _is_local_image(u)]
+	# url -> (data URL, baseline JPEG bytes) or None
+	results: Dict[str, Tuple[str, int] | None] = {}
+	if prefetcher is not None:
+		for img_url in remote_urls:
+			results[img_url] = prefetcher.get(img_url)
+	elif image_download_concurrency > 1 and len(remote_urls) > 1:
 		def task(url):
-			return url, download_and_process_image(url, image_max_size, image_quality)
+			return url, _download_data_url(
+				url,
+				image_max_size,
+				image_quality,
+				policy=policy,
+				crop_margins=image_crop_margins,
+				byte_budget=image_byte_budget,
+			)
 
 		with ThreadPoolExecutor(max_workers=image_download_concurrency) as ex:
-			futures = [ex.submit(task, u) for u in all_image_urls]
-			# Preserve order according to original URL list
-			results: Dict[str, str | None] = {}
+			futures = [ex.submit(task, u) for u in remote_urls]
 			for fut in as_completed(futures):
 				url, res = fut.result()
 				results[url] = res
-		for img_url in all_image_urls:
-			processed = results.get(img_url)
-			if processed:
-				content.append({"type": "image_url", "image_url": {"url": processed}})
-			else:
-				print(f"跳过无法处理的图片: {img_url}")
 	else:
-		for img_url in all_image_urls:
-			processed = download_and_process_image(img_url, image_max_size, image_quality)
-			if processed:
-				content.append({"type": "image_url", "image_url": {"url": processed}})
-			else:
-				print(f"跳过无法处理的图片: {img_url}")
+		for img_url in remote_urls:
+			results[img_url] = _download_data_url(
+				img_url,
+				image_max_size,
+				image_quality,
+				policy=policy,
+				crop_margins=image_crop_margins,
+				byte_budget=image_byte_budget,
+			)
+
+	# Preserve order according to original URL list; baselines are only known
+	# for images encoded here (local blobs and re-encodes count as sent)
+	baselines: Dict[str, int] = {}
+	for img_url in all_image_urls:
+		if _is_local_image(img_url):
+			data_url = _materialize_local_image(img_url)
+		else:
+			encoded = results.get(img_url)
+			data_url = encoded[0] if encoded else None
+			if encoded:
+				baselines[data_url] = encoded[1]
+		if data_url:
+			processed.append((img_url, data_url))
+		else:
+			print(f"跳过无法处理的图片: {str(img_url)[:120]}")
+
+	merged: List[Dict[str, Any]] = []
+	before_prune = processed
+	if image_dedup_distance is not None and image_dedup_distance >= 0 and len(processed) > 1:
+		processed, merged = prune_near_duplicate_images(processed, image_dedup_distance)
+		batch["merged_images"] = merged
+
+	processed, batch["image_tokens"] = fit_images_to_token_budget(
+		processed, policy, int(image_token_budget or 0), image_quality
+	)
+
+	sent = baseline = 0
+	for _, data_url in processed:
+		s, b = _payload_bytes(data_url, baselines.get(data_url))
+		sent += s
+		baseline += b
+	batch["image_bytes"] = {"sent": sent, "baseline": baseline, "saved": baseline - sent}
+
+	# Attachment number of every image reference; merged duplicates point at the kept image
+	image_index: Dict[str, int] = {}
+	for n, (ref, _) in enumerate(processed, 1):
+		image_index.setdefault(ref, n)
+
+	def resolve(ref: str) -> str:
+		# prune_near_duplicate_images records data-URL references by position
+		return before_prune[int(ref[1:]) - 1][0] if ref.startswith("#") else ref
+
+	for record in merged:
+		n = image_index.get(resolve(record["kept"]))
+		if n:
+			for ref in record["merged"]:
+				image_index.setdefault(resolve(ref), n)
+	# Duplicates already dropped before planning (prune_section_images)
+	for section in batch["sections"]:
+		for ref, kept_ref in (section.get("image_aliases") or {}).items():
+			n = image_index.get(kept_ref)
+			if n:
+				image_index.setdefault(ref, n)
+
+	content: List[Dict] = [
+		{"type": "text", "text": prompt_prefix},
+		{"type": "text", "text": render_prompt(image_index, "【说明】本批次 PRD 包含文本和图片，图片随附在末尾。\n\n")},
+	]
+	for _, data_url in processed:
+		content.append({"type": "image_url", "image_url": {"url": data_url}})
 
 	messages = [
-		{
-			"role": "system",
-			"content": "你是一名资深SQA工程师。请严格基于以下PRD（包含文本和图片）生成测试用例，使用简体中文，不得编造无关场景。",
-		},
+		{"role": "system", "content": SQA_SYSTEM_PROMPT},
 		{"role": "user", "content": content},
 	]
 	return messages
 
 
-__all__ = ["download_and_process_image", "build_vision_messages"]
+__all__ = [
+	"ImageRejected",
+	"select_batch_model",
+	"summarize_batch_models",
+	"fetch_image",
+	"download_and_encode_image",
+	"download_and_process_image",
+	"image_dhash",
+	"data_url_dhash",
+	"hamming_distance",
+	"prune_near_duplicate_images",
+	"prune_section_images",
+	"summarize_image_dedup",
+	"select_sizing_policy",
+	"estimate_image_tokens",
+	"plan_image_dimensions",
+	"crop_uniform_margins",
+	"fit_images_to_token_budget",
+	"summarize_image_tokens",
+	"encode_image",
+	"summarize_image_payload",
+	"start_image_prefetch",
+	"build_vision_messages",
+]
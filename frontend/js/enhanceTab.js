@@ -340,7 +340,10 @@ export function initEnhanceTab() {
                     if (!st.ok) throw new Error("查询任务失败");
                     const js = await st.json();
                     if (js.status === "done") {
-                        enhancedContent = js.result || "";
+                        // Status polls carry no result; download it once when done
+                        const res = await fetch(`/api/job_result/${jobId}.csv`);
+                        if (!res.ok) throw new Error("获取任务结果失败");
+                        enhancedContent = await res.text();
                         if (isLikelyCsv(enhancedContent)) {
                             outputContainer.innerHTML = csvToHtmlTable(enhancedContent);
                         } else {
@@ -158,6 +158,34 @@ function resetModeIndicator(indicator) {
     indicator.innerHTML = "";
 }
 
+async function previewBatchPlan(target, prdText) {
+    if (!target) {
+        return;
+    }
+    if (!prdText.trim()) {
+        target.classList.add("hidden");
+        return;
+    }
+
+    try {
+        const response = await fetch("/api/plan", {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ new_prd: prdText, config: buildRequestConfig() }),
+        });
+        if (!response.ok) {
+            target.classList.add("hidden");
+            return;
+        }
+        const plan = await response.json();
+        target.textContent = `预计 ${plan.total_batches} 个批次（${plan.total_sections} 个章节，${plan.total_images} 张图片）`;
+        target.classList.remove("hidden");
+    } catch (error) {
+        console.error(error);
+        target.classList.add("hidden");
+    }
+}
+
 function toggleLoading(loadingEl, submitButton, isLoading) {
     if (loadingEl) {
         loadingEl.classList.toggle("hidden", !isLoading);
@@ -253,6 +281,7 @@ export function initGenerationTab() {
     const loadingIndicator = document.getElementById("generateLoading");
     const outputContainer = document.getElementById("generateOutput");
     const modeIndicator = document.getElementById("generateModeIndicator");
+    const planPreview = document.getElementById("generatePlanPreview");
     const timer = setupTimer("generateTimer");
 
     setupFileInput(oldPrdInput, oldPrdLabel, (text) => {
@@ -260,6 +289,7 @@ export function initGenerationTab() {
     });
     setupFileInput(newPrdInput, newPrdLabel, (text) => {
         newPrdText = text;
+        previewBatchPlan(planPreview, text);
     });
 
     exportButton?.addEventListener("click", () => {
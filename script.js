@@ -262,8 +262,11 @@ document.addEventListener('DOMContentLoaded', () => {
                     genEtaText.textContent = `预计剩余 ${m}分${s}秒`;
                 }
                 if (js.status === 'done') {
-                    currentTestCases = js.result;
-                    testCaseOutput.innerHTML = marked.parse(js.result);
+                    // 状态接口不再携带结果，完成后单独下载一次
+                    const res = await fetch(`/api/job_result/${jobId}.csv`);
+                    if (!res.ok) throw new Error('获取任务结果失败');
+                    currentTestCases = await res.text();
+                    testCaseOutput.innerHTML = marked.parse(currentTestCases);
                     exportBtn.classList.remove('hidden');
                     if (js.meta) {
                         ensureModeBadge(!!oldPrdText.trim(), !!js.meta.use_vision);
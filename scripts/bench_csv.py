@@ -0,0 +1,161 @@
+"""Benchmark CSV post-processing on large merged model outputs.
+
+Compares the previous validate -> coerce -> validate sequence (kept below as
+``old_pipeline``: a strict check, a full re-parse to repair, a second check)
+with the single-pass ``normalize_csv`` on synthetic multi-batch CSV containing the
+usual defects (code fences, repeated headers, extra/missing cells, blank lines),
+then times near-duplicate removal on the rows plus 10% perturbed copies.
+
+Usage:
+    python scripts/bench_csv.py                    # 50k rows
+    python scripts/bench_csv.py --rows 10000 200000
+    python scripts/bench_csv.py --trace-memory     # also report peak memory (slower)
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import io
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backend.services.dedup import dedupe_case_rows  # noqa: E402
+from backend.services.postprocess import (  # noqa: E402
+	EXPECTED_HEADER,
+	_find_header,
+	_strip_code_fences,
+	iter_normalized_csv,
+	normalize_csv,
+)
+
+
+def make_csv(rows: int, batch_rows: int = 40, seed: int = 0) -> str:
+	"""Build merged CSV text of ``rows`` data rows split into model-sized batches."""
+
+	rng = random.Random(seed)
+	header = ",".join(EXPECTED_HEADER)
+	words = ["登录", "订单", "支付", "校验", "按钮", "页面", "提示", "字段", "状态", "权限"]
+	out = ["```csv", header]
+	for n in range(1, rows + 1):
+		if n > 1 and n % batch_rows == 1:
+			out.extend(["", header])
+		cells = [
+			f"TC-M{n % 17}-F{n % 13}-{n:04d}",
+			f"模块{n % 17}",
+			f"子模块{n % 13}",
+			"".join(rng.choice(words) for _ in range(6)),
+			"已登录",
+			"1. 打开页面；2. " + "".join(rng.choice(words) for _ in range(8)) + "；3. 提交",
+			"提示" + "".join(rng.choice(words) for _ in range(5)),
+			rng.choice(["功能", "异常", "边界"]),
+		]
+		roll = rng.random()
+		if roll < 0.01:
+			cells[6] += ", 并记录日志"  # unquoted comma -> 9 cells
+		elif roll < 0.02:
+			cells = cells[:6]  # truncated row
+		elif roll < 0.03:
+			cells[5] = '"' + cells[5].replace("；", "\n") + '"'  # quoted multiline cell
+		out.append(",".join(cells))
+	out.append("```")
+	return "\n".join(out)
+
+
+def _old_lines(text: str) -> list:
+	text = _strip_code_fences(text).lstrip("\ufeff")
+	return text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+
+
+def old_validate(text: str) -> bool:
+	rows = list(csv.reader(_old_lines(text)))
+	if len(rows) < 2 or [c.strip() for c in rows[0]] != EXPECTED_HEADER:
+		return False
+	return all(len(r) == len(EXPECTED_HEADER) for r in rows[1:])
+
+
+def old_coerce(text: str) -> str:
+	lines = [ln for ln in _old_lines(text) if ln.strip()]
+	for start, line in enumerate(lines):
+		delimiter = _find_header(line.strip())
+		if delimiter is not None:
+			break
+	else:
+		return text
+	joined = "\n".join(lines[start:])
+	if delimiter == "，":
+		joined = joined.replace("，", ",")
+	width = len(EXPECTED_HEADER)
+	out = io.StringIO()
+	writer = csv.writer(out, lineterminator="\r\n")
+	writer.writerow(EXPECTED_HEADER)
+	for r in list(csv.reader(io.StringIO(joined)))[1:]:
+		if not any(cell.strip() for cell in r):
+			continue
+		if len(r) > width:
+			r = r[: width - 1] + [",".join(r[width - 1:]).strip()]
+		writer.writerow([cell.strip() for cell in r] + [""] * (width - len(r)))
+	return out.getvalue()
+
+
+def old_pipeline(text: str) -> str:
+	if not old_validate(text):
+		repaired = old_coerce(text)
+		if old_validate(repaired):
+			return repaired
+	return text
+
+
+def timed(fn, text: str, trace_memory: bool):
+	if trace_memory:
+		tracemalloc.start()
+	t0 = time.perf_counter()
+	result = fn(text)
+	dt = time.perf_counter() - t0
+	peak = None
+	if trace_memory:
+		_, peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+	return result, dt, peak
+
+
+def run(rows: int, trace_memory: bool) -> None:
+	text = make_csv(rows)
+	mb = len(text.encode("utf-8")) / (1024 * 1024)
+	_, old_s, old_peak = timed(old_pipeline, text, trace_memory)
+	(_, ok, report), new_s, new_peak = timed(normalize_csv, text, trace_memory)
+	line = (
+		f"{rows:8d} rows {mb:6.1f} MB  old={old_s:6.2f}s  single-pass={new_s:6.2f}s "
+		f"({old_s / max(new_s, 1e-9):4.1f}x)  ok={ok} repairs={report['repairs']}"
+	)
+	if trace_memory:
+		line += f"  peak old={old_peak / (1024 * 1024):6.1f} MB new={new_peak / (1024 * 1024):6.1f} MB"
+	print(line)
+
+	case_rows = [row for row, _ in iter_normalized_csv(text)]
+	for row in case_rows[: len(case_rows) // 10]:
+		copy = list(row)
+		copy[6] += "。"
+		copy[5] = copy[5].replace("打开页面", "打开该页面")
+		case_rows.append(copy)
+	t0 = time.perf_counter()
+	kept, removed = dedupe_case_rows(case_rows, 0.85)
+	print(f"{'':8s} dedup {len(case_rows)} rows -> {len(kept)} ({len(removed)} removed) in {time.perf_counter() - t0:5.2f}s")
+
+
+def main() -> None:
+	ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	ap.add_argument("--rows", type=int, nargs="+", default=[50_000], help="data rows per run")
+	ap.add_argument("--trace-memory", action="store_true", help="report peak traced memory")
+	args = ap.parse_args()
+	for rows in args.rows:
+		run(rows, args.trace_memory)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,163 @@
+"""Benchmark the IVF (approximate) KB index against exact search: recall vs latency.
+
+Builds a persisted index from synthetic clustered embeddings (real section
+embeddings are clustered by topic, uniform random vectors are the worst case
+for IVF), trains it, then for each ``--nprobe`` reports recall@k against the
+exact top k and the mean query latency. Also times the first build (load +
+train + persist) against a fresh worker start that reads the persisted index.
+Requires NumPy.
+
+The summary names the smallest ``nprobe`` that reaches ``--target-recall`` and
+its speedup over exact search. IVF only pays off on large indexes: on small
+ones (a few 10k sections) exact search is already sub-millisecond, and the
+clusters are too coarse for good recall at a useful ``nprobe``. That is why the
+service keeps exact search below ``KB_ANN_MIN_ROWS``, and the summary says
+which of the two it would use at this size with the configured defaults.
+
+Usage:
+    python scripts/bench_kb_ann.py                               # 100k sections, 256 dims
+    python scripts/bench_kb_ann.py --sections 1000000 --dim 128 --nprobe 4 8 16 32
+    python scripts/bench_kb_ann.py --nlist 2048 --uniform
+    python scripts/bench_kb_ann.py --sections 20000 --target-recall 0.9
+"""
+
+from __future__ import annotations
+
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backend.config import KB_ANN_MIN_ROWS_DEFAULT, KB_ANN_NPROBE_DEFAULT  # noqa: E402
+from backend.services.ann_index import IndexStore, IvfFlat  # noqa: E402
+from backend.services.vector_index import KbVectorIndex, np  # noqa: E402
+
+
+SECTIONS_PER_DOC = 100
+TOPICS = 1000
+
+
+def make_loader(sections: int, dim: int, uniform: bool):
+	"""``(list_doc_ids, load_doc)`` over synthetic docs generated on demand."""
+
+	docs = (sections + SECTIONS_PER_DOC - 1) // SECTIONS_PER_DOC
+	topics = np.random.default_rng(0).standard_normal((TOPICS, dim), dtype=np.float32)
+
+	def vectors(seed: int, count: int):
+		rng = np.random.default_rng(seed)
+		noise = rng.standard_normal((count, dim), dtype=np.float32)
+		if uniform:
+			return noise
+		return topics[rng.integers(0, TOPICS, count)] + noise
+
+	def list_doc_ids():
+		return [f"doc{d:07d}" for d in range(docs)]
+
+	def load_doc(doc_id: str):
+		d = int(doc_id[3:])
+		count = min(SECTIONS_PER_DOC, sections - d * SECTIONS_PER_DOC)
+		return {
+			"doc_id": doc_id,
+			"name": doc_id,
+			"sections": [
+				{"title": f"{doc_id}-{i}", "text": "", "images": [], "embedding": vec}
+				for i, vec in enumerate(vectors(d + 1, count).tolist())
+			],
+		}
+
+	return list_doc_ids, load_doc, vectors
+
+
+def timed_queries(index: KbVectorIndex, queries, top_k: int, nprobe=None):
+	t0 = time.perf_counter()
+	hits = [[h["title"] for h in index.search(q, top_k=top_k, nprobe=nprobe)] for q in queries]
+	return hits, (time.perf_counter() - t0) / len(queries) * 1000
+
+
+def main() -> None:
+	ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	ap.add_argument("--sections", type=int, default=100_000, help="sections in the index")
+	ap.add_argument("--dim", type=int, default=256, help="embedding dimension")
+	ap.add_argument("--queries", type=int, default=200, help="queries timed per setting")
+	ap.add_argument("--top-k", type=int, default=10)
+	ap.add_argument("--nlist", type=int, default=0, help="IVF clusters (0 = about sqrt(sections))")
+	ap.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32, 64], help="clusters probed per query")
+	ap.add_argument("--uniform", action="store_true", help="uniform random vectors instead of clustered ones")
+	ap.add_argument("--target-recall", type=float, default=0.95, help="recall@k an nprobe must reach to be recommended")
+	ap.add_argument("--min-speedup", type=float, default=2.0, help="speedup over exact below which ANN is not worth it")
+	args = ap.parse_args()
+	if np is None:
+		sys.exit("bench_kb_ann.py needs NumPy")
+
+	list_doc_ids, load_doc, vectors = make_loader(args.sections, args.dim, args.uniform)
+	root = Path(tempfile.mkdtemp(prefix="kb-ann-"))
+	try:
+		def open_index() -> KbVectorIndex:
+			return KbVectorIndex(
+				list_doc_ids,
+				load_doc,
+				ann=IvfFlat(nlist=args.nlist),
+				store=IndexStore(root),
+				ann_min_rows=1,
+			)
+
+		index = open_index()
+		t0 = time.perf_counter()
+		index.refresh(force=True)
+		load_s = time.perf_counter() - t0
+		queries = vectors(10**9, args.queries).tolist()
+		t0 = time.perf_counter()
+		index.search(queries[0], top_k=1)  # first search trains and rewrites the store
+		train_s = time.perf_counter() - t0
+
+		exact = KbVectorIndex(list_doc_ids, load_doc)
+		exact.refresh(force=True)
+		truth, exact_ms = timed_queries(exact, queries, args.top_k)
+		del exact
+
+		t0 = time.perf_counter()
+		warm = open_index()
+		warm.refresh(force=True)
+		reopen_s = time.perf_counter() - t0
+		stats = warm.stats()
+		size_mb = sum(p.stat().st_size for p in root.iterdir()) / 2**20
+
+		print(
+			f"{stats['sections']} sections dim={args.dim} clusters={stats['ann_clusters']} "
+			f"{'uniform' if args.uniform else 'clustered'}  index on disk {size_mb:.0f} MB"
+		)
+		print(f"first build: load docs {load_s:.2f}s + train/persist {train_s:.2f}s; worker start from disk {reopen_s:.2f}s")
+		print(f"exact:        {exact_ms:8.2f} ms/query  recall@{args.top_k}=1.000")
+		results = []
+		for nprobe in sorted(args.nprobe):
+			hits, ms = timed_queries(warm, queries, args.top_k, nprobe)
+			recall = sum(len(set(h) & set(t)) for h, t in zip(hits, truth)) / (len(truth) * args.top_k)
+			speedup = exact_ms / max(ms, 1e-9)
+			results.append((nprobe, recall, speedup))
+			print(f"nprobe={nprobe:<5d} {ms:8.2f} ms/query  recall@{args.top_k}={recall:.3f}  ({speedup:5.1f}x)")
+
+		best = next((r for r in results if r[1] >= args.target_recall), None)
+		if best is None:
+			print(f"no tested nprobe reaches recall@{args.top_k}={args.target_recall}: keep exact search at this size")
+		elif best[2] < args.min_speedup:
+			print(
+				f"nprobe={best[0]} reaches recall@{args.top_k}={best[1]:.3f} but is only {best[2]:.1f}x faster "
+				f"than exact: keep exact search at this size"
+			)
+		else:
+			print(f"nprobe={best[0]} reaches recall@{args.top_k}={best[1]:.3f} at {best[2]:.1f}x the speed of exact search")
+		mode = "ANN" if stats["sections"] >= KB_ANN_MIN_ROWS_DEFAULT else "exact search"
+		print(
+			f"configured: KB_ANN_MIN_ROWS={KB_ANN_MIN_ROWS_DEFAULT} KB_ANN_NPROBE={KB_ANN_NPROBE_DEFAULT} "
+			f"-> {mode} for {stats['sections']} sections"
+		)
+	finally:
+		shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,117 @@
+"""Benchmark KB similarity search: per-query scan vs the in-process vector index.
+
+The scan baseline is the previous ``search_similar_sections`` loop
+(``cosine_similarity`` on every section, then a full sort); it is timed on at
+most ``--baseline-max`` sections and extrapolated linearly. The index is
+built from synthetic documents of random embeddings and queried
+``--queries`` times. Without NumPy the index runs its pure-Python fallback.
+
+Usage:
+    python scripts/bench_kb_index.py                         # 10k, 100k sections, 1536 dims
+    python scripts/bench_kb_index.py --sizes 1000000 --dim 256
+    python scripts/bench_kb_index.py --sizes 20000 --baseline-max 20000   # also checks top-k agreement
+
+A 1M x 1536 float32 matrix needs about 6 GB; use a smaller ``--dim`` for 1M runs.
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backend.services.embeddings import cosine_similarity  # noqa: E402
+from backend.services.vector_index import KbVectorIndex, np  # noqa: E402
+
+
+SECTIONS_PER_DOC = 100
+
+
+def make_vectors(seed: int, count: int, dim: int) -> list:
+	if np is not None:
+		return np.random.default_rng(seed).standard_normal((count, dim), dtype=np.float32).tolist()
+	rng = random.Random(seed)
+	return [[rng.gauss(0.0, 1.0) for _ in range(dim)] for _ in range(count)]
+
+
+def make_loader(sections: int, dim: int):
+	"""``(list_doc_ids, load_doc)`` over synthetic docs generated on demand."""
+
+	docs = (sections + SECTIONS_PER_DOC - 1) // SECTIONS_PER_DOC
+
+	def list_doc_ids():
+		return [f"doc{d:06d}" for d in range(docs)]
+
+	def load_doc(doc_id: str):
+		d = int(doc_id[3:])
+		count = min(SECTIONS_PER_DOC, sections - d * SECTIONS_PER_DOC)
+		return {
+			"doc_id": doc_id,
+			"name": doc_id,
+			"sections": [
+				{"title": f"{doc_id}-{i}", "text": "", "images": [], "embedding": vec}
+				for i, vec in enumerate(make_vectors(d, count, dim))
+			],
+		}
+
+	return list_doc_ids, load_doc
+
+
+def scan_search(docs: list, query: list, top_k: int) -> list:
+	results = []
+	for doc in docs:
+		for sec in doc["sections"]:
+			sim = cosine_similarity(query, sec["embedding"])
+			results.append((sim, sec["title"]))
+	results.sort(key=lambda x: x[0], reverse=True)
+	return [title for _, title in results[:top_k]]
+
+
+def run(sections: int, dim: int, queries: int, baseline_max: int, top_k: int) -> None:
+	list_doc_ids, load_doc = make_loader(sections, dim)
+	index = KbVectorIndex(list_doc_ids, load_doc)
+	t0 = time.perf_counter()
+	index.refresh(force=True)
+	build_s = time.perf_counter() - t0
+
+	query_vecs = make_vectors(10**9 + sections, queries, dim)
+	t0 = time.perf_counter()
+	hits = [index.search(q, top_k=top_k) for q in query_vecs]
+	index_ms = (time.perf_counter() - t0) / queries * 1000
+
+	base_n = min(sections, baseline_max)
+	base_docs = [load_doc(doc_id) for doc_id in list_doc_ids()[: (base_n + SECTIONS_PER_DOC - 1) // SECTIONS_PER_DOC]]
+	base_queries = query_vecs[: max(1, min(queries, 3))]
+	t0 = time.perf_counter()
+	base_hits = [scan_search(base_docs, q, top_k) for q in base_queries]
+	base_ms = (time.perf_counter() - t0) / len(base_queries) * 1000 * sections / base_n
+
+	line = (
+		f"{sections:9d} sections dim={dim}  build={build_s:7.2f}s  "
+		f"scan~{base_ms:10.1f} ms/query  index={index_ms:8.2f} ms/query  ({base_ms / max(index_ms, 1e-9):7.1f}x)"
+		f"  mode={'numpy' if index.vectorized else 'python'}"
+	)
+	if base_n == sections:
+		agree = all([h["title"] for h in hits[i]] == base_hits[i] for i in range(len(base_hits)))
+		line += f"  top-{top_k} matches scan={agree}"
+	print(line)
+
+
+def main() -> None:
+	ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	ap.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000], help="sections per run")
+	ap.add_argument("--dim", type=int, default=1536, help="embedding dimension")
+	ap.add_argument("--queries", type=int, default=20, help="queries timed per run")
+	ap.add_argument("--baseline-max", type=int, default=2_000, help="sections the scan baseline is timed on")
+	ap.add_argument("--top-k", type=int, default=5)
+	args = ap.parse_args()
+	for sections in args.sizes:
+		run(sections, args.dim, args.queries, args.baseline_max, args.top_k)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,84 @@
+"""Benchmark PRD parsing and batch planning on large synthetic documents.
+
+Usage:
+    python scripts/bench_parsing.py                 # 10, 25, 50 MB
+    python scripts/bench_parsing.py --sizes 5 100   # custom sizes (MB)
+    python scripts/bench_parsing.py --trace-memory  # also report peak memory (slower)
+"""
+
+from __future__ import annotations
+
+import argparse
+import random
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backend.services.parsing import create_batches_from_sections, parse_prd_sections  # noqa: E402
+
+
+def make_prd(target_mb: float, seed: int = 0) -> str:
+	"""Build a markdown PRD of roughly ``target_mb`` (UTF-8) with many sections and images."""
+
+	rng = random.Random(seed)
+	words = ["用户", "登录", "订单", "支付", "校验", "按钮", "页面", "提示", "字段", "状态", "接口", "权限"]
+	target = int(target_mb * 1024 * 1024)
+	parts = []
+	size = 0
+	n = 0
+	while size < target:
+		n += 1
+		level = "#" if n % 20 == 1 else "##"
+		lines = [f"{level} 功能模块 {n}"]
+		for _ in range(rng.randint(5, 60)):
+			lines.append("- " + "".join(rng.choice(words) for _ in range(rng.randint(8, 40))))
+			if rng.random() < 0.08:
+				lines.append(f"![截图 {n}](https://cdn.example.com/prd/{n}/{rng.getrandbits(64):016x}.png?sig={rng.getrandbits(128):032x})")
+		if rng.random() < 0.2:
+			lines.append("| 字段 | 类型 | 说明 |\n| --- | --- | --- |")
+			lines.extend(f"| f{i} | string | 描述{i} |" for i in range(rng.randint(2, 12)))
+		block = "\n".join(lines) + "\n\n"
+		parts.append(block)
+		size += len(block.encode("utf-8"))
+	return "".join(parts)
+
+
+def run(size_mb: float, trace_memory: bool) -> None:
+	text = make_prd(size_mb)
+	if trace_memory:
+		tracemalloc.start()
+	t0 = time.perf_counter()
+	sections = parse_prd_sections(text)
+	t1 = time.perf_counter()
+	batches = create_batches_from_sections(sections)
+	t2 = time.perf_counter()
+	peak = None
+	if trace_memory:
+		_, peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+
+	mb = len(text.encode("utf-8")) / (1024 * 1024)
+	images = sum(len(s["images"]) for s in sections)
+	line = (
+		f"{mb:6.1f} MB  sections={len(sections):6d}  images={images:6d}  batches={len(batches):5d}  "
+		f"parse={t1 - t0:6.2f}s ({mb / max(t1 - t0, 1e-9):6.1f} MB/s)  plan={t2 - t1:6.3f}s"
+	)
+	if peak is not None:
+		line += f"  peak={peak / (1024 * 1024):7.1f} MB"
+	print(line)
+
+
+def main() -> None:
+	ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	ap.add_argument("--sizes", type=float, nargs="+", default=[10, 25, 50], help="document sizes in MB")
+	ap.add_argument("--trace-memory", action="store_true", help="report peak traced memory")
+	args = ap.parse_args()
+	for size in args.sizes:
+		run(size, args.trace_memory)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,120 @@
+"""Route-level smoke check: call the API through Flask's test client.
+
+The model client is replaced by a canned one (``create_openai_client`` in the
+route module), so no API key or network is needed. Each check posts a real
+request body and asserts on the status code and the shape of the reply;
+the script exits non-zero on the first failure.
+
+Model capability lookups the routes depend on are checked first.
+
+Usage:
+    python scripts/smoke_routes.py
+"""
+
+from __future__ import annotations
+
+import sys
+from pathlib import Path
+from types import SimpleNamespace
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from backend import create_app  # noqa: E402
+from backend.routes import enhance as enhance_routes  # noqa: E402
+from backend.services.models import get_model_capabilities, plan_request  # noqa: E402
+
+
+CASES_CSV = """用例ID,模块,子模块,测试项,前置条件,操作步骤,预期结果,用例类型
+TC-登录-0001,登录,密码登录,正确密码登录,已注册,1. 输入账号密码 2. 点击登录,登录成功,功能
+TC-登录-0002,登录,密码登录,错误密码登录,已注册,1. 输入错误密码 2. 点击登录,提示密码错误,功能
+"""
+
+DELTA_REPLY = """用例ID,模块,子模块,测试项,前置条件,操作步骤,预期结果,用例类型
+[新增] TC-登录-0003,登录,密码登录,密码为空,已注册,1. 不输入密码 2. 点击登录,提示请输入密码,异常
+"""
+
+# A second pass over an already enhanced suite modifies one of its rows
+REDELTA_REPLY = """用例ID,模块,子模块,测试项,前置条件,操作步骤,预期结果,用例类型
+[修改] TC-登录-0003,登录,密码登录,密码为空,已注册,1. 不输入密码 2. 点击登录,提示请输入密码且登录按钮置灰,异常
+"""
+
+
+class _CannedCompletions:
+	def __init__(self, reply: str) -> None:
+		self.reply = reply
+		self.calls = 0
+
+	def create(self, **kwargs):
+		self.calls += 1
+		return SimpleNamespace(
+			choices=[SimpleNamespace(message=SimpleNamespace(content=self.reply), finish_reason="stop")],
+			usage=SimpleNamespace(prompt_tokens=100, completion_tokens=40),
+		)
+
+
+def _canned_client(reply: str):
+	completions = _CannedCompletions(reply)
+	return SimpleNamespace(chat=SimpleNamespace(completions=completions)), completions
+
+
+def check(name: str, ok: bool, detail: object = "") -> None:
+	print(f"{'ok  ' if ok else 'FAIL'} {name}")
+	if not ok:
+		print(f"     {detail}")
+		sys.exit(1)
+
+
+def check_model_registry() -> None:
+	"""Vision variants of text-only families must keep image support."""
+
+	image_message = [{"role": "user", "content": [{"type": "image_url", "image_url": {"url": "data:,"}}]}]
+	for model in ("glm-4v", "glm-4.5v", "deepseek-vl2", "qwen-vl-max"):
+		check(f"registry: {model} accepts images", get_model_capabilities(model)["images"], get_model_capabilities(model))
+		try:
+			plan_request(model, image_message)
+		except ValueError as exc:
+			check(f"registry: plan_request({model}) with an image", False, exc)
+	for model in ("glm-4", "deepseek-chat"):
+		check(f"registry: {model} is text-only", not get_model_capabilities(model)["images"])
+
+
+def main() -> None:
+	check_model_registry()
+
+	app = create_app()
+	http = app.test_client()
+
+	resp = http.get("/api/health")
+	check("GET /api/health", resp.status_code == 200, resp.data)
+
+	client, completions = _canned_client(DELTA_REPLY)
+	enhance_routes.create_openai_client = lambda *_args, **_kwargs: client
+	body = {
+		"test_cases": CASES_CSV,
+		# A model name no other run caches under, so the chunk is really sent
+		"config": {"api_key": "smoke", "text_model": f"smoke-{id(client)}", "enhance_mode": "delta"},
+	}
+	resp = http.post("/api/enhance", json=body)
+	data = resp.get_json() or {}
+	check("POST /api/enhance (delta)", resp.status_code == 200, data)
+	check("  merged the added row", "[新增] TC-登录-0003" in data.get("enhanced_cases", ""), data.get("enhanced_cases"))
+	check("  kept the original rows", "TC-登录-0002" in data.get("enhanced_cases", ""), data.get("enhanced_cases"))
+	check("  one model call", completions.calls == 1, completions.calls)
+
+	client, completions = _canned_client(REDELTA_REPLY)
+	body = {
+		"test_cases": data.get("enhanced_cases", ""),
+		"config": {"api_key": "smoke", "text_model": f"smoke-{id(client)}", "enhance_mode": "delta"},
+	}
+	resp = http.post("/api/enhance", json=body)
+	data = resp.get_json() or {}
+	cases = data.get("enhanced_cases", "")
+	check("POST /api/enhance (enhanced input)", resp.status_code == 200, data)
+	check("  modified the marked row in place", cases.count("TC-登录-0003") == 1 and "[修改] TC-登录-0003" in cases, cases)
+
+	resp = http.post("/api/enhance", json={"test_cases": "", "config": body["config"]})
+	check("POST /api/enhance (empty input) -> 400", resp.status_code == 400, resp.data)
+
+
+if __name__ == "__main__":
+	main()